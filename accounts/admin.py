@@ -5,6 +5,8 @@ from .models import PassengerProfile
 class PassengerProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'balance', 'phone')
     search_fields = ('user__username', 'user__email', 'phone')
+    # Snapshot of the wallet ledger; change it with a WalletTransaction.
+    readonly_fields = ('balance',)
 
 
 admin.site.register(PassengerProfile, PassengerProfileAdmin)
\ No newline at end of file
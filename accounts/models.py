@@ -8,5 +8,15 @@ class PassengerProfile(models.Model):
     balance = models.DecimalField(max_digits=8, decimal_places=2, default=Decimal('0.00'))
     phone = models.CharField(max_length=20, blank=True)
 
+    def save(self, *args, **kwargs):
+        # balance only changes through metro.wallet's F() updates; saving a
+        # profile loaded earlier must not write back its stale balance.
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'balance'
+            ]
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.user.username}'s Profile"
\ No newline at end of file
@@ -23,5 +23,8 @@ fi
 echo "Applying database migrations..."
 python manage.py migrate --noinput
 
+echo "Creating TicketScan partitions..."
+python manage.py create_scan_partitions
+
 echo "Starting Gunicorn..."
 exec gunicorn mysite.wsgi:application --bind 0.0.0.0:8000 --workers 3 --timeout 120
@@ -21,6 +21,17 @@ class WalletTransactionAdmin(admin.ModelAdmin):
     list_display = ('passenger', 'amount', 'description', 'created_at')
     list_filter = ('created_at',)
     search_fields = ('passenger__user__username',)
+    # __str__ and the passenger column both need passenger.user.
+    list_select_related = ('passenger__user',)
+    # Counting the whole ledger on every page load is slow once it is large.
+    show_full_result_count = False
+
+    # The ledger is append-only: entries are never edited or deleted.
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 
 class TicketAdmin(admin.ModelAdmin):
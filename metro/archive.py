@@ -0,0 +1,301 @@
+"""
+Monthly retention for scans and tickets.
+
+On PostgreSQL metro_ticketscan is range-partitioned on scanned_at with one
+partition per local month (migration 0013); ensure_scan_partitions()
+creates upcoming months ahead of time. archive_month() writes a closed
+month of scans or tickets to gzipped NDJSON under METRO_ARCHIVE_DIR, marks
+the file read-only and removes the month from the hot tables, dropping the
+scan partition outright where there is one. read_archive() streams an
+archived month back. The footfall rollup is kept, so reports still cover
+archived months.
+"""
+import gzip
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, Min, OuterRef, Q
+from django.utils import timezone
+
+from .exports import EXPORTS, iter_ndjson
+from .models import LIVE_TICKET, Ticket, TicketScan
+
+SCAN_TABLE = TicketScan._meta.db_table
+DATASETS = ('scans', 'tickets')
+# Rows read, and tickets deleted, per statement while archiving.
+BATCH_SIZE = 1000
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def month_start(moment=None):
+    """
+    Aware start of the local month containing moment (default now).
+    """
+    local = timezone.localtime(moment)
+    return timezone.make_aware(datetime(local.year, local.month, 1))
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return timezone.make_aware(datetime(index // 12, index % 12 + 1, 1))
+
+
+def parse_month(label):
+    """
+    Aware local month start for a YYYY-MM label; raises ValueError.
+    """
+    return timezone.make_aware(datetime.strptime(label, '%Y-%m'))
+
+
+def month_label(month):
+    return f"{month:%Y-%m}"
+
+
+def archive_dir():
+    directory = getattr(settings, 'METRO_ARCHIVE_DIR', None)
+    if not directory:
+        raise ArchiveError("METRO_ARCHIVE_DIR is not set.")
+    return Path(directory)
+
+
+# ----- scan partitions (PostgreSQL only) -----
+
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [SCAN_TABLE])
+        return cursor.fetchone() is not None
+
+
+def partition_name(month):
+    return f"{SCAN_TABLE}_p{month:%Y%m}"
+
+
+def _partition_exists(cursor, month):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [partition_name(month)])
+    return cursor.fetchone()[0]
+
+
+def _create_partition(cursor, month):
+    """
+    Add the partition for month. Scans that landed in the default partition
+    for that month are moved into it before it is attached, as PostgreSQL
+    refuses to attach a range the default partition already holds rows for.
+    """
+    name = connection.ops.quote_name(partition_name(month))
+    table = connection.ops.quote_name(SCAN_TABLE)
+    default = connection.ops.quote_name(f"{SCAN_TABLE}_default")
+    start, end = month.isoformat(), add_months(month, 1).isoformat()
+    cursor.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    cursor.execute(
+        f"WITH moved AS (DELETE FROM {default} WHERE scanned_at >= %s AND scanned_at < %s RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved",
+        [start, end],
+    )
+    cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')")
+
+
+def ensure_scan_partitions(months_ahead=2, now=None):
+    """
+    Create scan partitions for the current month and the months_ahead after
+    it that do not exist yet. Returns the names created; nothing is done
+    when the table is not partitioned.
+    """
+    if not is_partitioned():
+        return []
+    created = []
+    first = month_start(now)
+    with transaction.atomic(), connection.cursor() as cursor:
+        for offset in range(months_ahead + 1):
+            month = add_months(first, offset)
+            if not _partition_exists(cursor, month):
+                _create_partition(cursor, month)
+                created.append(partition_name(month))
+    return created
+
+
+# ----- archiving -----
+
+def retention_cutoffs(keep_months=None, now=None):
+    """
+    {dataset: first month kept hot}. Scans older than the retention window
+    are archived; tickets a month later, so a ticket bought at the end of a
+    month is not archived before the scans of its journey.
+    """
+    if keep_months is None:
+        keep_months = settings.METRO_RETENTION_MONTHS
+    scans = add_months(month_start(now), -keep_months)
+    return {'scans': scans, 'tickets': add_months(scans, -1)}
+
+
+def _archivable(dataset, start, end, now=None):
+    queryset, time_field, _station_filter, _columns = EXPORTS[dataset]
+    rows = queryset().filter(**{f'{time_field}__gte': start, f'{time_field}__lt': end})
+    if dataset == 'tickets':
+        now = now or timezone.now()
+        # Tickets that can still be used, or that scans still in the hot
+        # table point at (deleting them would cascade), stay for a later run.
+        rows = (rows
+                .exclude(LIVE_TICKET & (Q(expires_at__isnull=True) | Q(expires_at__gt=now)))
+                .exclude(Exists(TicketScan.objects.filter(ticket=OuterRef('pk')))))
+    return rows
+
+
+def months_to_archive(dataset, keep_months=None, now=None):
+    """
+    Months before the retention cutoff that still have rows in the hot table.
+    """
+    cutoff = retention_cutoffs(keep_months, now)[dataset]
+    queryset, time_field, _station_filter, _columns = EXPORTS[dataset]
+    oldest = queryset().filter(**{f'{time_field}__lt': cutoff}).aggregate(oldest=Min(time_field))['oldest']
+    months = []
+    month = month_start(oldest) if oldest else cutoff
+    while month < cutoff:
+        if _archivable(dataset, month, add_months(month, 1), now).exists():
+            months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+def archive_files(dataset, month):
+    """
+    Archive files for a month in the order they were written. A month has
+    more than one when rows turned up after it was first archived, such as
+    a late gate upload.
+    """
+    prefix = f"{dataset}-{month_label(month)}"
+    return sorted(archive_dir().glob(f"{prefix}.*ndjson.gz"), key=lambda path: (len(path.name), path.name))
+
+
+def archived_months(dataset):
+    months = set()
+    for path in archive_dir().glob(f"{dataset}-*.ndjson.gz"):
+        months.add(path.name[len(dataset) + 1:len(dataset) + 8])
+    return sorted(months)
+
+
+def archived_until():
+    """
+    End of the newest month whose scans were archived, or None if none
+    were (or archiving is not configured). Scans before it are no longer
+    all in TicketScan, so the footfall rollup there cannot be recomputed.
+    """
+    if not getattr(settings, 'METRO_ARCHIVE_DIR', None):
+        return None
+    months = archived_months('scans')
+    return add_months(parse_month(months[-1]), 1) if months else None
+
+
+def _next_archive_path(dataset, month):
+    directory = archive_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    part = len(archive_files(dataset, month)) + 1
+    suffix = '' if part == 1 else f".{part}"
+    return directory / f"{dataset}-{month_label(month)}{suffix}.ndjson.gz"
+
+
+class _Counted:
+    def __init__(self, rows):
+        self.rows = rows
+        self.count = 0
+
+    def __iter__(self):
+        for row in self.rows:
+            self.count += 1
+            yield row
+
+
+def _delete_scans(month, start, end):
+    deleted = 0
+    if connection.vendor == 'postgresql' and is_partitioned():
+        with connection.cursor() as cursor:
+            if _partition_exists(cursor, month):
+                name = connection.ops.quote_name(partition_name(month))
+                cursor.execute(f"SELECT count(*) FROM {name}")
+                deleted = cursor.fetchone()[0]
+                cursor.execute(f"ALTER TABLE {connection.ops.quote_name(SCAN_TABLE)} DETACH PARTITION {name}")
+                cursor.execute(f"DROP TABLE {name}")
+    # Everything else: the default partition, or the whole table when it
+    # is not partitioned. TicketScan has no dependents, so this is one DELETE.
+    count, _ = TicketScan.objects.filter(scanned_at__gte=start, scanned_at__lt=end).delete()
+    return deleted + count
+
+
+def archive_month(dataset, month, now=None):
+    """
+    Move one month of dataset out of the hot tables into a new read-only
+    archive file. Returns the number of rows archived.
+
+    The file is renamed into place before the deleting transaction commits,
+    so a failure can leave rows both archived and hot, never in neither.
+    """
+    start, end = month, add_months(month, 1)
+    _queryset, time_field, _station_filter, columns = EXPORTS[dataset]
+    lookups = [lookup for _, lookup in columns]
+    path = _next_archive_path(dataset, month)
+    partial = path.with_name(f".{path.name}.tmp")
+
+    try:
+        with transaction.atomic():
+            rows = _archivable(dataset, start, end, now).order_by(time_field, 'id')
+            if dataset == 'scans' and connection.vendor == 'postgresql' and is_partitioned():
+                with connection.cursor() as cursor:
+                    if _partition_exists(cursor, month):
+                        # Block late uploads into the month until it is gone.
+                        cursor.execute(f"LOCK TABLE {connection.ops.quote_name(partition_name(month))} IN EXCLUSIVE MODE")
+
+            written = deleted = 0
+            with gzip.open(partial, 'wt', encoding='utf-8') as out:
+                if dataset == 'scans':
+                    counted = _Counted(rows.values_list(*lookups).iterator(chunk_size=BATCH_SIZE))
+                    for chunk in iter_ndjson([column for column, _ in columns], counted):
+                        out.write(chunk)
+                    written = counted.count
+                    deleted = _delete_scans(month, start, end)
+                else:
+                    # Ticket deletes go through the collector, so archive and
+                    # delete a batch at a time rather than the whole month.
+                    while True:
+                        batch = list(rows.values_list(*lookups)[:BATCH_SIZE])
+                        if not batch:
+                            break
+                        for chunk in iter_ndjson([column for column, _ in columns], batch):
+                            out.write(chunk)
+                        written += len(batch)
+                        _count, per_model = Ticket.objects.filter(pk__in=[row[0] for row in batch]).delete()
+                        deleted += per_model.get(Ticket._meta.label, 0)
+                out.flush()
+                os.fsync(out.fileno())
+
+            if written != deleted:
+                raise ArchiveError(
+                    f"{dataset} {month_label(month)}: wrote {written} rows but deleted {deleted}; "
+                    f"rows changed while archiving, try again."
+                )
+            if written:
+                os.replace(partial, path)
+                os.chmod(path, 0o444)
+    finally:
+        if partial.exists():
+            partial.unlink()
+    return written
+
+
+def read_archive(dataset, month):
+    """
+    Rows of an archived month as dicts, in the order they were archived.
+    Values are as written by the export encoder: ids and timestamps are
+    strings.
+    """
+    for path in archive_files(dataset, month):
+        with gzip.open(path, 'rt', encoding='utf-8') as fh:
+            for line in fh:
+                yield json.loads(line)
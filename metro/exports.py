@@ -0,0 +1,105 @@
+"""
+Streaming CSV / NDJSON exports of raw scans and tickets for analysts.
+Rows are read through a server-side cursor and written out a chunk at a
+time, so memory stays flat however many rows match.
+"""
+import csv
+import io
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from .models import Ticket, TicketScan
+
+CHUNK_SIZE = 2000
+
+# name -> (queryset, timestamp field, station filter, [(column, lookup), ...])
+EXPORTS = {
+    'scans': (
+        TicketScan.objects.all,
+        'scanned_at',
+        lambda station_id: Q(station_id=station_id),
+        [
+            ('id', 'id'),
+            ('ticket_id', 'ticket_id'),
+            ('station', 'station__code'),
+            ('direction', 'direction'),
+            ('scanned_at', 'scanned_at'),
+            ('scanned_by', 'scanned_by__username'),
+            ('gate_id', 'gate_id'),
+            ('gate_seq', 'gate_seq'),
+        ],
+    ),
+    'tickets': (
+        Ticket.objects.all,
+        'created_at',
+        lambda station_id: Q(source_id=station_id) | Q(destination_id=station_id),
+        [
+            ('id', 'id'),
+            ('passenger', 'passenger__user__username'),
+            ('source', 'source__code'),
+            ('destination', 'destination__code'),
+            ('price', 'price'),
+            ('status', 'status'),
+            ('lines_used', 'lines_used'),
+            ('path', 'path_repr'),
+            ('created_at', 'created_at'),
+            ('expires_at', 'expires_at'),
+            ('updated_at', 'updated_at'),
+        ],
+    ),
+}
+
+
+def export_rows(name, start=None, end=None, station_id=None):
+    """
+    Rows of export name with timestamps in [start, end) and, if given,
+    touching station_id, oldest first. Returns (columns, row iterator).
+    """
+    queryset, time_field, station_filter, columns = EXPORTS[name]
+    rows = queryset()
+    if start:
+        rows = rows.filter(**{f'{time_field}__gte': start})
+    if end:
+        rows = rows.filter(**{f'{time_field}__lt': end})
+    if station_id:
+        rows = rows.filter(station_filter(station_id))
+    rows = rows.order_by(time_field, 'id').values_list(*(lookup for _, lookup in columns))
+    return [column for column, _ in columns], rows.iterator(chunk_size=CHUNK_SIZE)
+
+
+def _chunked(lines):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= CHUNK_SIZE:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def iter_csv(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        writer.writerow(values)
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    yield line(columns)
+    yield from _chunked(line(row) for row in rows)
+
+
+def iter_ndjson(columns, rows):
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    yield from _chunked(encoder.encode(dict(zip(columns, row))) + '\n' for row in rows)
+
+
+FORMATS = {
+    'csv': (iter_csv, 'text/csv; charset=utf-8'),
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+}
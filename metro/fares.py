@@ -0,0 +1,150 @@
+from decimal import Decimal
+
+from django.conf import settings
+
+
+def to_paise(amount):
+    return int((Decimal(str(amount)) * 100).quantize(Decimal('1')))
+
+
+def from_paise(paise):
+    return (Decimal(int(paise)) / 100).quantize(Decimal('0.01'))
+
+
+class Tariff:
+    """
+    Fare rules, parsed from a dict such as settings.METRO_TARIFF:
+
+        base_fare       flat amount added to every trip with at least one edge
+        rate_per_edge   charge per edge, "5.00" by default
+        line_rates      {line_code: rate} overriding rate_per_edge on that line
+        bands           [[max_hops, fare], ...] zone fares replacing the
+                        per-edge charge; trips longer than the last band pay it
+        transfer_fee    added per change of line, negative for a discount
+        min_fare        floor, applied to trips with at least one edge
+        max_fare        cap, optional
+
+    Amounts are kept in integer paise so array maths stays exact.
+    """
+
+    def __init__(self, definition=None):
+        definition = definition or {}
+        self.base_fare = to_paise(definition.get('base_fare', '0.00'))
+        self.rate_per_edge = to_paise(definition.get('rate_per_edge', '5.00'))
+        self.line_rates = {code: to_paise(rate) for code, rate in definition.get('line_rates', {}).items()}
+        bands = sorted((int(hops), to_paise(fare)) for hops, fare in definition.get('bands', []))
+        self.band_limits = [hops for hops, _ in bands]
+        self.band_fares = [fare for _, fare in bands]
+        self.transfer_fee = to_paise(definition.get('transfer_fee', '0.00'))
+        self.min_fare = to_paise(definition.get('min_fare', '0.00'))
+        max_fare = definition.get('max_fare')
+        self.max_fare = to_paise(max_fare) if max_fare is not None else None
+
+    def edge_rate(self, line_code):
+        return self.line_rates.get(line_code, self.rate_per_edge)
+
+    def price(self, edge_line_codes):
+        """
+        Fare as a Decimal for one trip, given the line code of each edge.
+        """
+        hops = len(edge_line_codes)
+        if hops == 0:
+            return Decimal('0.00')
+
+        if self.band_limits:
+            distance = self.band_fares[-1]
+            for limit, fare in zip(self.band_limits, self.band_fares):
+                if hops <= limit:
+                    distance = fare
+                    break
+        else:
+            distance = sum(self.edge_rate(code) for code in edge_line_codes)
+
+        transfers = sum(1 for a, b in zip(edge_line_codes, edge_line_codes[1:]) if a != b)
+        paise = max(self.base_fare + distance + transfers * self.transfer_fee, self.min_fare)
+        if self.max_fare is not None:
+            paise = min(paise, self.max_fare)
+        return from_paise(paise)
+
+    def price_many(self, hops, line_counts, transfers, line_codes):
+        """
+        Fares in paise for many trips at once. hops and transfers are (P,)
+        arrays, line_counts is (P, L) with columns ordered like line_codes.
+        """
+        import numpy as np
+
+        hops = np.asarray(hops, dtype=np.int64)
+        if self.band_limits:
+            band = np.searchsorted(np.array(self.band_limits), hops, side='left')
+            band = np.minimum(band, len(self.band_fares) - 1)
+            distance = np.array(self.band_fares, dtype=np.int64)[band]
+        else:
+            rates = np.array([self.edge_rate(code) for code in line_codes], dtype=np.int64)
+            distance = np.asarray(line_counts, dtype=np.int64) @ rates
+
+        paise = self.base_fare + distance + np.asarray(transfers, dtype=np.int64) * self.transfer_fee
+        paise = np.maximum(paise, self.min_fare)
+        if self.max_fare is not None:
+            paise = np.minimum(paise, self.max_fare)
+        return np.where(hops > 0, paise, 0)
+
+
+_default_tariff = {}
+
+
+def get_tariff():
+    """
+    The tariff configured in settings.METRO_TARIFF, parsed once per worker.
+    """
+    definition = getattr(settings, 'METRO_TARIFF', None)
+    key = repr(definition)
+    if key not in _default_tariff:
+        _default_tariff.clear()
+        _default_tariff[key] = Tariff(definition)
+    return _default_tariff[key]
+
+
+def path_line_codes(engine, path_ids):
+    """
+    Line code of each edge of a path, None for an edge the engine does not
+    know (a path computed before a topology change).
+    """
+    nodes = [engine.index_of(sid) for sid in path_ids]
+    lines = (engine.edge_line(u, v) for u, v in zip(nodes, nodes[1:]))
+    return [engine.line_codes[line] if line is not None else None for line in lines]
+
+
+def od_features(engine):
+    """
+    Hop counts, per-line edge counts and transfer counts for the engine's
+    shortest path between every reachable ordered pair of stations.
+    Returns (pairs, hops, line_counts, transfers).
+    """
+    import numpy as np
+
+    pairs = []
+    hops = []
+    transfers = []
+    counts = []
+    n_lines = len(engine.line_codes)
+    for source_id in engine.station_ids:
+        for dest_id in engine.distances_from(source_id):
+            if dest_id == source_id:
+                continue
+            path_ids = engine.shortest_path(source_id, dest_id)
+            nodes = [engine.index_of(sid) for sid in path_ids]
+            lines = [engine.edge_line(u, v) for u, v in zip(nodes, nodes[1:])]
+            row = [0] * n_lines
+            for line in lines:
+                row[line] += 1
+            pairs.append((source_id, dest_id))
+            hops.append(len(lines))
+            transfers.append(sum(1 for a, b in zip(lines, lines[1:]) if a != b))
+            counts.append(row)
+
+    return (
+        pairs,
+        np.array(hops, dtype=np.int64),
+        np.array(counts, dtype=np.int64).reshape(len(pairs), n_lines),
+        np.array(transfers, dtype=np.int64),
+    )
@@ -0,0 +1,110 @@
+"""
+Hourly footfall rollup. Every code path that writes TicketScan rows calls
+record_scans() in the same transaction; rebuild_footfall() recomputes a
+range from TicketScan for backfills and repairs.
+"""
+from collections import Counter
+from datetime import datetime, time, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDate, TruncHour
+from django.utils import timezone
+
+from .archive import archived_until
+from .models import StationFootfall, TicketScan
+
+
+def bucket_start(moment):
+    """
+    Start of the local-time hour containing moment, so daily totals line
+    up with local days even in zones with a half-hour offset.
+    """
+    return timezone.localtime(moment).replace(minute=0, second=0, microsecond=0)
+
+
+def record_scans(scans):
+    """
+    Add scans, an iterable of (station_id, scanned_at, direction), to the
+    rollup: one UPDATE per (station, hour, direction) bucket touched, plus
+    an INSERT the first time a bucket is seen.
+    """
+    buckets = Counter(
+        (station_id, bucket_start(scanned_at), direction)
+        for station_id, scanned_at, direction in scans
+    )
+    for (station_id, hour, direction), count in buckets.items():
+        bucket = StationFootfall.objects.filter(station_id=station_id, hour=hour, direction=direction)
+        if bucket.update(count=F('count') + count):
+            continue
+        try:
+            with transaction.atomic():
+                StationFootfall.objects.create(station_id=station_id, hour=hour, direction=direction, count=count)
+        except IntegrityError:
+            # Another transaction created the bucket first.
+            bucket.update(count=F('count') + count)
+
+
+def rebuild_footfall(start=None, end=None, batch_size=1000):
+    """
+    Recompute the rollup for scans in [start, end) (either bound optional)
+    from TicketScan. Bounds should fall on the hour. start is moved up to
+    archive.archived_until(): archived scans are gone from TicketScan, and
+    the rollup is all that is left of them. Returns the number of buckets
+    written.
+    """
+    floor = archived_until()
+    if floor and (start is None or start < floor):
+        start = floor
+    if start and end and end <= start:
+        return 0
+
+    scans = TicketScan.objects.all()
+    buckets = StationFootfall.objects.all()
+    if start:
+        scans = scans.filter(scanned_at__gte=start)
+        buckets = buckets.filter(hour__gte=start)
+    if end:
+        scans = scans.filter(scanned_at__lt=end)
+        buckets = buckets.filter(hour__lt=end)
+
+    rows = (scans
+            .annotate(bucket=TruncHour('scanned_at', tzinfo=timezone.get_current_timezone()))
+            .values_list('station_id', 'bucket', 'direction')
+            .annotate(count=Count('id'))
+            .order_by())
+    with transaction.atomic():
+        buckets.delete()
+        created = StationFootfall.objects.bulk_create(
+            (StationFootfall(station_id=station_id, hour=hour, direction=direction, count=count)
+             for station_id, hour, direction, count in rows.iterator()),
+            batch_size=batch_size,
+        )
+    return len(created)
+
+
+def footfall_rows(start, end, granularity='day'):
+    """
+    Entries, exits and total scans per station for each day (or hour) in
+    [start, end), newest first.
+    """
+    bucket = TruncDate('hour') if granularity == 'day' else F('hour')
+    return (StationFootfall.objects
+            .filter(hour__gte=start, hour__lt=end)
+            .values(bucket=bucket, station_name=F('station__name'))
+            .annotate(
+                entries=Sum('count', filter=Q(direction='ENTRY'), default=0),
+                exits=Sum('count', filter=Q(direction='EXIT'), default=0),
+                count=Sum('count'),
+            )
+            .order_by('-bucket', 'station_name'))
+
+
+def day_range(first_day, last_day):
+    """
+    Aware [start, end) covering the local dates first_day..last_day.
+    """
+    return (
+        timezone.make_aware(datetime.combine(first_day, time.min)),
+        timezone.make_aware(datetime.combine(last_day + timedelta(days=1), time.min)),
+    )
@@ -1,5 +1,30 @@
+from datetime import timedelta
+
 from django import forms
-from .models import Station, MetroLine
+from django.utils import timezone
+from .models import TicketScan
+from .registry import get_registry
+
+
+class StationChoiceField(forms.ChoiceField):
+    """
+    Station dropdown served from the in-memory registry, so rendering and
+    validating it costs no queries. Cleans to a Station instance.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(choices=self.station_choices, **kwargs)
+
+    @staticmethod
+    def station_choices():
+        return [('', '---------')] + get_registry().station_choices()
+
+    def valid_value(self, value):
+        return get_registry().station(value) is not None
+
+    def clean(self, value):
+        value = super().clean(value)
+        return get_registry().station(value) if value else None
 
 
 class WalletTopupForm(forms.Form):
@@ -7,8 +32,8 @@ class WalletTopupForm(forms.Form):
 
 
 class TicketPurchaseForm(forms.Form):
-    source = forms.ModelChoiceField(queryset=Station.objects.all())
-    destination = forms.ModelChoiceField(queryset=Station.objects.all())
+    source = StationChoiceField()
+    destination = StationChoiceField()
 
     def clean(self):
         cleaned_data = super().clean()
@@ -21,8 +46,8 @@ class TicketPurchaseForm(forms.Form):
         return cleaned_data
 
 class OfflineTicketForm(forms.Form):
-    source = forms.ModelChoiceField(queryset=Station.objects.all())
-    destination = forms.ModelChoiceField(queryset=Station.objects.all())
+    source = StationChoiceField()
+    destination = StationChoiceField()
 
     def clean(self):
         cleaned_data = super().clean()
@@ -35,3 +60,53 @@ class OfflineTicketForm(forms.Form):
 
 class OTPVerifyForm(forms.Form):
     code = forms.CharField(max_length=6, label="Enter OTP")
+
+
+class TicketScanForm(forms.Form):
+    ticket_id = forms.CharField(label="Ticket ID")
+    station = StationChoiceField()
+    direction = forms.ChoiceField(choices=TicketScan.DIRECTION_CHOICES)
+
+
+class FootfallFilterForm(forms.Form):
+    GRANULARITIES = (('day', 'Daily'), ('hour', 'Hourly'))
+    # Longest range per granularity, in days, to keep the report bounded.
+    MAX_DAYS = {'day': 366, 'hour': 31}
+    DEFAULT_DAYS = 7
+
+    start = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    end = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    granularity = forms.ChoiceField(choices=GRANULARITIES, required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        end = cleaned_data.get('end') or timezone.localdate()
+        start = cleaned_data.get('start') or end - timedelta(days=self.DEFAULT_DAYS - 1)
+        granularity = cleaned_data.get('granularity') or 'day'
+
+        if start > end:
+            raise forms.ValidationError("Start date must not be after end date.")
+        if (end - start).days + 1 > self.MAX_DAYS[granularity]:
+            raise forms.ValidationError(
+                f"{dict(self.GRANULARITIES)[granularity]} reports cover at most {self.MAX_DAYS[granularity]} days."
+            )
+
+        cleaned_data.update(start=start, end=end, granularity=granularity)
+        return cleaned_data
+
+
+class ExportFilterForm(forms.Form):
+    FORMATS = (('csv', 'CSV'), ('ndjson', 'NDJSON'))
+
+    start = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    end = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    station = StationChoiceField(required=False)
+    format = forms.ChoiceField(choices=FORMATS, required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start, end = cleaned_data.get('start'), cleaned_data.get('end')
+        if start and end and start > end:
+            raise forms.ValidationError("Start date must not be after end date.")
+        cleaned_data['format'] = cleaned_data.get('format') or 'csv'
+        return cleaned_data
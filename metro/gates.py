@@ -0,0 +1,305 @@
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .footfall import record_scans
+from .models import GateScanSeq, Station, Ticket, TicketScan
+from .services import get_routing_engine
+from .tickets import LIVE_STATUSES, decode_cursor, encode_cursor
+
+
+# Rows per IN (...) lookup and per bulk INSERT/UPDATE statement.
+BATCH_SIZE = 1000
+
+# direction -> (status required, status after scan, ticket field the station must match)
+TRANSITIONS = {
+    'ENTRY': ('ACTIVE', 'IN_USE', 'source_id'),
+    'EXIT': ('IN_USE', 'USED', 'destination_id'),
+}
+
+
+def apply_scan(ticket_id, station_id, direction, user=None):
+    """
+    Validate a gate tap and apply its status transition.
+
+    The transition is a single UPDATE filtered on the expected status, the
+    expected station and expiry, so two gates racing on one ticket cannot
+    both succeed. The TicketScan row and its footfall count are written in
+    the same transaction.
+    Returns a dict with ok, verdict and status; rejected scans also carry
+    the ticket (or None) so callers can explain the verdict.
+    """
+    expected, new_status, station_field = TRANSITIONS[direction]
+    now = timezone.now()
+
+    try:
+        with transaction.atomic():
+            updated = (Ticket.objects
+                       .filter(id=ticket_id, status=expected, **{station_field: station_id})
+                       .filter(Q(expires_at__isnull=True) | Q(expires_at__gt=now))
+                       .update(status=new_status, updated_at=now))
+            if updated:
+                scan = TicketScan.objects.create(
+                    ticket_id=ticket_id,
+                    station_id=station_id,
+                    direction=direction,
+                    scanned_by=user,
+                    scanned_at=now,
+                )
+                record_scans([(station_id, scan.scanned_at, direction)])
+                return {'ok': True, 'verdict': 'OK', 'status': new_status}
+    except ValidationError:
+        return {'ok': False, 'verdict': 'NOT_FOUND', 'status': None, 'ticket': None}
+
+    ticket = Ticket.objects.select_related('source', 'destination').filter(id=ticket_id).first()
+    if ticket is None:
+        verdict, status = 'NOT_FOUND', None
+    elif ticket.status in ('USED', 'EXPIRED'):
+        verdict, status = ticket.status, ticket.status
+    elif ticket.is_expired():
+        verdict, status = 'EXPIRED', 'EXPIRED'
+    elif ticket.status != expected:
+        verdict, status = 'WRONG_STATUS', ticket.status
+    else:
+        verdict, status = 'WRONG_STATION', ticket.status
+    return {'ok': False, 'verdict': verdict, 'status': status, 'ticket': ticket}
+
+
+def _chunks(values, size=BATCH_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def check_gate_id(gate_id):
+    """
+    Return gate_id if it is a non-empty string that fits TicketScan.gate_id,
+    else raise ValueError.
+    """
+    max_length = TicketScan._meta.get_field('gate_id').max_length
+    if not isinstance(gate_id, str) or not 0 < len(gate_id) <= max_length:
+        raise ValueError(f"A gate id must be a string of 1 to {max_length} characters.")
+    return gate_id
+
+
+def _parse_offline_scan(record, engine):
+    """
+    Normalise one uploaded record to (seq, ticket_id, station_id, direction,
+    scanned_at), raising ValueError if any field is missing or invalid.
+    """
+    try:
+        seq = int(record['seq'])
+        ticket_id = Ticket._meta.pk.to_python(str(record['ticket_id']))
+        direction = record['direction']
+        scanned_at = parse_datetime(str(record['scanned_at']))
+        station_id = engine.id_for_code(str(record['station']))
+        # gate_seq is a signed 64-bit column.
+        if not (0 <= seq < 2 ** 63 and isinstance(direction, str) and direction in TRANSITIONS):
+            raise ValueError(record)
+    except (KeyError, TypeError, OverflowError, ValidationError) as exc:
+        raise ValueError(str(exc))
+    if scanned_at is None or station_id is None:
+        raise ValueError(record)
+    if timezone.is_naive(scanned_at):
+        scanned_at = timezone.make_aware(scanned_at)
+    return seq, ticket_id, station_id, direction, scanned_at
+
+
+def apply_offline_scans(gate_id, records, user=None):
+    """
+    Reconcile scans a gate buffered while offline. Each record is a dict with
+    seq, ticket_id, station (code), direction and scanned_at (ISO 8601).
+
+    Records are applied in seq order with the same rules as apply_scan(),
+    expiry being judged at the time of the tap. Tickets are locked and read
+    in chunks, transitions are worked out in memory, then statuses are
+    written with bulk_update and scans with bulk_create, so the number of
+    queries grows with the batch size / BATCH_SIZE, not with the batch size.
+    Seqs already recorded for this gate in GateScanSeq are skipped, which
+    makes a replayed upload a no-op; uploads from one gate take turns.
+
+    Returns {'applied': n, 'duplicates': n, 'rejected': [{'seq', 'verdict'}, ...]}.
+    """
+    engine = get_routing_engine()
+    now = timezone.now()
+    rejected = []
+    parsed = {}
+    for record in records:
+        try:
+            scan = _parse_offline_scan(record, engine)
+        except ValueError:
+            seq = record.get('seq') if isinstance(record, dict) else None
+            rejected.append({'seq': seq, 'verdict': 'BAD_RECORD'})
+            continue
+        parsed.setdefault(scan[0], scan)
+    duplicates = len(records) - len(rejected) - len(parsed)
+
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            # One upload per gate at a time, taken before any ticket lock: two
+            # uploads of the same seqs for different tickets would otherwise
+            # both pass the check below.
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [gate_id])
+
+        ticket_ids = {scan[1] for scan in parsed.values()}
+        tickets = {}
+        for chunk in _chunks(ticket_ids):
+            for ticket in (Ticket.objects.select_for_update()
+                           .filter(id__in=chunk)
+                           .only('id', 'status', 'source_id', 'destination_id', 'expires_at')):
+                tickets[ticket.id] = ticket
+
+        # Checked after taking the locks, so a concurrent replay of the same
+        # upload sees the seqs this one committed.
+        seen = set()
+        for chunk in _chunks(parsed):
+            seen.update(GateScanSeq.objects
+                        .filter(gate_id=gate_id, gate_seq__in=chunk)
+                        .values_list('gate_seq', flat=True))
+        duplicates += len(seen)
+
+        scans = []
+        changed = {}
+        for seq in sorted(parsed):
+            if seq in seen:
+                continue
+            _, ticket_id, station_id, direction, scanned_at = parsed[seq]
+            expected, new_status, station_field = TRANSITIONS[direction]
+            ticket = tickets.get(ticket_id)
+
+            if ticket is None:
+                verdict = 'NOT_FOUND'
+            elif ticket.status in ('USED', 'EXPIRED'):
+                verdict = ticket.status
+            elif ticket.expires_at and scanned_at >= ticket.expires_at:
+                verdict = 'EXPIRED'
+            elif ticket.status != expected:
+                verdict = 'WRONG_STATUS'
+            elif getattr(ticket, station_field) != station_id:
+                verdict = 'WRONG_STATION'
+            else:
+                verdict = 'OK'
+
+            if verdict != 'OK':
+                rejected.append({'seq': seq, 'verdict': verdict})
+                continue
+
+            ticket.status = new_status
+            ticket.updated_at = now
+            changed[ticket.id] = ticket
+            scans.append(TicketScan(
+                ticket_id=ticket_id,
+                station_id=station_id,
+                direction=direction,
+                scanned_by=user,
+                scanned_at=scanned_at,
+                gate_id=gate_id,
+                gate_seq=seq,
+            ))
+
+        Ticket.objects.bulk_update(changed.values(), ['status', 'updated_at'], batch_size=BATCH_SIZE)
+        # Unique on (gate_id, gate_seq): the database refuses a seq twice
+        # even where the lock above is not available.
+        GateScanSeq.objects.bulk_create(
+            (GateScanSeq(gate_id=gate_id, gate_seq=scan.gate_seq) for scan in scans), batch_size=BATCH_SIZE)
+        TicketScan.objects.bulk_create(scans, batch_size=BATCH_SIZE)
+        record_scans((scan.station_id, scan.scanned_at, scan.direction) for scan in scans)
+
+    return {'applied': len(scans), 'duplicates': duplicates, 'rejected': rejected}
+
+
+FEED_FIELDS = ('id', 'status', 'source', 'destination', 'expires_at')
+_LAST_UUID = uuid.UUID(int=(1 << 128) - 1)
+_SNAPSHOT_PREFIX = 'snapshot:'
+
+
+def station_ticket_feed(station_id, cursor=None, limit=None):
+    """
+    Tickets a gate at station_id may be shown: live tickets starting or
+    ending there, keyed by (updated_at, id).
+
+    Without a cursor this starts a snapshot of every live ticket; with one
+    it is the tickets changed since, with tickets that were used or expired
+    listed under 'revoked'. Both come in (updated_at, id) order, at most
+    limit per call, and the returned cursor resumes the feed. Snapshot
+    pages all read up to the first page's cutoff; the last one hands over
+    a cursor for changes made after it. Gates should also drop tickets
+    once their expires_at passes, as that changes no row.
+
+    Rows updated in the last METRO_GATE_FEED_LAG_SECONDS are held back so a
+    transaction that commits after a later one cannot slip behind a cursor.
+    """
+    engine = get_routing_engine()
+    now = timezone.now()
+    limit = limit or settings.METRO_GATE_FEED_PAGE_SIZE
+
+    snapshot = cursor is None or str(cursor).startswith(_SNAPSHOT_PREFIX)
+    if cursor is None:
+        cutoff = now - timedelta(seconds=settings.METRO_GATE_FEED_LAG_SECONDS)
+        after_at = after_id = None
+    elif snapshot:
+        cutoff_cursor, _, after = str(cursor)[len(_SNAPSHOT_PREFIX):].partition(':')
+        cutoff = decode_cursor(cutoff_cursor)[0]
+        after_at, after_id = decode_cursor(after)
+    else:
+        cutoff = now - timedelta(seconds=settings.METRO_GATE_FEED_LAG_SECONDS)
+        after_at, after_id = decode_cursor(cursor)
+
+    rows = Ticket.objects.filter(
+        Q(source_id=station_id) | Q(destination_id=station_id),
+        updated_at__lte=cutoff,
+    )
+    if snapshot:
+        rows = (rows.filter(status__in=LIVE_STATUSES)
+                .filter(Q(expires_at__isnull=True) | Q(expires_at__gt=now)))
+    if after_at is not None:
+        rows = rows.filter(Q(updated_at__gt=after_at) | Q(updated_at=after_at, id__gt=after_id))
+    rows = list(rows.order_by('updated_at', 'id')[:limit + 1]
+                .values_list('id', 'status', 'source_id', 'destination_id', 'expires_at', 'updated_at'))
+
+    more = len(rows) > limit
+    if more:
+        rows = rows[:limit]
+    if snapshot and more:
+        next_cursor = (f"{_SNAPSHOT_PREFIX}{encode_cursor(cutoff, _LAST_UUID)}:"
+                       f"{encode_cursor(rows[-1][5], rows[-1][0])}")
+    elif snapshot:
+        next_cursor = encode_cursor(cutoff, _LAST_UUID)
+    elif rows:
+        next_cursor = encode_cursor(rows[-1][5], rows[-1][0])
+    else:
+        next_cursor = cursor
+
+    # Stations added since this worker's engine was built are looked up in
+    # one query rather than failing the page.
+    unknown = {sid for row in rows for sid in row[2:4] if engine.index_of(sid) is None}
+    extra_codes = dict(Station.objects.filter(id__in=unknown).values_list('id', 'code')) if unknown else {}
+
+    def code(sid):
+        i = engine.index_of(sid)
+        return engine.station_codes[i] if i is not None else extra_codes.get(sid)
+
+    tickets, revoked = [], []
+    for ticket_id, status, source_id, destination_id, expires_at, _updated_at in rows:
+        if status in LIVE_STATUSES and (expires_at is None or expires_at > now):
+            tickets.append([
+                str(ticket_id), status, code(source_id), code(destination_id),
+                int(expires_at.timestamp()) if expires_at else None,
+            ])
+        else:
+            revoked.append(str(ticket_id))
+
+    return {
+        'fields': FEED_FIELDS,
+        'tickets': tickets,
+        'revoked': revoked,
+        'cursor': next_cursor,
+        'more': more,
+    }
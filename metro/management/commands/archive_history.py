@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from metro.archive import (
+    DATASETS, ArchiveError, archive_month, month_label, months_to_archive,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Move scans older than METRO_RETENTION_MONTHS, and tickets a month older, out of "
+        "the database into read-only gzipped NDJSON files in METRO_ARCHIVE_DIR. "
+        "Run it from cron; read archived months back with read_archive."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-months', type=int, help="Override METRO_RETENTION_MONTHS.")
+        parser.add_argument('--dry-run', action='store_true', help="List the months without archiving.")
+
+    def handle(self, *args, **options):
+        keep = options['keep_months']
+        if keep is not None and keep < 1:
+            raise CommandError("--keep-months must be at least 1.")
+
+        total = 0
+        try:
+            # Scans first: tickets with scans still in the database are kept.
+            for dataset in DATASETS:
+                for month in months_to_archive(dataset, keep_months=keep):
+                    if options['dry_run']:
+                        self.stdout.write(f"Would archive {dataset} {month_label(month)}")
+                        continue
+                    count = archive_month(dataset, month)
+                    total += count
+                    self.stdout.write(f"Archived {count} {dataset} from {month_label(month)}")
+        except ArchiveError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS(f"Archived {total} rows."))
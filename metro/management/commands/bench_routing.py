@@ -0,0 +1,104 @@
+import random
+import time
+import tracemalloc
+
+import networkx as nx
+from django.core.management.base import BaseCommand, CommandError
+
+from metro.services import RoutingEngine
+
+
+def synthetic_network(stations, lines, interchanges, seed):
+    """
+    Split shuffled stations into `lines` chains and join random pairs of
+    stations on different chains. Returns (station_ids, edges).
+    """
+    rng = random.Random(seed)
+    ids = list(range(1, stations + 1))
+    rng.shuffle(ids)
+    chunk = max(2, stations // lines)
+    chains = [ids[i:i + chunk] for i in range(0, stations, chunk)]
+
+    edges = []
+    for line, chain in enumerate(chains):
+        edges.extend((a, b, line) for a, b in zip(chain, chain[1:]))
+    for i in range(1, len(chains)):
+        edges.append((rng.choice(chains[i - 1]), rng.choice(chains[i]), i))
+    for _ in range(interchanges):
+        a, b = rng.sample(chains, 2)
+        edges.append((rng.choice(a), rng.choice(b), rng.randrange(len(chains))))
+    return sorted(ids), edges
+
+
+def measure(build, repeat=3):
+    """
+    (network, best build time, bytes held by the network). Timed runs and
+    the traced run are separate, as tracemalloc slows allocation down.
+    """
+    elapsed = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        build()
+        elapsed.append(time.perf_counter() - started)
+    tracemalloc.start()
+    network = build()
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return network, min(elapsed), size
+
+
+class Command(BaseCommand):
+    help = "Compare RoutingEngine with networkx on synthetic networks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stations', type=int, nargs='+', default=[1000, 10000, 50000])
+        parser.add_argument('--lines', type=int, default=40)
+        parser.add_argument('--interchanges', type=int, default=200)
+        parser.add_argument('--queries', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        RoutingEngine.from_edges([1, 2], [(1, 2, 0)])  # import numpy before timing
+        for stations in options['stations']:
+            station_ids, edges = synthetic_network(
+                stations, options['lines'], options['interchanges'], options['seed']
+            )
+
+            def build_nx():
+                G = nx.Graph()
+                G.add_nodes_from(station_ids)
+                for a, b, line in edges:
+                    G.add_edge(a, b, line=line)
+                return G
+
+            G, nx_build, nx_bytes = measure(build_nx)
+            engine, engine_build, engine_bytes = measure(
+                lambda: RoutingEngine.from_edges(station_ids, edges, range(options['lines']))
+            )
+
+            rng = random.Random(options['seed'])
+            pairs = [tuple(rng.sample(station_ids, 2)) for _ in range(options['queries'])]
+
+            started = time.perf_counter()
+            expected = []
+            for a, b in pairs:
+                try:
+                    expected.append(nx.shortest_path(G, a, b))
+                except nx.NetworkXNoPath:
+                    expected.append(None)
+            nx_query = (time.perf_counter() - started) / len(pairs)
+
+            started = time.perf_counter()
+            got = [engine.shortest_path(a, b) for a, b in pairs]
+            engine_query = (time.perf_counter() - started) / len(pairs)
+
+            if got != expected:
+                raise CommandError(f"RoutingEngine paths differ from networkx at {stations} stations.")
+
+            self.stdout.write(
+                f"{stations} stations, {len(edges)} edges\n"
+                f"  networkx: build {nx_build * 1000:.1f} ms, {nx_bytes / 1024:.0f} KiB, "
+                f"query {nx_query * 1e6:.0f} us\n"
+                f"  engine:   build {engine_build * 1000:.1f} ms, {engine_bytes / 1024:.0f} KiB, "
+                f"query {engine_query * 1e6:.0f} us"
+            )
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from metro.services import rebuild_route_table
+
+
+class Command(BaseCommand):
+    help = "Precompute routes and fares for every station pair on the enabled network."
+
+    def handle(self, *args, **options):
+        count = rebuild_route_table()
+        self.stdout.write(self.style.SUCCESS(f"Stored {count} routes."))
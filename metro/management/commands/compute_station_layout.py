@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from metro.maps import store_station_layout
+
+
+class Command(BaseCommand):
+    help = "Store map coordinates for stations. Only unplaced stations move unless --reset is given."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="Recompute every station's position.")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        count = store_station_layout(reset=options['reset'], seed=options['seed'])
+        if not count:
+            self.stdout.write("Every station already has a position.")
+            return
+        self.stdout.write(self.style.SUCCESS(f"Placed {count} stations."))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from metro.archive import ensure_scan_partitions, is_partitioned
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the monthly TicketScan partitions for this month and the next few. "
+        "run_maintenance does this on every pass and the web entrypoint on start; "
+        "scans for a month without a partition land in the default partition until "
+        "it is created, and are moved over then."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=2)
+
+    def handle(self, *args, **options):
+        if not is_partitioned():
+            self.stdout.write("TicketScan is not partitioned on this database; nothing to do.")
+            return
+        created = ensure_scan_partitions(months_ahead=options['months_ahead'])
+        for name in created:
+            self.stdout.write(f"Created {name}")
+        self.stdout.write(self.style.SUCCESS(f"Created {len(created)} partitions."))
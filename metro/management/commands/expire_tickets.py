@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from metro.tickets import expire_overdue_tickets
+
+
+class Command(BaseCommand):
+    help = "Mark ACTIVE and IN_USE tickets past their expiry as EXPIRED. Run it from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = expire_overdue_tickets(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Expired {count} tickets."))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from metro import snapshot
+from metro.services import RoutingEngine, current_topology_version
+
+
+class Command(BaseCommand):
+    help = "Write mmappable routing snapshots for the current topology version."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help="Output directory, defaults to METRO_SNAPSHOT_DIR.")
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or snapshot.snapshot_dir()
+        if not directory:
+            raise CommandError("Set METRO_SNAPSHOT_DIR or pass --dir.")
+
+        version = current_topology_version(force=True)
+        for only_enabled in (True, False):
+            engine = RoutingEngine.from_db(only_enabled=only_enabled)
+            path = snapshot.write_snapshot(
+                engine, snapshot.snapshot_path(version, only_enabled, directory), version
+            )
+            self.stdout.write(f"Wrote {path}")
+        snapshot.prune_snapshots(keep_version=version, directory=directory)
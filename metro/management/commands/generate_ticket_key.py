@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from metro.tokens import active_kid, generate_key, key_dir, retire_key
+
+
+class Command(BaseCommand):
+    help = (
+        "Create a new ticket signing key in METRO_TICKET_KEY_DIR. New tickets are signed with "
+        "it unless METRO_TICKET_SIGNING_KID pins another; older keys keep verifying."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kid', help="Key id, by default a UTC timestamp so newer keys sort last.")
+        parser.add_argument('--retire', metavar='KID', help="Keep only the public half of KID instead.")
+
+    def handle(self, *args, **options):
+        directory = key_dir()
+        if directory is None:
+            raise CommandError("Set METRO_TICKET_KEY_DIR first.")
+
+        if options['retire']:
+            kid = options['retire']
+            if kid == active_kid():
+                raise CommandError(f"{kid} is still the active signing key; generate a new one first.")
+            try:
+                retire_key(directory, kid)
+            except FileNotFoundError:
+                raise CommandError(f"No signing key {kid} in {directory}.")
+            self.stdout.write(self.style.SUCCESS(f"Retired {kid}; it still verifies tickets it signed."))
+            return
+
+        kid = options['kid'] or timezone.now().strftime('k%Y%m%d%H%M%S')
+        try:
+            path = generate_key(directory, kid)
+        except FileExistsError:
+            raise CommandError(f"Key {kid} already exists.")
+        self.stdout.write(self.style.SUCCESS(f"Wrote {path}. Active signing key: {active_kid()}"))
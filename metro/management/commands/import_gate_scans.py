@@ -0,0 +1,54 @@
+import json
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from metro.gates import apply_offline_scans, check_gate_id
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply scans a gate buffered while offline. The file holds the same JSON as the "
+        "upload API ({\"gate_id\": ..., \"scans\": [...]}); use - to read stdin."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--gate', help="Gate id, overriding the one in the file.")
+        parser.add_argument('--scanned-by', help="Username recorded as scanned_by.")
+
+    def handle(self, *args, **options):
+        try:
+            if options['path'] == '-':
+                body = json.load(sys.stdin)
+            else:
+                with open(options['path']) as fh:
+                    body = json.load(fh)
+        except (OSError, ValueError) as exc:
+            raise CommandError(f"Could not read scans: {exc}")
+        if not isinstance(body, dict) or not isinstance(body.get('scans', []), list):
+            raise CommandError("Expected {\"gate_id\": ..., \"scans\": [...]}.")
+
+        gate_id = options['gate'] or body.get('gate_id')
+        if not gate_id:
+            raise CommandError("No gate id in the file; pass --gate.")
+        try:
+            check_gate_id(gate_id)
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        user = None
+        if options['scanned_by']:
+            try:
+                user = get_user_model().objects.get(username=options['scanned_by'])
+            except get_user_model().DoesNotExist:
+                raise CommandError(f"No user named {options['scanned_by']}.")
+
+        result = apply_offline_scans(gate_id, body.get('scans', []), user=user)
+        for item in result['rejected']:
+            self.stdout.write(f"seq {item['seq']}: {item['verdict']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Applied {result['applied']} scans, skipped {result['duplicates']} duplicates, "
+            f"rejected {len(result['rejected'])}."
+        ))
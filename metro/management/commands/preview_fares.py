@@ -0,0 +1,45 @@
+import csv
+import json
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from metro.fares import Tariff, get_tariff, od_features, from_paise
+from metro.services import get_routing_engine
+
+
+class Command(BaseCommand):
+    help = "Re-price every station pair under a tariff file and compare with the current tariff."
+
+    def add_arguments(self, parser):
+        parser.add_argument('tariff', help="JSON file with a tariff definition (see metro.fares.Tariff).")
+        parser.add_argument('--csv', help="Write per-pair old and new fares to this file.")
+
+    def handle(self, *args, **options):
+        with open(options['tariff']) as fh:
+            proposed = Tariff(json.load(fh))
+
+        engine = get_routing_engine(only_enabled=True)
+        pairs, hops, line_counts, transfers = od_features(engine)
+        if not pairs:
+            self.stdout.write("No connected station pairs on the enabled network.")
+            return
+
+        current = get_tariff().price_many(hops, line_counts, transfers, engine.line_codes)
+        new = proposed.price_many(hops, line_counts, transfers, engine.line_codes)
+        delta = new - current
+
+        self.stdout.write(
+            f"{len(pairs)} pairs, {int(np.count_nonzero(delta))} change. "
+            f"Mean fare {from_paise(current.mean())} -> {from_paise(new.mean())}, "
+            f"largest rise {from_paise(delta.max())}, largest cut {from_paise(-delta.min())}."
+        )
+
+        if options['csv']:
+            codes = dict(zip(engine.station_ids, engine.station_codes))
+            with open(options['csv'], 'w', newline='') as fh:
+                writer = csv.writer(fh)
+                writer.writerow(['source', 'destination', 'hops', 'current', 'proposed'])
+                for (src, dest), h, old, fare in zip(pairs, hops, current, new):
+                    writer.writerow([codes[src], codes[dest], int(h), from_paise(old), from_paise(fare)])
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['csv']}."))
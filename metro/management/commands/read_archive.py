@@ -0,0 +1,49 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from metro.archive import DATASETS, ArchiveError, archive_files, archived_months, parse_month, read_archive
+
+# Fields matched by --station for each dataset.
+STATION_FIELDS = {
+    'scans': ('station',),
+    'tickets': ('source', 'destination'),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Print an archived month of scans or tickets as NDJSON, optionally only the rows "
+        "for one station or ticket. Without a month, list the archived months."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=DATASETS)
+        parser.add_argument('month', nargs='?', help="YYYY-MM")
+        parser.add_argument('--station', help="Station code.")
+        parser.add_argument('--ticket', help="Ticket id.")
+
+    def handle(self, *args, **options):
+        dataset = options['dataset']
+        try:
+            if not options['month']:
+                for label in archived_months(dataset):
+                    self.stdout.write(label)
+                return
+            try:
+                month = parse_month(options['month'])
+            except ValueError:
+                raise CommandError("month must be YYYY-MM.")
+            if not archive_files(dataset, month):
+                raise CommandError(f"No {dataset} archived for {options['month']}.")
+
+            station, ticket = options['station'], options['ticket']
+            ticket_field = 'ticket_id' if dataset == 'scans' else 'id'
+            for row in read_archive(dataset, month):
+                if station and station not in (row[field] for field in STATION_FIELDS[dataset]):
+                    continue
+                if ticket and row[ticket_field] != ticket:
+                    continue
+                self.stdout.write(json.dumps(row, ensure_ascii=False))
+        except ArchiveError as exc:
+            raise CommandError(str(exc))
@@ -0,0 +1,30 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from metro.archive import archived_until
+from metro.footfall import day_range, rebuild_footfall
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the hourly footfall rollup from TicketScan, for all scans or for the "
+        "local dates --start..--end. Use it to backfill after upgrading or to repair counts."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=date.fromisoformat, help="First local date, YYYY-MM-DD.")
+        parser.add_argument('--end', type=date.fromisoformat, help="Last local date, YYYY-MM-DD.")
+
+    def handle(self, *args, **options):
+        start_day, end_day = options['start'], options['end']
+        if start_day and end_day and start_day > end_day:
+            raise CommandError("--start must not be after --end.")
+
+        start = day_range(start_day, start_day)[0] if start_day else None
+        end = day_range(end_day, end_day)[1] if end_day else None
+        floor = archived_until()
+        if floor and (start is None or start < floor):
+            self.stdout.write(f"Scans before {floor:%Y-%m-%d} are archived; keeping their footfall as it is.")
+        count = rebuild_footfall(start, end)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} footfall buckets."))
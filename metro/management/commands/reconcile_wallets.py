@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from metro.wallet import mismatched_wallets, repair_wallets
+
+
+class Command(BaseCommand):
+    help = (
+        "Check every passenger's balance snapshot against the sum of their wallet "
+        "transactions. Exits with an error if any disagree, unless --fix resets them "
+        "to the ledger."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help="Reset mismatched balances to the ledger sum.")
+
+    def handle(self, *args, **options):
+        mismatched = list(mismatched_wallets())
+        for pk, balance, ledger in mismatched:
+            self.stdout.write(f"profile {pk}: balance {balance}, ledger {ledger}")
+
+        if not mismatched:
+            self.stdout.write(self.style.SUCCESS("All wallets match the ledger."))
+        elif options['fix']:
+            repaired = repair_wallets([pk for pk, _balance, _ledger in mismatched])
+            self.stdout.write(self.style.SUCCESS(f"Reset {repaired} balances to the ledger."))
+        else:
+            raise CommandError(f"{len(mismatched)} wallets disagree with the ledger.")
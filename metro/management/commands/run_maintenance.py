@@ -0,0 +1,47 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from metro.archive import ensure_scan_partitions
+from metro.maps import place_unplaced_stations
+from metro.services import rebuild_route_table_if_stale
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Background upkeep kept off the request path: rebuilds the route table after "
+        "topology changes, lays out new stations on the map and creates the coming "
+        "months' TicketScan partitions. Runs every --interval seconds until stopped, "
+        "or once with --once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=30.0, help="Seconds between runs.")
+        parser.add_argument('--once', action='store_true', help="Run each task once and exit.")
+
+    def tasks(self):
+        return [
+            ('route table', rebuild_route_table_if_stale, "Stored {} routes."),
+            ('station layout', place_unplaced_stations, "Placed {} stations on the map."),
+            ('scan partitions', lambda: len(ensure_scan_partitions()), "Created {} scan partitions."),
+        ]
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            for name, task, message in self.tasks():
+                try:
+                    result = task()
+                except Exception:
+                    # Keep going: the next run retries, e.g. once migrations are in.
+                    logger.exception("Maintenance task %r failed.", name)
+                    continue
+                if result:
+                    self.stdout.write(message.format(result))
+            if options['once']:
+                return
+            time.sleep(options['interval'])
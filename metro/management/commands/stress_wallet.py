@@ -0,0 +1,115 @@
+import random
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from accounts.models import PassengerProfile
+from metro.wallet import InsufficientBalance, credit, debit, ledger_balances
+
+
+def hammer(profile, threads, operations, action):
+    """
+    Run action(profile, rng) operations times on each of threads threads at
+    once. Returns (results, seconds).
+    """
+    results = []
+    lock = threading.Lock()
+    start = threading.Barrier(threads)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        done = []
+        try:
+            start.wait()
+            for _ in range(operations):
+                done.append(action(profile, rng))
+        finally:
+            connection.close()
+        with lock:
+            results.extend(done)
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = (
+        "Hammer one throwaway wallet with concurrent credits and debits, then check that "
+        "no update was lost, that it was never overdrawn, and report throughput. Runs "
+        "against the configured database; the wallet is deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--operations', type=int, default=250, help="Per thread.")
+        parser.add_argument('--amount', type=Decimal, default=Decimal('1.00'))
+
+    def handle(self, *args, **options):
+        threads, operations, amount = options['threads'], options['operations'], options['amount']
+        user = get_user_model().objects.create_user(f"wallet-stress-{uuid.uuid4().hex[:12]}")
+        profile = user.profile
+        try:
+            self.mixed(profile, threads, operations, amount)
+            self.drain(profile, threads, operations, amount)
+        finally:
+            user.delete()
+
+    def mixed(self, profile, threads, operations, amount):
+        opening = amount * threads * operations
+        credit(profile, opening, 'Stress opening balance')
+
+        def action(profile, rng):
+            if rng.random() < 0.5:
+                credit(profile, amount, 'Stress credit')
+                return amount
+            debit(profile, amount, 'Stress debit')
+            return -amount
+
+        results, seconds = hammer(profile, threads, operations, action)
+        self.check_wallet(profile, opening + sum(results))
+        self.stdout.write(
+            f"mixed: {len(results)} operations on {threads} threads in {seconds:.2f}s "
+            f"({len(results) / seconds:.0f}/s), no lost updates"
+        )
+
+    def drain(self, profile, threads, operations, amount):
+        # Twice as many debits as the balance covers: exactly half must succeed.
+        balance = PassengerProfile.objects.get(pk=profile.pk).balance
+        covered = threads * operations // 2
+        if balance < amount * covered:
+            credit(profile, amount * covered - balance, 'Stress top-up')
+        else:
+            debit(profile, balance - amount * covered, 'Stress reset')
+
+        def action(profile, rng):
+            try:
+                debit(profile, amount, 'Stress debit')
+                return True
+            except InsufficientBalance:
+                return False
+
+        results, seconds = hammer(profile, threads, operations, action)
+        if sum(results) != covered:
+            raise CommandError(f"drain: {sum(results)} debits succeeded, expected {covered}.")
+        self.check_wallet(profile, Decimal('0.00'))
+        self.stdout.write(
+            f"drain: {len(results)} debits on {threads} threads in {seconds:.2f}s "
+            f"({len(results) / seconds:.0f}/s), {covered} accepted, never overdrawn"
+        )
+
+    def check_wallet(self, profile, expected):
+        row = ledger_balances().get(pk=profile.pk)
+        if row.balance != expected or row.ledger != expected:
+            raise CommandError(
+                f"Lost updates: balance {row.balance}, ledger {row.ledger}, expected {expected}."
+            )
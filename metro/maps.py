@@ -0,0 +1,349 @@
+import hashlib
+import io
+import logging
+import math
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils.html import escape
+
+from .models import Station, Connection
+from .registry import get_registry
+from .services import bump_map_layout_version
+
+logger = logging.getLogger(__name__)
+
+# matplotlib, networkx and Pillow are imported inside the functions that draw
+# or lay out the map, so importing this module (and metro.views) stays cheap
+# for workers and management commands that never render a PNG.
+
+
+LINE_COLOR_MAP = {
+    'R': 'red',
+    'B': 'blue',
+    'O': 'orange',
+    'Y': 'gold',
+    'G': 'green'
+}
+
+FIGSIZE = (10, 8)
+DPI = 150
+# Base map and overlays share this axes box and the same limits, so an
+# overlay PNG lines up pixel for pixel with the base PNG.
+AXES_RECT = (0.02, 0.02, 0.96, 0.90)
+MAP_CACHE_SECONDS = 24 * 60 * 60
+
+
+def build_graph_from_db():
+    import networkx as nx
+
+    G = nx.Graph()
+
+    for code, name, x, y in Station.objects.values_list('code', 'name', 'map_x', 'map_y'):
+        if x is not None and y is not None:
+            G.add_node(code, label=name, pos=(x, y))
+        else:
+            G.add_node(code, label=name)
+
+    # Add edges with line id stored
+    for a, b, line_code in Connection.objects.values_list('from_station__code', 'to_station__code', 'line__code'):
+        G.add_edge(a, b, line=line_code)
+
+    return G
+
+
+def place_new_stations(G, pos):
+    """
+    Positions for stations missing from pos, leaving the others where they
+    are. A new station sits next to the centroid of its placed neighbours;
+    stations with none are spread around the edge of the existing map. With
+    nothing placed at all the stations go round a circle until
+    store_station_layout() has run: a force-directed layout is too slow to
+    compute while serving a request.
+    """
+    if not pos:
+        if not G:
+            return {}
+        logger.warning("No stored map positions; drawing stations on a circle until the layout is computed.")
+        count = len(G)
+        return {n: (math.cos(2 * math.pi * i / count), math.sin(2 * math.pi * i / count))
+                for i, n in enumerate(G)}
+
+    pos = dict(pos)
+    xs = [x for x, _ in pos.values()]
+    ys = [y for _, y in pos.values()]
+    span = max(max(xs) - min(xs), max(ys) - min(ys)) or 1.0
+    cx, cy = (max(xs) + min(xs)) / 2, (max(ys) + min(ys)) / 2
+    missing = [n for n in G if n not in pos]
+
+    progress = True
+    while missing and progress:
+        progress = False
+        for i, n in enumerate(list(missing)):
+            placed = [pos[m] for m in G[n] if m in pos]
+            if not placed:
+                continue
+            angle = 2.4 * (len(pos) + i)
+            x = sum(p[0] for p in placed) / len(placed) + 0.05 * span * math.cos(angle)
+            y = sum(p[1] for p in placed) / len(placed) + 0.05 * span * math.sin(angle)
+            pos[n] = (x, y)
+            missing.remove(n)
+            progress = True
+
+    for i, n in enumerate(missing):
+        angle = 2 * math.pi * i / len(missing)
+        pos[n] = (cx + 0.6 * span * math.cos(angle), cy + 0.6 * span * math.sin(angle))
+    return pos
+
+
+def station_positions(G):
+    """
+    Stored layout positions, with any unplaced stations filled in cheaply.
+    """
+    pos = {n: d['pos'] for n, d in G.nodes(data=True) if 'pos' in d}
+    if len(pos) < len(G):
+        pos = place_new_stations(G, pos)
+    return pos
+
+
+def store_station_layout(reset=False, seed=42):
+    """
+    Compute and store map coordinates for stations without them (all
+    stations with reset), keeping placed stations fixed. Returns the number
+    of stations placed. Run offline: by compute_station_layout and
+    run_maintenance, never from a view.
+    """
+    import networkx as nx
+
+    G = build_graph_from_db()
+    fixed = {} if reset else {n: d['pos'] for n, d in G.nodes(data=True) if 'pos' in d}
+    missing = [n for n in G if n not in fixed]
+    if not missing:
+        return 0
+
+    if fixed:
+        pos = nx.spring_layout(G, pos=fixed, fixed=list(fixed), seed=seed)
+    else:
+        pos = nx.spring_layout(G, seed=seed)
+
+    stations = list(Station.objects.filter(code__in=missing))
+    for station in stations:
+        station.map_x, station.map_y = (float(v) for v in pos[station.code])
+    Station.objects.bulk_update(stations, ['map_x', 'map_y'])
+    # bulk_update skips post_save, which is what we want: positions only
+    # matter to the map, so routes and the route table stay as they are.
+    bump_map_layout_version()
+    return len(stations)
+
+
+def place_unplaced_stations():
+    """
+    store_station_layout() if any station lacks coordinates, else 0.
+    """
+    if not Station.objects.filter(Q(map_x__isnull=True) | Q(map_y__isnull=True)).exists():
+        return 0
+    return store_station_layout()
+
+
+def path_digest(path_codes):
+    return hashlib.sha1("-".join(path_codes).encode()).hexdigest()[:16]
+
+
+def _new_axes():
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=FIGSIZE)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes(AXES_RECT)
+    ax.axis('off')
+    return fig, ax
+
+
+def _set_limits(ax, pos):
+    if not pos:
+        return
+    xs = [x for x, _ in pos.values()]
+    ys = [y for _, y in pos.values()]
+    pad_x = (max(xs) - min(xs)) * 0.08 or 0.1
+    pad_y = (max(ys) - min(ys)) * 0.08 or 0.1
+    ax.set_xlim(min(xs) - pad_x, max(xs) + pad_x)
+    ax.set_ylim(min(ys) - pad_y, max(ys) + pad_y)
+
+
+def _png(fig, transparent=False):
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=DPI, transparent=transparent)
+    return buf.getvalue()
+
+
+def map_layout(version):
+    """
+    Station positions and labels, edges as (from_code, to_code, line_code)
+    and legend line names for a map version (see
+    metro.services.current_map_version), cached like the maps.
+    """
+    key = f"metro-map:layout:v{version}"
+    cached = cache.get(key)
+    if cached:
+        return cached
+
+    G = build_graph_from_db()
+    layout = {
+        'pos': station_positions(G),
+        'labels': {n: d.get('label', n) for n, d in G.nodes(data=True)},
+        'edges': [(u, v, d.get('line')) for u, v, d in G.edges(data=True)],
+        'line_names': {code: name for code, name in get_registry().line_names.items() if code in LINE_COLOR_MAP},
+    }
+    cache.set(key, layout, MAP_CACHE_SECONDS)
+    return layout
+
+
+def base_map(version):
+    """
+    Return (png_bytes, positions, labels) for the whole network at a map
+    version. Rendered once per version and kept in the default cache.
+    """
+    key = f"metro-map:base:v{version}"
+    cached = cache.get(key)
+    if cached:
+        return cached
+
+    import matplotlib.lines as mlines
+    import networkx as nx
+
+    layout = map_layout(version)
+    pos, labels = layout['pos'], layout['labels']
+    G = nx.Graph()
+    G.add_nodes_from(pos)
+    G.add_edges_from((u, v) for u, v, _line in layout['edges'])
+
+    fig, ax = _new_axes()
+    fig.suptitle("Metro Map", fontsize=14, fontweight='bold')
+
+    edges_by_line = {}
+    for u, v, line_id in layout['edges']:
+        edges_by_line.setdefault(line_id or 'UNKNOWN', []).append((u, v))
+
+    for line_id, edges in edges_by_line.items():
+        color = LINE_COLOR_MAP.get(line_id, 'gray')
+        nx.draw_networkx_edges(G, pos, edgelist=edges, width=2.5, edge_color=color, alpha=0.9, ax=ax)
+
+    nx.draw_networkx_nodes(G, pos, node_size=400, node_color='lightgray', ax=ax)
+    nx.draw_networkx_labels(G, pos, labels=labels, font_size=8, ax=ax)
+
+    line_names = layout['line_names']
+    legend_handles = [
+        mlines.Line2D([], [], color=color, marker='_', markersize=15, label=line_names.get(line_id, line_id))
+        for line_id, color in LINE_COLOR_MAP.items()
+    ]
+    ax.legend(handles=legend_handles, title="Lines", loc='upper left')
+    _set_limits(ax, pos)
+
+    result = (_png(fig), pos, labels)
+    cache.set(key, result, MAP_CACHE_SECONDS)
+    return result
+
+
+def highlighted_map(version, path_codes):
+    """
+    Base map with a ticket path drawn over it. The overlay is rendered on a
+    transparent canvas and composited onto the cached base PNG; the result
+    is cached per path, so every ticket on the same route shares it.
+    """
+    key = f"metro-map:path:v{version}:{path_digest(path_codes)}"
+    cached = cache.get(key)
+    if cached:
+        return cached
+
+    import networkx as nx
+    from PIL import Image
+
+    base_png, pos, labels = base_map(version)
+    codes = [c for c in path_codes if c in pos]
+    path_edges = list(zip(codes, codes[1:]))
+    if not path_edges:
+        return base_png
+
+    G = nx.Graph(path_edges)
+    fig, ax = _new_axes()
+    nx.draw_networkx_edges(G, pos, edgelist=path_edges, width=4.0, edge_color='black', style='dashed', ax=ax)
+    nx.draw_networkx_nodes(G, pos, nodelist=codes, node_size=500, node_color='yellow', ax=ax)
+    nx.draw_networkx_labels(G, pos, labels={c: labels.get(c, c) for c in codes}, font_size=8, ax=ax)
+    _set_limits(ax, pos)
+
+    base = Image.open(io.BytesIO(base_png)).convert('RGBA')
+    overlay = Image.open(io.BytesIO(_png(fig, transparent=True))).convert('RGBA')
+    buf = io.BytesIO()
+    Image.alpha_composite(base, overlay).save(buf, format='PNG', optimize=True)
+
+    png = buf.getvalue()
+    cache.set(key, png, MAP_CACHE_SECONDS)
+    return png
+
+
+SVG_WIDTH, SVG_HEIGHT = 1000, 800
+
+
+def iter_svg(version, path_codes=()):
+    """
+    Yield the metro map as SVG text in chunks, with an optional highlighted
+    path. Uses the same cached layout as the PNG map; no matplotlib involved.
+    """
+    layout = map_layout(version)
+    pos, labels = layout['pos'], layout['labels']
+
+    if pos:
+        xs = [x for x, _ in pos.values()]
+        ys = [y for _, y in pos.values()]
+        min_x, max_x, min_y, max_y = min(xs), max(xs), min(ys), max(ys)
+    else:
+        min_x = max_x = min_y = max_y = 0.0
+    pad_x = (max_x - min_x) * 0.08 or 0.1
+    pad_y = (max_y - min_y) * 0.08 or 0.1
+    left, top = 0.02 * SVG_WIDTH, 0.08 * SVG_HEIGHT
+    width, height = 0.96 * SVG_WIDTH, 0.90 * SVG_HEIGHT
+    scale_x = width / (max_x - min_x + 2 * pad_x)
+    scale_y = height / (max_y - min_y + 2 * pad_y)
+
+    def point(code):
+        x, y = pos[code]
+        return (left + (x - min_x + pad_x) * scale_x,
+                top + (max_y + pad_y - y) * scale_y)
+
+    yield (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{SVG_WIDTH}" height="{SVG_HEIGHT}" '
+        f'viewBox="0 0 {SVG_WIDTH} {SVG_HEIGHT}" font-family="sans-serif">\n'
+        f'<rect width="100%" height="100%" fill="white"/>\n'
+        f'<text x="{SVG_WIDTH / 2}" y="32" text-anchor="middle" font-size="22" font-weight="bold">Metro Map</text>\n'
+    )
+
+    yield '<g stroke-width="3.5" stroke-opacity="0.9">\n'
+    for u, v, line_id in layout['edges']:
+        (x1, y1), (x2, y2) = point(u), point(v)
+        color = LINE_COLOR_MAP.get(line_id, 'gray')
+        yield f'<line x1="{x1:.1f}" y1="{y1:.1f}" x2="{x2:.1f}" y2="{y2:.1f}" stroke="{color}"/>\n'
+    yield '</g>\n'
+
+    codes = [c for c in path_codes if c in pos]
+    if len(codes) > 1:
+        points = " ".join(f"{x:.1f},{y:.1f}" for x, y in map(point, codes))
+        yield (f'<polyline points="{points}" fill="none" stroke="black" '
+               f'stroke-width="5" stroke-dasharray="12 8"/>\n')
+    highlighted = set(codes) if len(codes) > 1 else set()
+
+    yield '<g font-size="11" text-anchor="middle" dominant-baseline="central">\n'
+    for code in pos:
+        x, y = point(code)
+        fill, radius = ('yellow', 15) if code in highlighted else ('lightgray', 13)
+        yield (f'<circle cx="{x:.1f}" cy="{y:.1f}" r="{radius}" fill="{fill}"/>'
+               f'<text x="{x:.1f}" y="{y:.1f}">{escape(labels.get(code, code))}</text>\n')
+    yield '</g>\n'
+
+    line_names = layout['line_names']
+    yield '<g font-size="13">\n<text x="24" y="70" font-weight="bold">Lines</text>\n'
+    for i, (line_id, color) in enumerate(LINE_COLOR_MAP.items()):
+        y = 92 + i * 22
+        yield (f'<line x1="24" y1="{y}" x2="54" y2="{y}" stroke="{color}" stroke-width="3"/>'
+               f'<text x="62" y="{y + 4}">{escape(line_names.get(line_id, line_id))}</text>\n')
+    yield '</g>\n</svg>\n'
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-18 08:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('metro', '0003_rename_is_active_metroline_is_enabled_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TopologyVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='ticket',
+            name='passenger',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='tickets', to='accounts.passengerprofile'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-18 08:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metro', '0004_topologyversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteFare',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path_ids', models.JSONField()),
+                ('path_repr', models.TextField(blank=True)),
+                ('hops', models.PositiveIntegerField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('lines_used', models.CharField(blank=True, max_length=200)),
+                ('topology_version', models.PositiveBigIntegerField()),
+                ('destination', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='routes_to', to='metro.station')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='routes_from', to='metro.station')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('source', 'destination'), name='uniq_routefare_pair')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 08:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metro', '0005_routefare'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='station',
+            name='map_x',
+            field=models.FloatField(blank=True, help_text='Map layout position, set by compute_station_layout', null=True),
+        ),
+        migrations.AddField(
+            model_name='station',
+            name='map_y',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.8 on 2026-10-18 08:51
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metro', '0006_station_map_position'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticketscan',
+            name='gate_id',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='ticketscan',
+            name='gate_seq',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='ticketscan',
+            name='scanned_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddConstraint(
+            model_name='ticketscan',
+            constraint=models.UniqueConstraint(condition=models.Q(('gate_seq__isnull', False)), fields=('gate_id', 'gate_seq'), name='uniq_ticketscan_gate_seq'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 08:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metro', '0007_ticketscan_gate_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='token',
+            field=models.TextField(blank=True, help_text='Signed token gates can verify offline, see metro.tokens'),
+        ),
+    ]
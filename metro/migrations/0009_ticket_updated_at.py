@@ -0,0 +1,27 @@
+# Generated by Django 5.2.8 on 2026-10-18 08:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('metro', '0008_ticket_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(fields=['source', 'updated_at', 'id'], name='ticket_source_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(fields=['destination', 'updated_at', 'id'], name='ticket_dest_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 08:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('metro', '0009_ticket_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(fields=['passenger', 'created_at', 'id'], name='ticket_passenger_created_idx'),
+        ),
+    ]
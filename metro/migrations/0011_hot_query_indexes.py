@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:00
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('metro', '0010_ticket_passenger_created_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='purchaseotp',
+            index=models.Index(condition=models.Q(('is_used', False)), fields=['user', 'purpose', '-created_at'], name='otp_pending_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(condition=models.Q(('status', 'ACTIVE'), ('status', 'IN_USE'), _connector='OR'), fields=['expires_at'], name='ticket_live_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticketscan',
+            index=models.Index(fields=['scanned_at', 'station'], name='ticketscan_time_station_idx'),
+        ),
+    ]
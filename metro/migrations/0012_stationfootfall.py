@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metro', '0011_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StationFootfall',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField(help_text='Start of the local hour')),
+                ('direction', models.CharField(choices=[('ENTRY', 'Entry'), ('EXIT', 'Exit')], max_length=10)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('station', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='footfall', to='metro.station')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['hour', 'station'], name='footfall_hour_station_idx')],
+                'constraints': [models.UniqueConstraint(fields=('station', 'hour', 'direction'), name='uniq_footfall_bucket')],
+            },
+        ),
+    ]
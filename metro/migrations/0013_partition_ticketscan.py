@@ -0,0 +1,110 @@
+"""
+Range-partition metro_ticketscan on scanned_at, one partition per local
+month, so old months can be archived by dropping a partition (see
+metro.archive). PostgreSQL only; other databases keep the plain table.
+
+A partitioned table's primary key and unique indexes must include the
+partition key, so the primary key becomes (id, scanned_at) and the gate
+seq index (gate_id, gate_seq, scanned_at). ids still come from a sequence
+and stay unique, but the widened seq index no longer enforces one scan
+per gate seq: the same seq with a different scanned_at is accepted.
+Migration 0017 moves that guarantee to the unpartitioned GateScanSeq
+table and drops the index. Django's model state is unchanged.
+"""
+import re
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.db import migrations
+
+TABLE = 'metro_ticketscan'
+LEGACY = 'metro_ticketscan_unpartitioned'
+SEQUENCE = 'metro_ticketscan_part_id_seq'
+
+
+def _months(first, last):
+    """Local month starts from the month of first through the month of last."""
+    zone = ZoneInfo(settings.TIME_ZONE)
+    first, last = first.astimezone(zone), last.astimezone(zone)
+    year, month = first.year, first.month
+    while (year, month) <= (last.year, last.month):
+        yield datetime(year, month, 1, tzinfo=zone)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def _next_month(start):
+    year, month = (start.year + 1, 1) if start.month == 12 else (start.year, start.month + 1)
+    return start.replace(year=year, month=month)
+
+
+def partition_ticketscan(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [TABLE])
+        if cursor.fetchone():
+            return
+
+        cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {LEGACY}")
+        cursor.execute(f"ALTER TABLE {LEGACY} RENAME CONSTRAINT {TABLE}_pkey TO {LEGACY}_pkey")
+        cursor.execute(
+            f"CREATE TABLE {TABLE} (LIKE {LEGACY} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            f"PARTITION BY RANGE (scanned_at)"
+        )
+        cursor.execute(f"CREATE SEQUENCE {SEQUENCE} OWNED BY {TABLE}.id")
+        cursor.execute(f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT nextval('{SEQUENCE}')")
+        cursor.execute(f"ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (id, scanned_at)")
+        cursor.execute(f"CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT")
+
+        # A partition for every month with scans, and for this month and the
+        # next two, before the rows are copied in.
+        cursor.execute(f"SELECT min(scanned_at), max(scanned_at) FROM {LEGACY}")
+        oldest, newest = cursor.fetchone()
+        now = datetime.now(ZoneInfo(settings.TIME_ZONE))
+        horizon = _next_month(_next_month(now))
+        for start in _months(min(oldest or now, now), max(newest or horizon, horizon)):
+            cursor.execute(
+                f"CREATE TABLE {TABLE}_p{start:%Y%m} PARTITION OF {TABLE} "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{_next_month(start).isoformat()}')"
+            )
+
+        cursor.execute(f"INSERT INTO {TABLE} SELECT * FROM {LEGACY}")
+        cursor.execute(f"SELECT setval('{SEQUENCE}', coalesce(max(id), 0) + 1, false) FROM {TABLE}")
+
+        # Move foreign keys and indexes across under their existing names,
+        # so later migrations can still find them.
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = to_regclass(%s) AND contype = 'f'", [LEGACY])
+        for name, definition in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE {LEGACY} DROP CONSTRAINT {name}")
+            cursor.execute(f"ALTER TABLE {TABLE} ADD CONSTRAINT {name} {definition}")
+
+        cursor.execute(
+            "SELECT c.relname, pg_get_indexdef(i.indexrelid), i.indisunique FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE i.indrelid = to_regclass(%s) "
+            "AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = i.indexrelid)", [LEGACY])
+        for name, definition, unique in cursor.fetchall():
+            definition = re.sub(rf' ON (\S+\.)?{LEGACY} ', f' ON {TABLE} ', definition)
+            if unique:
+                definition = re.sub(r'USING (\w+) \((.*?)\)', r'USING \1 (\2, scanned_at)', definition, count=1)
+            cursor.execute(f"DROP INDEX {name}")
+            cursor.execute(definition)
+
+        cursor.execute(f"DROP TABLE {LEGACY}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metro', '0012_stationfootfall'),
+    ]
+
+    operations = [
+        # Not reversed: the partitioned table works with the models as-is.
+        migrations.RunPython(partition_ticketscan, migrations.RunPython.noop),
+    ]
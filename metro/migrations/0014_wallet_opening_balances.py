@@ -0,0 +1,35 @@
+from decimal import Decimal
+
+from django.db import migrations
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def record_opening_balances(apps, schema_editor):
+    """
+    Balances changed before the ledger became the source of truth may not
+    match it; book the difference so reconcile_wallets starts clean.
+    """
+    PassengerProfile = apps.get_model('accounts', 'PassengerProfile')
+    WalletTransaction = apps.get_model('metro', 'WalletTransaction')
+    mismatched = (PassengerProfile.objects
+                  .annotate(ledger=Coalesce(Sum('transactions__amount'), Value(Decimal('0.00'))))
+                  .exclude(balance=F('ledger'))
+                  .values_list('pk', 'balance', 'ledger'))
+    WalletTransaction.objects.bulk_create(
+        (WalletTransaction(passenger_id=pk, amount=balance - ledger, description='Opening balance')
+         for pk, balance, ledger in mismatched.iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('metro', '0013_partition_ticketscan'),
+    ]
+
+    operations = [
+        migrations.RunPython(record_opening_balances, migrations.RunPython.noop),
+    ]
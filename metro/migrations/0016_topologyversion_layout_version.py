@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metro', '0015_wallet_passenger_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topologyversion',
+            name='layout_version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:51
+
+from django.db import migrations, models
+
+
+def copy_gate_seqs(apps, schema_editor):
+    TicketScan = apps.get_model('metro', 'TicketScan')
+    GateScanSeq = apps.get_model('metro', 'GateScanSeq')
+    seqs = (TicketScan.objects.using(schema_editor.connection.alias)
+            .filter(gate_seq__isnull=False)
+            .values_list('gate_id', 'gate_seq')
+            .iterator(chunk_size=5000))
+    batch = []
+    for gate_id, gate_seq in seqs:
+        batch.append(GateScanSeq(gate_id=gate_id, gate_seq=gate_seq))
+        if len(batch) == 5000:
+            GateScanSeq.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    GateScanSeq.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metro', '0016_topologyversion_layout_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GateScanSeq',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gate_id', models.CharField(max_length=64)),
+                ('gate_seq', models.PositiveBigIntegerField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='gatescanseq',
+            constraint=models.UniqueConstraint(fields=('gate_id', 'gate_seq'), name='uniq_gatescanseq'),
+        ),
+        migrations.RunPython(copy_gate_seqs, migrations.RunPython.noop),
+        # On PostgreSQL migration 0013 had widened this to include scanned_at,
+        # so it no longer enforced anything; GateScanSeq does.
+        migrations.RemoveConstraint(
+            model_name='ticketscan',
+            name='uniq_ticketscan_gate_seq',
+        ),
+    ]
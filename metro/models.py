@@ -19,6 +19,8 @@ class MetroLine(models.Model):
 class Station(models.Model):
     code = models.CharField(max_length=10, unique=True)  
     name = models.CharField(max_length=100)
+    map_x = models.FloatField(null=True, blank=True, help_text="Map layout position, set by compute_station_layout")
+    map_y = models.FloatField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.code} - {self.name}"
@@ -38,18 +40,32 @@ class Connection(models.Model):
 
 class WalletTransaction(models.Model):
     """
-    Tracks money added or deducted from a passenger's balance.
+    Tracks money added or deducted from a passenger's balance. Append-only:
+    the ledger is the source of truth and PassengerProfile.balance a
+    snapshot of its sum (see metro.wallet).
     """
     passenger = models.ForeignKey(PassengerProfile, on_delete=models.CASCADE, related_name='transactions')
     amount = models.DecimalField(max_digits=8, decimal_places=2)
     description = models.CharField(max_length=255, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Wallet statement: keyset pages and monthly totals per passenger.
+            models.Index(fields=['passenger', 'created_at', 'id'], name='wallet_passenger_created_idx'),
+        ]
+
     def __str__(self):
         sign = '+' if self.amount >= 0 else ''
         return f"{self.passenger.user.username} {sign}{self.amount} at {self.created_at}"
 
 
+# Tickets that can still be scanned. Written as ORed equalities rather than
+# status__in so SQLite, like PostgreSQL, matches it against the partial
+# index below when the values arrive as bound parameters.
+LIVE_TICKET = models.Q(status='ACTIVE') | models.Q(status='IN_USE')
+
+
 class Ticket(models.Model):
     STATUS_CHOICES = [
         ('ACTIVE', 'Active'),
@@ -67,8 +83,25 @@ class Ticket(models.Model):
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='ACTIVE')
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField(null=True, blank=True)
+    # Cursor for the gate ticket feed. auto_now only covers save(); queryset
+    # .update() and bulk_update() callers must set it themselves.
+    updated_at = models.DateTimeField(auto_now=True)
 
     path_repr = models.TextField(blank=True, help_text="Stations path as codes, e.g. S1-S2-S3")
+    token = models.TextField(blank=True, help_text="Signed token gates can verify offline, see metro.tokens")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['source', 'updated_at', 'id'], name='ticket_source_updated_idx'),
+            models.Index(fields=['destination', 'updated_at', 'id'], name='ticket_dest_updated_idx'),
+            models.Index(fields=['passenger', 'created_at', 'id'], name='ticket_passenger_created_idx'),
+            # Expiry sweep: only live tickets are ever looked up by expires_at.
+            models.Index(
+                fields=['expires_at'],
+                condition=LIVE_TICKET,
+                name='ticket_live_expiry_idx',
+            ),
+        ]
     
     def __str__(self):
         return f"Ticket[{self.id}] {self.source.code} -> {self.destination.code} ({self.status})"
@@ -87,12 +120,65 @@ class TicketScan(models.Model):
     station = models.ForeignKey(Station, on_delete=models.SET_NULL, null=True, blank=True)
     direction = models.CharField(max_length=10, choices=DIRECTION_CHOICES)
     scanned_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
-    scanned_at = models.DateTimeField(auto_now_add=True)
+    scanned_at = models.DateTimeField(default=timezone.now)
+    # Set for scans uploaded by a gate after working offline; gate_seq is the
+    # gate's own counter. GateScanSeq keeps replays from recording them twice.
+    gate_id = models.CharField(max_length=64, blank=True, default='')
+    gate_seq = models.PositiveBigIntegerField(null=True, blank=True)
+
+    # On PostgreSQL the table is partitioned by month of scanned_at
+    # (migration 0013), which requires scanned_at in every unique index the
+    # database enforces; see metro.archive.
+    class Meta:
+        indexes = [
+            # Footfall report: date range, grouped by station.
+            models.Index(fields=['scanned_at', 'station'], name='ticketscan_time_station_idx'),
+        ]
 
     def __str__(self):
         return f"{self.ticket.id} {self.direction} at {self.station} on {self.scanned_at}"
     
 
+class GateScanSeq(models.Model):
+    """
+    Every seq a gate has uploaded a scan under. Kept apart from the
+    partitioned TicketScan table so the database can still enforce one
+    scan per gate seq, and outlives the scans when they are archived.
+    """
+    gate_id = models.CharField(max_length=64)
+    gate_seq = models.PositiveBigIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['gate_id', 'gate_seq'], name='uniq_gatescanseq'),
+        ]
+
+    def __str__(self):
+        return f"{self.gate_id} #{self.gate_seq}"
+
+
+class StationFootfall(models.Model):
+    """
+    Scan counts per station, local-time hour and direction, kept up to date
+    as scans are written (metro.footfall) so reports never scan TicketScan.
+    """
+    station = models.ForeignKey(Station, on_delete=models.SET_NULL, null=True, blank=True, related_name='footfall')
+    hour = models.DateTimeField(help_text="Start of the local hour")
+    direction = models.CharField(max_length=10, choices=TicketScan.DIRECTION_CHOICES)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['station', 'hour', 'direction'], name='uniq_footfall_bucket'),
+        ]
+        indexes = [
+            models.Index(fields=['hour', 'station'], name='footfall_hour_station_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.station} {self.direction} {self.hour}: {self.count}"
+
+
 class PurchaseOTP(models.Model):
     PURPOSES = (('TICKET_PURCHASE', 'Ticket Purchase'),)
 
@@ -104,9 +190,57 @@ class PurchaseOTP(models.Model):
     expires_at = models.DateTimeField()
     is_used = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # Latest pending OTP for a user; used rows are never looked up again.
+            models.Index(
+                fields=['user', 'purpose', '-created_at'],
+                condition=models.Q(is_used=False),
+                name='otp_pending_user_idx',
+            ),
+        ]
+
     def is_valid(self):
         return (not self.is_used) and timezone.now() < self.expires_at
 
     def __str__(self):
         return f"OTP {self.purpose} for {self.user} @ {self.created_at}"
 
+
+
+class TopologyVersion(models.Model):
+    """
+    Single-row counter bumped whenever stations, lines or connections change.
+    Workers compare it against the version of their cached network graph.
+    layout_version counts map layout changes, which need new map images but
+    leave routes alone.
+    """
+    version = models.PositiveBigIntegerField(default=0)
+    layout_version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Topology v{self.version} @ {self.updated_at}"
+
+
+class RouteFare(models.Model):
+    """
+    Precomputed route and fare between two stations over the enabled network.
+    Rows are only trusted when topology_version matches the current version.
+    """
+    source = models.ForeignKey(Station, on_delete=models.CASCADE, related_name='routes_from')
+    destination = models.ForeignKey(Station, on_delete=models.CASCADE, related_name='routes_to')
+    path_ids = models.JSONField()
+    path_repr = models.TextField(blank=True)
+    hops = models.PositiveIntegerField()
+    price = models.DecimalField(max_digits=8, decimal_places=2)
+    lines_used = models.CharField(max_length=200, blank=True)
+    topology_version = models.PositiveBigIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source', 'destination'], name='uniq_routefare_pair'),
+        ]
+
+    def __str__(self):
+        return f"{self.path_repr} ({self.price})"
@@ -0,0 +1,50 @@
+"""
+Stations and lines held in memory per worker for forms and views, rebuilt
+when the topology version moves on (see metro.signals).
+"""
+import copy
+
+from .models import MetroLine, Station
+from .services import _cached_network
+
+
+class Registry:
+    def __init__(self, stations, lines):
+        self.stations = stations
+        self.lines = lines
+        self._by_id = {station.id: station for station in stations}
+        self._by_code = {station.code: station for station in stations}
+        self.line_names = {line.code: line.name for line in lines}
+        self.has_enabled_line = any(line.is_enabled for line in lines)
+
+    @classmethod
+    def from_db(cls):
+        return cls(
+            list(Station.objects.order_by('id').only('id', 'code', 'name')),
+            list(MetroLine.objects.order_by('id')),
+        )
+
+    def station(self, pk):
+        """
+        A private copy of the station with this id, or None. Copies keep
+        callers from touching the instances other requests share.
+        """
+        try:
+            station = self._by_id.get(int(pk))
+        except (TypeError, ValueError):
+            return None
+        return copy.copy(station) if station is not None else None
+
+    def station_by_code(self, code):
+        station = self._by_code.get(code)
+        return copy.copy(station) if station is not None else None
+
+    def station_choices(self):
+        return [(station.id, str(station)) for station in self.stations]
+
+
+def get_registry():
+    """
+    The worker's registry for the current topology version.
+    """
+    return _cached_network(('registry',), lambda version: Registry.from_db())
@@ -1,40 +1,439 @@
-import networkx as nx
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
 from decimal import Decimal
-from .models import Station, Connection, MetroLine
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 
+from . import snapshot
+from .fares import get_tariff, path_line_codes
+from .models import Station, Connection, TopologyVersion, RouteFare
 
-import networkx as nx
-from decimal import Decimal
-from .models import Station, Connection, MetroLine
-
-def build_graph(only_enabled: bool = False):
-    G = nx.Graph()
-    
-    for station in Station.objects.all():
-        G.add_node(station.id)
-
-    qs = Connection.objects.select_related('line', 'from_station', 'to_station')
-    if only_enabled:
-        qs = qs.filter(line__is_enabled=True)
-
-    for edge in qs:
-        G.add_edge(
-            edge.from_station.id,
-            edge.to_station.id,
-            line=edge.line.code
+
+class RoutingEngine:
+    """
+    Undirected station network stored as CSR integer arrays.
+
+    Node i is the station with the i-th smallest id. Its neighbours are
+    neighbours[offsets[i]:offsets[i + 1]], listed in the order the edges were
+    first added, and edge_lines holds the index into line_codes/line_names
+    for each of those slots. Keeping the networkx adjacency order means
+    shortest_path() returns exactly the path nx.shortest_path() would.
+    """
+
+    def __init__(self, station_ids, offsets, neighbours, edge_lines,
+                 line_codes, line_names=None, station_codes=None):
+        self.station_ids = station_ids
+        self.offsets = offsets
+        self.neighbours = neighbours
+        self.edge_lines = edge_lines
+        self.line_codes = line_codes
+        self.line_names = line_names or list(line_codes)
+        self.station_codes = station_codes or [str(sid) for sid in station_ids]
+
+    @classmethod
+    def from_edges(cls, station_ids, edges, line_codes=(), line_names=None, station_codes=None):
+        """
+        Build from station ids and (from_id, to_id, line_index) tuples. A
+        repeated station pair keeps its first position and its last line,
+        as networkx.Graph.add_edge does. station_codes maps id to code.
+
+        The arrays are sorted into place with numpy rather than grown node
+        by node: each node's neighbours are its edges ordered by where the
+        station pair first appears in edges.
+        """
+        import numpy as np
+
+        ids = np.unique(np.fromiter(station_ids, dtype=np.int64))
+        n = len(ids)
+        rows = np.array(edges, dtype=np.int64).reshape(-1, 3)
+        u = np.searchsorted(ids, rows[:, 0])
+        v = np.searchsorted(ids, rows[:, 1])
+        known = (u < n) & (v < n)
+        if not (known.all() and (ids[u] == rows[:, 0]).all() and (ids[v] == rows[:, 1]).all()):
+            raise KeyError("Edge between unknown stations.")
+
+        pair = np.minimum(u, v) * n + np.maximum(u, v)
+        _keys, first = np.unique(pair, return_index=True)
+        _keys, last_from_end = np.unique(pair[::-1], return_index=True)
+        lines = rows[len(pair) - 1 - last_from_end, 2]
+        u, v = u[first], v[first]
+
+        # Both directions of every pair, a self-loop only once.
+        other = u != v
+        source = np.concatenate((u, v[other]))
+        slots = np.lexsort((np.concatenate((first, first[other])), source))
+        neighbours = np.concatenate((v, u[other]))[slots]
+        edge_lines = np.concatenate((lines, lines[other]))[slots]
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(source, minlength=n), out=offsets[1:])
+
+        codes = [station_codes[sid] for sid in ids.tolist()] if station_codes else None
+        return cls(
+            array('q', ids.tobytes()), array('q', offsets.tobytes()),
+            array('i', neighbours.astype(np.int32).tobytes()), array('i', edge_lines.astype(np.int32).tobytes()),
+            list(line_codes), list(line_names) if line_names else None, codes,
         )
 
-    return G
+    @classmethod
+    def from_db(cls, only_enabled=False):
+        line_codes = []
+        line_names = []
+        line_index = {}
+        qs = (Connection.objects.order_by('pk')
+              .values_list('from_station_id', 'to_station_id', 'line__code', 'line__name'))
+        if only_enabled:
+            qs = qs.filter(line__is_enabled=True)
 
+        edges = []
+        for a, b, code, name in qs:
+            if code not in line_index:
+                line_index[code] = len(line_codes)
+                line_codes.append(code)
+                line_names.append(name)
+            edges.append((a, b, line_index[code]))
 
-def shortest_path_between_stations(source_station, dest_station, only_enabled=False):
-    G = build_graph(only_enabled=only_enabled)
-    try:
-        path_ids = nx.shortest_path(G, source_station.id, dest_station.id)
-        return path_ids
-    except nx.NetworkXNoPath:
+        station_codes = dict(Station.objects.values_list('id', 'code'))
+        return cls.from_edges(station_codes, edges, line_codes, line_names, station_codes)
+
+    def id_for_code(self, code):
+        """
+        Station id for a station code, or None. Snapshot string tables are
+        searched in place; otherwise a lookup table is built on first use.
+        """
+        find = getattr(self.station_codes, 'find', None)
+        if find is not None:
+            i = find(code)
+            return None if i is None else self.station_ids[i]
+        if getattr(self, '_code_index', None) is None:
+            self._code_index = dict(zip(self.station_codes, self.station_ids))
+        return self._code_index.get(code)
+
+    def index_of(self, station_id):
+        i = bisect_left(self.station_ids, station_id)
+        if i == len(self.station_ids) or self.station_ids[i] != station_id:
+            return None
+        return i
+
+    def shortest_path(self, source_id, target_id):
+        """
+        Unweighted shortest path between two station ids as a list of ids,
+        or None. Mirrors networkx's bidirectional BFS step for step.
+        """
+        s, t = self.index_of(source_id), self.index_of(target_id)
+        if s is None or t is None:
+            return None
+        if s == t:
+            return [source_id]
+
+        offsets, neighbours = self.offsets, self.neighbours
+        pred = {s: None}
+        succ = {t: None}
+        forward_fringe = [s]
+        reverse_fringe = [t]
+        meet = None
+
+        while forward_fringe and reverse_fringe and meet is None:
+            if len(forward_fringe) <= len(reverse_fringe):
+                this_level, forward_fringe = forward_fringe, []
+                seen, other, fringe = pred, succ, forward_fringe
+            else:
+                this_level, reverse_fringe = reverse_fringe, []
+                seen, other, fringe = succ, pred, reverse_fringe
+            for v in this_level:
+                for w in neighbours[offsets[v]:offsets[v + 1]]:
+                    if w not in seen:
+                        fringe.append(w)
+                        seen[w] = v
+                    if w in other:
+                        meet = w
+                        break
+                if meet is not None:
+                    break
+
+        if meet is None:
+            return None
+
+        path = []
+        w = meet
+        while w is not None:
+            path.append(w)
+            w = pred[w]
+        path.reverse()
+        w = succ[path[-1]]
+        while w is not None:
+            path.append(w)
+            w = succ[w]
+        ids = self.station_ids
+        return [ids[i] for i in path]
+
+    def edge_line(self, u, v):
+        """
+        Line index of the edge between node indices u and v, or None.
+        """
+        if u is None or v is None:
+            return None
+        for slot in range(self.offsets[u], self.offsets[u + 1]):
+            if self.neighbours[slot] == v:
+                return self.edge_lines[slot]
         return None
 
+    def annotate_path(self, path_ids):
+        """
+        Describe a path of station ids using only the engine's own arrays:
+        station codes plus the line code and name of every edge.
+        """
+        nodes = [self.index_of(sid) for sid in path_ids]
+        codes = [self.station_codes[i] if i is not None else str(sid) for i, sid in zip(nodes, path_ids)]
+        edges = []
+        lines_in_order = []
+        for (u, v), (a, b) in zip(zip(nodes, nodes[1:]), zip(codes, codes[1:])):
+            line = self.edge_line(u, v)
+            line_code = self.line_codes[line] if line is not None else None
+            line_name = self.line_names[line] if line is not None else None
+            edges.append({'from': a, 'to': b, 'line_code': line_code, 'line_name': line_name})
+            if line_name and line_name not in lines_in_order:
+                lines_in_order.append(line_name)
+        return {
+            'path_ids': list(path_ids),
+            'station_codes': codes,
+            'path_repr': "-".join(codes),
+            'edges': edges,
+            'lines': lines_in_order,
+            'lines_used': ", ".join(lines_in_order),
+        }
+
+    def distances_from(self, source_id):
+        """
+        Hop counts from one station to every reachable station, keyed by id.
+        """
+        s = self.index_of(source_id)
+        if s is None:
+            return {}
+        offsets, neighbours = self.offsets, self.neighbours
+        dist = {s: 0}
+        fringe = [s]
+        depth = 0
+        while fringe:
+            depth += 1
+            next_fringe = []
+            for v in fringe:
+                for w in neighbours[offsets[v]:offsets[v + 1]]:
+                    if w not in dist:
+                        dist[w] = depth
+                        next_fringe.append(w)
+            fringe = next_fringe
+        ids = self.station_ids
+        return {ids[i]: d for i, d in dist.items()}
+
+    def dijkstra_path(self, source_id, target_id, weights):
+        """
+        Cheapest path by per-slot edge weights, a sequence aligned with
+        neighbours (so it can weigh by line, e.g. from edge_lines). Returns
+        (cost, path_ids) or None when unreachable.
+        """
+        s, t = self.index_of(source_id), self.index_of(target_id)
+        if s is None or t is None:
+            return None
+        offsets, neighbours = self.offsets, self.neighbours
+        best = {s: 0}
+        prev = {s: None}
+        heap = [(0, s)]
+        while heap:
+            cost, v = heapq.heappop(heap)
+            if v == t:
+                break
+            if cost > best[v]:
+                continue
+            for slot in range(offsets[v], offsets[v + 1]):
+                w = neighbours[slot]
+                new_cost = cost + weights[slot]
+                if w not in best or new_cost < best[w]:
+                    best[w] = new_cost
+                    prev[w] = v
+                    heapq.heappush(heap, (new_cost, w))
+        if t not in best:
+            return None
+        path = []
+        v = t
+        while v is not None:
+            path.append(self.station_ids[v])
+            v = prev[v]
+        path.reverse()
+        return best[t], path
+
+
+# Per-worker cache of built networks (routing engines, the registry), keyed by
+# kind and scope. Each entry remembers the topology version it was built from
+# so other workers' changes are noticed.
+_graph_cache = {}
+_graph_lock = threading.Lock()
+_version_seen = {'version': None, 'layout_version': 0, 'updated_at': None, 'checked_at': 0.0}
+
+
+def _refresh_topology_version(force):
+    interval = getattr(settings, 'METRO_TOPOLOGY_CHECK_SECONDS', 2.0)
+    now = time.monotonic()
+    if force or _version_seen['version'] is None or now - _version_seen['checked_at'] >= interval:
+        row = (TopologyVersion.objects
+               .filter(pk=1)
+               .values_list('version', 'layout_version', 'updated_at')
+               .first())
+        _version_seen['version'], _version_seen['layout_version'], _version_seen['updated_at'] = row or (0, 0, None)
+        _version_seen['checked_at'] = now
+
+
+def current_topology_version(force=False):
+    """
+    Return the shared topology version. The database is consulted at most once
+    every METRO_TOPOLOGY_CHECK_SECONDS per worker unless force is set.
+    """
+    _refresh_topology_version(force)
+    return _version_seen['version']
+
+
+def current_map_version(force=False):
+    """
+    Version of the drawn map, "<topology version>.<layout version>". It
+    moves with the topology and also when stations are repositioned, which
+    current_topology_version() ignores.
+    """
+    _refresh_topology_version(force)
+    return f"{_version_seen['version']}.{_version_seen['layout_version']}"
+
+
+def topology_updated_at():
+    """
+    When the topology or map layout last changed, or None if neither has.
+    Cached like current_topology_version().
+    """
+    _refresh_topology_version(False)
+    return _version_seen['updated_at']
+
+
+def bump_topology_version():
+    """
+    Increment the shared topology version and drop this worker's cached graphs.
+    """
+    updated = TopologyVersion.objects.filter(pk=1).update(
+        version=F('version') + 1, updated_at=timezone.now()
+    )
+    if not updated:
+        TopologyVersion.objects.get_or_create(pk=1, defaults={'version': 1})
+    invalidate_graph_cache()
+
+
+def bump_map_layout_version():
+    """
+    Increment the shared map layout version after station positions change.
+    Cached routing engines and the route table stay valid.
+    """
+    updated = TopologyVersion.objects.filter(pk=1).update(
+        layout_version=F('layout_version') + 1, updated_at=timezone.now()
+    )
+    if not updated:
+        TopologyVersion.objects.get_or_create(pk=1, defaults={'layout_version': 1})
+    with _graph_lock:
+        _version_seen['version'] = None
+
+
+def invalidate_graph_cache():
+    with _graph_lock:
+        _graph_cache.clear()
+        _version_seen['version'] = None
+
+
+def _cached_entry(key, builder):
+    version = current_topology_version()
+    cached = _graph_cache.get(key)
+    if cached and cached[0] == version:
+        return cached
+
+    with _graph_lock:
+        cached = _graph_cache.get(key)
+        if cached and cached[0] == version:
+            return cached
+        cached = _graph_cache[key] = (version, builder(version))
+        return cached
+
+
+def _cached_network(key, builder):
+    return _cached_entry(key, builder)[1]
+
+
+def versioned_routing_engine(only_enabled: bool = False):
+    """
+    (topology version, RoutingEngine) from one cache lookup, for callers
+    that key other caches by version and must read them with the engine
+    built at that version.
+    """
+    def build(version):
+        if not snapshot.snapshot_dir():
+            return RoutingEngine.from_db(only_enabled=only_enabled)
+        return snapshot.load_engine(
+            version, only_enabled, lambda: RoutingEngine.from_db(only_enabled=only_enabled)
+        )
+
+    return _cached_entry(('engine', only_enabled), build)
+
+
+def get_routing_engine(only_enabled: bool = False):
+    """
+    Return the cached RoutingEngine for this worker, rebuilt only when the
+    topology version has moved on. Callers must not mutate the result.
+    With METRO_SNAPSHOT_DIR set the engine is mmapped from a shared snapshot
+    file, exported by whichever worker first sees a new topology version.
+    """
+    return versioned_routing_engine(only_enabled)[1]
+
+
+_route_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def route_cache_stats():
+    """
+    Hit/miss counters of the route cache for this worker.
+    """
+    return dict(_route_cache_stats)
+
+
+def _route_cache():
+    alias = getattr(settings, 'METRO_ROUTE_CACHE_ALIAS', '')
+    return caches[alias] if alias else None
+
+
+def shortest_path_between_stations(source_station, dest_station, only_enabled=False):
+    """
+    Shortest path as a list of station ids, or None. Results are cached under
+    a key that includes the topology version, so a topology change makes old
+    entries unreachable and they age out through the backend's own eviction.
+    """
+    version, engine = versioned_routing_engine(only_enabled)
+    return _cached_path(version, engine, source_station.id, dest_station.id, only_enabled)
+
+
+def _cached_path(version, engine, source_id, dest_id, only_enabled):
+    cache = _route_cache()
+    if cache is None:
+        return engine.shortest_path(source_id, dest_id)
+
+    key = f"route:v{version}:{source_id}:{dest_id}:{int(only_enabled)}"
+    path_ids = cache.get(key)
+    if path_ids is not None:
+        _route_cache_stats['hits'] += 1
+        return path_ids or None
+
+    _route_cache_stats['misses'] += 1
+    path_ids = engine.shortest_path(source_id, dest_id)
+    # An empty list records "no path" so unreachable pairs are cached too.
+    cache.set(key, path_ids or [])
+    return path_ids
 
 
 def calculate_price_from_path(path_ids, rate_per_edge=Decimal('5.00')):
@@ -42,3 +441,122 @@ def calculate_price_from_path(path_ids, rate_per_edge=Decimal('5.00')):
         return Decimal('0.00')
     num_edges = len(path_ids) - 1
     return rate_per_edge * num_edges
+
+
+def fare_for_path(engine, path_ids):
+    """
+    Price of a path under the configured tariff. With no METRO_TARIFF this is
+    exactly calculate_price_from_path().
+    """
+    return get_tariff().price(path_line_codes(engine, path_ids))
+
+
+def find_route(source_station, dest_station, only_enabled=True):
+    """
+    Shortest route between two stations, fully annotated from the cached
+    routing engine: path ids, station codes, per-edge line code and name,
+    lines used in order and price. Returns None when there is no path.
+    """
+    version, engine = versioned_routing_engine(only_enabled)
+    path_ids = _cached_path(version, engine, source_station.id, dest_station.id, only_enabled)
+    if not path_ids:
+        return None
+    route = engine.annotate_path(path_ids)
+    route['price'] = fare_for_path(engine, path_ids)
+    return route
+
+
+def rebuild_route_table(only_if_stale=False):
+    """
+    Recompute the route/fare row for every reachable station pair on the
+    enabled network. Returns the number of rows written.
+
+    Rows are computed outside any transaction, then written under a lock on
+    the TopologyVersion row, so overlapping rebuilds take turns instead of
+    colliding on uniq_routefare_pair. The write is skipped if the topology
+    moved on while computing (the next run_maintenance pass picks up the
+    new version) or, with only_if_stale, if another rebuild already stored
+    this version.
+    """
+    version = current_topology_version(force=True)
+    if only_if_stale and RouteFare.objects.filter(topology_version=version).exists():
+        return 0
+    engine = get_routing_engine(only_enabled=True)
+
+    rows = []
+    for source_id in engine.station_ids:
+        for dest_id in engine.distances_from(source_id):
+            if dest_id == source_id:
+                continue
+            path_ids = engine.shortest_path(source_id, dest_id)
+            route = engine.annotate_path(path_ids)
+            rows.append(RouteFare(
+                source_id=source_id,
+                destination_id=dest_id,
+                path_ids=path_ids,
+                path_repr=route['path_repr'],
+                hops=len(path_ids) - 1,
+                price=fare_for_path(engine, path_ids),
+                lines_used=route['lines_used'],
+                topology_version=version,
+            ))
+
+    with transaction.atomic():
+        locked = TopologyVersion.objects.select_for_update().filter(pk=1).values_list('version', flat=True).first()
+        if (locked or 0) != version:
+            return 0
+        if only_if_stale and RouteFare.objects.filter(topology_version=version).exists():
+            return 0
+        RouteFare.objects.all().delete()
+        RouteFare.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def rebuild_route_table_if_stale():
+    return rebuild_route_table(only_if_stale=True)
+
+
+def get_route_quote(source_station, dest_station):
+    """
+    Return the route and fare between two stations on the enabled network as
+    a dict with path_ids, path_repr, price and lines_used, or None when the
+    stations are not connected. Served from RouteFare when it is current.
+    """
+    row = (RouteFare.objects
+           .filter(source=source_station, destination=dest_station,
+                   topology_version=current_topology_version())
+           .values('path_ids', 'path_repr', 'price', 'lines_used')
+           .first())
+    if row:
+        return row
+
+    return find_route(source_station, dest_station, only_enabled=True)
+
+
+def quote_pairs(pairs):
+    """
+    Quote many (source_code, destination_code) pairs against one snapshot of
+    the enabled network. Each result carries either path, price and lines or
+    an error message, in the order the pairs were given.
+    """
+    engine = get_routing_engine(only_enabled=True)
+    quotes = []
+    for source_code, dest_code in pairs:
+        quote = {'source': source_code, 'destination': dest_code}
+        source_id = engine.id_for_code(source_code)
+        dest_id = engine.id_for_code(dest_code)
+        if source_id is None or dest_id is None:
+            quote['error'] = "Unknown station code."
+        elif source_id == dest_id:
+            quote['error'] = "Source and destination cannot be the same."
+        else:
+            path_ids = engine.shortest_path(source_id, dest_id)
+            if not path_ids:
+                quote['error'] = "No path found between selected stations."
+            else:
+                route = engine.annotate_path(path_ids)
+                quote['path'] = route['station_codes']
+                quote['price'] = fare_for_path(engine, path_ids)
+                quote['lines'] = route['lines']
+        quotes.append(quote)
+    return quotes
@@ -0,0 +1,17 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Station, Connection, MetroLine
+from .services import bump_topology_version
+
+
+@receiver(post_save, sender=Station)
+@receiver(post_delete, sender=Station)
+@receiver(post_save, sender=Connection)
+@receiver(post_delete, sender=Connection)
+@receiver(post_save, sender=MetroLine)
+@receiver(post_delete, sender=MetroLine)
+def topology_changed(sender, instance, **kwargs):
+    # The bump marks the route table stale; quotes fall back to live routing
+    # until run_maintenance rebuilds it.
+    bump_topology_version()
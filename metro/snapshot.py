@@ -0,0 +1,187 @@
+"""
+Versioned binary snapshots of the routing network that workers mmap, so all
+of them share one copy of the arrays through the page cache. Station codes
+and line names are string tables in the same mapping, decoded on access,
+so a worker's own memory does not grow with the network either.
+"""
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+
+from django.conf import settings
+
+MAGIC = b'MTRONET3'
+# magic, topology version, stations, adjacency slots, lines
+HEADER = struct.Struct('<8sQQQQ')
+
+
+class StringTable:
+    """
+    Read-only sequence of strings over a mapped section: offsets (n + 1
+    int64), the indices sorted by string (n int32) and the UTF-8 text.
+    """
+
+    def __init__(self, offsets, order, text):
+        self.offsets = offsets
+        self.order = order
+        self.text = text
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return bytes(self.text[self.offsets[i]:self.offsets[i + 1]]).decode()
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def find(self, value):
+        """
+        Index of value, or None; a binary search over the sorted order.
+        """
+        position = bisect_left(self.order, value, key=self.__getitem__)
+        if position < len(self.order) and self[self.order[position]] == value:
+            return self.order[position]
+        return None
+
+
+def _write_strings(fh, values):
+    encoded = [value.encode() for value in values]
+    offsets = array('q', [0])
+    for item in encoded:
+        offsets.append(offsets[-1] + len(item))
+    _align(fh)
+    offsets.tofile(fh)
+    _align(fh)
+    array('i', sorted(range(len(values)), key=values.__getitem__)).tofile(fh)
+    fh.write(b''.join(encoded))
+
+
+def _read_strings(view, position, count):
+    position += -position % 8
+    offsets = view[position:position + (count + 1) * 8].cast('q')
+    position += (count + 1) * 8
+    position += -position % 8
+    order = view[position:position + count * 4].cast('i')
+    position += count * 4
+    text = view[position:position + offsets[count]]
+    return StringTable(offsets, order, text), position + offsets[count]
+
+
+def snapshot_dir():
+    directory = getattr(settings, 'METRO_SNAPSHOT_DIR', None)
+    return Path(directory) if directory else None
+
+
+def snapshot_path(version, only_enabled, directory=None):
+    directory = directory or snapshot_dir()
+    scope = 'enabled' if only_enabled else 'all'
+    return Path(directory) / f"network-v{version}-{scope}.bin"
+
+
+def _align(fh):
+    padding = -fh.tell() % 8
+    if padding:
+        fh.write(b'\0' * padding)
+
+
+def write_snapshot(engine, path, version):
+    """
+    Write engine to path atomically. Linear in the size of the network, so
+    it is cheap enough for the first worker to see a new version to do it.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    n = len(engine.station_ids)
+
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(HEADER.pack(MAGIC, version, n, len(engine.neighbours), len(engine.line_codes)))
+            for values, typecode in (
+                (engine.station_ids, 'q'),
+                (engine.offsets, 'q'),
+                (engine.neighbours, 'i'),
+                (engine.edge_lines, 'i'),
+            ):
+                _align(fh)
+                array(typecode, values).tofile(fh)
+            for strings in (engine.station_codes, engine.line_codes, engine.line_names):
+                _write_strings(fh, list(strings))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return path
+
+
+def open_snapshot(path):
+    """
+    Map a snapshot file read-only and return (version, RoutingEngine) whose
+    arrays are memoryviews and whose codes and names are StringTables over
+    the mapping.
+    """
+    from .services import RoutingEngine
+
+    with open(path, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    magic, version, n, slots, lines = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a network snapshot.")
+
+    position = HEADER.size
+    sections = []
+    for count, typecode, size in ((n, 'q', 8), (n + 1, 'q', 8), (slots, 'i', 4), (slots, 'i', 4)):
+        position += -position % 8
+        sections.append(view[position:position + count * size].cast(typecode))
+        position += count * size
+
+    station_codes, position = _read_strings(view, position, n)
+    line_codes, position = _read_strings(view, position, lines)
+    line_names, position = _read_strings(view, position, lines)
+
+    station_ids, offsets, neighbours, edge_lines = sections
+    engine = RoutingEngine(station_ids, offsets, neighbours, edge_lines, line_codes, line_names, station_codes)
+    return version, engine
+
+
+def load_engine(version, only_enabled, build):
+    """
+    Open the snapshot for this topology version, exporting one from build()
+    first if no worker has written it yet.
+    """
+    path = snapshot_path(version, only_enabled)
+    if path.exists():
+        try:
+            return open_snapshot(path)[1]
+        except ValueError:
+            pass  # written by an older release in another format
+    write_snapshot(build(), path, version)
+    prune_snapshots(keep_version=version)
+    return open_snapshot(path)[1]
+
+
+def prune_snapshots(keep_version, directory=None):
+    """
+    Delete snapshots of older topology versions. Workers that still have one
+    mapped keep reading it until they swap; the pages go once they let go.
+    """
+    directory = Path(directory or snapshot_dir())
+    for path in directory.glob('network-v*-*.bin'):
+        try:
+            version = int(path.name.split('-')[1][1:])
+        except ValueError:
+            continue
+        if version < keep_version:
+            path.unlink(missing_ok=True)
@@ -1,3 +1,1382 @@
-from django.test import TestCase
+import json
+import os
+import re
+import subprocess
+import sys
+import tracemalloc
+import tempfile
+from datetime import timedelta
+from unittest import mock, skipUnless
+from decimal import Decimal
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import Count, Q
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .archive import (
+    add_months, archive_files, archive_month, ensure_scan_partitions, is_partitioned, month_start,
+    partition_name, read_archive,
+)
+from .forms import TicketPurchaseForm
+from .footfall import bucket_start, footfall_rows, rebuild_footfall, record_scans
+from .gates import apply_offline_scans, apply_scan
+from . import snapshot
+from .fares import Tariff, from_paise, od_features, path_line_codes
+from .models import (
+    GateScanSeq, MetroLine, Station, StationFootfall, Connection, PurchaseOTP, RouteFare, Ticket, TicketScan,
+    WalletTransaction,
+)
+from .tokens import check_token_at_gate, generate_key, issue_token, retire_key
+from .tickets import expire_overdue_tickets, overdue, with_effective_status
+from .wallet import InsufficientBalance, credit, debit, mismatched_wallets, monthly_totals
+from .services import (
+    bump_topology_version, calculate_price_from_path, current_map_version, current_topology_version, find_route,
+    RoutingEngine, get_route_quote, get_routing_engine, invalidate_graph_cache, rebuild_route_table,
+    route_cache_stats, shortest_path_between_stations, versioned_routing_engine,
+)
+
+
+def build_network(test, stations=21):
+    """
+    A Red line S0..S10 and a Blue line S10..S20 meeting at S10.
+    """
+    invalidate_graph_cache()
+    caches['routes'].clear()
+    test.red = MetroLine.objects.create(name='Red', code='R')
+    test.blue = MetroLine.objects.create(name='Blue', code='B')
+    test.stations = [Station.objects.create(code=f'S{i}', name=f'Station {i}') for i in range(stations)]
+    half = stations // 2
+    for i in range(stations - 1):
+        Connection.objects.create(
+            line=test.red if i < half else test.blue,
+            from_station=test.stations[i],
+            to_station=test.stations[i + 1],
+        )
+
+
+class RoutingEngineTests(SimpleTestCase):
+    def test_paths_match_networkx_with_ties(self):
+        import networkx as nx
+
+        # A 4x4 grid with two diagonals and a repeated pair: most station
+        # pairs have several shortest paths, so only the same tie-breaking
+        # as networkx gives the same answers.
+        edges = []
+        for row in range(4):
+            for col in range(4):
+                node = 10 + row * 4 + col
+                if col < 3:
+                    edges.append((node, node + 1, row % 2))
+                if row < 3:
+                    edges.append((node + 4, node, 2))
+        edges += [(10, 15, 1), (25, 20, 0), (11, 10, 2)]
+        station_ids = range(10, 27)  # 26 is isolated
+
+        G = nx.Graph()
+        G.add_nodes_from(station_ids)
+        for a, b, line in edges:
+            G.add_edge(a, b, line=line)
+        engine = RoutingEngine.from_edges(station_ids, edges, ['R', 'B', 'G'])
+
+        for source in station_ids:
+            for target in station_ids:
+                try:
+                    expected = nx.shortest_path(G, source, target)
+                except nx.NetworkXNoPath:
+                    expected = None
+                self.assertEqual(engine.shortest_path(source, target), expected, (source, target))
+        self.assertEqual(engine.edge_line(engine.index_of(10), engine.index_of(11)), 2)
+
+    def test_weighted_paths_cost_the_same_as_networkx(self):
+        import networkx as nx
+
+        edges = [(1, 2, 0), (2, 3, 0), (3, 4, 0), (1, 5, 2), (5, 4, 2), (2, 5, 1), (6, 7, 1)]
+        engine = RoutingEngine.from_edges(range(1, 8), edges, ['R', 'B', 'G'])
+        weights = [(1, 5, 2)[line] for line in engine.edge_lines]
+        G = nx.Graph()
+        G.add_nodes_from(range(1, 8))
+        G.add_weighted_edges_from((a, b, (1, 5, 2)[line]) for a, b, line in edges)
+
+        for source in range(1, 8):
+            for target in range(1, 8):
+                result = engine.dijkstra_path(source, target, weights)
+                if not nx.has_path(G, source, target):
+                    self.assertIsNone(result)
+                    continue
+                cost, path = result
+                self.assertEqual(cost, nx.dijkstra_path_length(G, source, target))
+                self.assertEqual(cost, nx.path_weight(G, path, 'weight'))
+                self.assertEqual((path[0], path[-1]), (source, target))
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        build_network(self, stations=8)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_round_trip_matches_engine_from_db(self):
+        engine = RoutingEngine.from_db()
+        path = snapshot.write_snapshot(engine, snapshot.snapshot_path(3, False, self.directory.name), 3)
+        version, loaded = snapshot.open_snapshot(path)
+
+        self.assertEqual(version, 3)
+        for field in ('station_ids', 'offsets', 'neighbours', 'edge_lines'):
+            self.assertEqual(list(getattr(loaded, field)), list(getattr(engine, field)), field)
+        for field in ('station_codes', 'line_codes', 'line_names'):
+            # Decoded from the mapping on access, not copied into lists.
+            self.assertIsInstance(getattr(loaded, field), snapshot.StringTable)
+            self.assertEqual(list(getattr(loaded, field)), getattr(engine, field), field)
+        for code, station_id in zip(engine.station_codes, engine.station_ids):
+            self.assertEqual(loaded.id_for_code(code), station_id)
+        self.assertIsNone(loaded.id_for_code('S99'))
+        for source in engine.station_ids:
+            for target in engine.station_ids:
+                self.assertEqual(loaded.shortest_path(source, target), engine.shortest_path(source, target))
+
+    def test_topology_change_swaps_to_a_new_snapshot(self):
+        with override_settings(METRO_SNAPSHOT_DIR=self.directory.name):
+            first = current_topology_version(force=True)
+            self.assertEqual(len(get_routing_engine().shortest_path(self.stations[0].id, self.stations[7].id)), 8)
+            old_path = snapshot.snapshot_path(first, False)
+            self.assertTrue(old_path.exists())
+
+            extra = Station.objects.create(code='X', name='Extra')
+            Connection.objects.create(line=self.red, from_station=self.stations[7], to_station=extra)
+            second = current_topology_version(force=True)
+            self.assertGreater(second, first)
+
+            engine = get_routing_engine()
+            self.assertEqual(engine.shortest_path(self.stations[6].id, extra.id),
+                             [self.stations[6].id, self.stations[7].id, extra.id])
+            self.assertTrue(snapshot.snapshot_path(second, False).exists())
+            self.assertFalse(old_path.exists())
+
+
+class FindRouteTests(TestCase):
+    def setUp(self):
+        build_network(self)
+
+    def test_route_is_annotated_from_the_engine(self):
+        route = find_route(self.stations[8], self.stations[12])
+
+        self.assertEqual(route['path_repr'], 'S8-S9-S10-S11-S12')
+        self.assertEqual(route['lines_used'], 'Red, Blue')
+        self.assertEqual(route['price'], Decimal('20.00'))
+        self.assertEqual(
+            [(e['from'], e['to'], e['line_code'], e['line_name']) for e in route['edges']],
+            [('S8', 'S9', 'R', 'Red'), ('S9', 'S10', 'R', 'Red'),
+             ('S10', 'S11', 'B', 'Blue'), ('S11', 'S12', 'B', 'Blue')],
+        )
+
+    def test_warm_route_lookup_issues_no_queries(self):
+        find_route(self.stations[0], self.stations[1])
+        with self.assertNumQueries(0):
+            route = find_route(self.stations[0], self.stations[20])
+        self.assertEqual(len(route['edges']), 20)
+
+    def test_cached_path_the_engine_cannot_follow_is_priced_not_a_500(self):
+        # As left by another worker whose engine already had an S0-S5 link.
+        version, _engine = versioned_routing_engine(only_enabled=True)
+        a, b, c = self.stations[0], self.stations[5], self.stations[6]
+        caches['routes'].set(f"route:v{version}:{a.id}:{c.id}:1", [a.id, b.id, c.id])
+
+        route = find_route(a, c)
+        self.assertEqual([e['line_code'] for e in route['edges']], [None, 'R'])
+        self.assertEqual(route['price'], Decimal('10.00'))
+        self.assertEqual(path_line_codes(get_routing_engine(), [a.id, b.id, 99999]), [None, None])
+
+
+class RouteCacheTests(TestCase):
+    def setUp(self):
+        build_network(self)
+
+    def test_repeat_lookup_hits_cache(self):
+        before = route_cache_stats()
+        shortest_path_between_stations(self.stations[0], self.stations[5], only_enabled=True)
+        shortest_path_between_stations(self.stations[0], self.stations[5], only_enabled=True)
+        after = route_cache_stats()
+
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+
+    def test_disabling_a_line_makes_cached_route_unreachable(self):
+        self.assertIsNotNone(
+            shortest_path_between_stations(self.stations[0], self.stations[15], only_enabled=True)
+        )
+        self.blue.is_enabled = False
+        self.blue.save()
+
+        self.assertIsNone(
+            shortest_path_between_stations(self.stations[0], self.stations[15], only_enabled=True)
+        )
+
+
+class RouteTableTests(TestCase):
+    def setUp(self):
+        build_network(self, stations=8)
+
+    def test_topology_change_is_rebuilt_by_maintenance_not_the_request(self):
+        rebuild_route_table()
+        with self.captureOnCommitCallbacks(execute=True):
+            # A loop, so some pairs have two routes and the table must pick find_route's.
+            Connection.objects.create(line=self.red, from_station=self.stations[0], to_station=self.stations[7])
+        version = current_topology_version(force=True)
+        self.assertFalse(RouteFare.objects.filter(topology_version=version).exists())
+
+        call_command('run_maintenance', once=True, stdout=open(os.devnull, 'w'))
+
+        rows = list(RouteFare.objects.select_related('source', 'destination'))
+        self.assertEqual(len(rows), 8 * 7)
+        for row in rows:
+            route = find_route(row.source, row.destination)
+            self.assertEqual(row.topology_version, version)
+            self.assertEqual((row.path_repr, row.price, row.lines_used),
+                             (route['path_repr'], route['price'], route['lines_used']))
+
+    def test_quotes_come_from_table_until_it_is_stale(self):
+        rebuild_route_table()
+        source, destination = self.stations[1], self.stations[6]
+        RouteFare.objects.filter(source=source, destination=destination).update(price=Decimal('99.00'))
+        self.assertEqual(get_route_quote(source, destination)['price'], Decimal('99.00'))
+
+        bump_topology_version()
+        self.assertEqual(get_route_quote(source, destination)['price'], find_route(source, destination)['price'])
+
+    def test_rebuild_for_an_outdated_version_writes_nothing(self):
+        rebuild_route_table()
+        stale = current_topology_version(force=True)
+        bump_topology_version()
+        with mock.patch('metro.services.current_topology_version', return_value=stale):
+            self.assertEqual(rebuild_route_table(), 0)
+        self.assertEqual(set(RouteFare.objects.values_list('topology_version', flat=True)), {stale})
+
+
+class RouteQuotesApiTests(TestCase):
+    def setUp(self):
+        build_network(self, stations=6)
+
+    def post(self, body):
+        data = body if isinstance(body, str) else json.dumps(body)
+        return self.client.post(reverse('metro_route_quotes'), data, content_type='application/json')
+
+    def test_quotes_match_purchase_routing(self):
+        response = self.post({'pairs': [['S0', 'S4'], ['S2', 'S2'], ['S1', 'NOPE']]})
+        self.assertEqual(response.status_code, 200)
+        route = find_route(self.stations[0], self.stations[4])
+        self.assertEqual(response.json()['quotes'], [
+            {'source': 'S0', 'destination': 'S4', 'path': route['station_codes'],
+             'price': str(route['price']), 'lines': route['lines']},
+            {'source': 'S2', 'destination': 'S2', 'error': "Source and destination cannot be the same."},
+            {'source': 'S1', 'destination': 'NOPE', 'error': "Unknown station code."},
+        ])
+
+    def test_malformed_bodies_are_rejected(self):
+        for body in ('not json', {'pair': []}, {'pairs': {'ab': 1}}, {'pairs': ['ab']},
+                     {'pairs': [['S0', 'S1', 'S2']]}, [['S0', 'S1']]):
+            with self.subTest(body=body):
+                self.assertEqual(self.post(body).status_code, 400)
+
+    @override_settings(METRO_QUOTE_BATCH_LIMIT=3)
+    def test_batch_size_is_limited(self):
+        self.assertEqual(self.post({'pairs': [['S0', 'S1']] * 3}).status_code, 200)
+        response = self.post({'pairs': [['S0', 'S1']] * 4})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('At most 3', response.json()['error'])
+
+
+class FareEngineTests(TestCase):
+    def setUp(self):
+        build_network(self, stations=9)
+        self.engine = get_routing_engine(only_enabled=True)
+
+    def test_default_tariff_matches_flat_pricing(self):
+        tariff = Tariff()
+        pairs, hops, line_counts, transfers = od_features(self.engine)
+        bulk = tariff.price_many(hops, line_counts, transfers, self.engine.line_codes)
+
+        for (src, dest), paise in zip(pairs, bulk):
+            path_ids = self.engine.shortest_path(src, dest)
+            expected = calculate_price_from_path(path_ids)
+            self.assertEqual(tariff.price(path_line_codes(self.engine, path_ids)), expected)
+            self.assertEqual(from_paise(paise), expected)
+
+    def test_bulk_and_single_path_agree_on_custom_tariff(self):
+        tariff = Tariff({
+            'base_fare': '2.00',
+            'line_rates': {'B': '7.50'},
+            'transfer_fee': '-1.00',
+            'max_fare': '30.00',
+        })
+        pairs, hops, line_counts, transfers = od_features(self.engine)
+        bulk = tariff.price_many(hops, line_counts, transfers, self.engine.line_codes)
+
+        for (src, dest), paise in zip(pairs, bulk):
+            path_ids = self.engine.shortest_path(src, dest)
+            self.assertEqual(from_paise(paise), tariff.price(path_line_codes(self.engine, path_ids)))
+
+
+class TicketPurchaseQueryTests(TestCase):
+    def setUp(self):
+        build_network(self)
+        self.user = User.objects.create_user('rider', email='rider@example.com', password='pw')
+        credit(self.user.profile, Decimal('500.00'))
+        self.client.force_login(self.user)
+
+    def purchase(self, dest):
+        return self.client.post(reverse('metro_ticket_buy'), {
+            'source': self.stations[0].id,
+            'destination': self.stations[dest].id,
+        })
+
+    def test_query_count_does_not_grow_with_path_length(self):
+        self.purchase(1)
+
+        with CaptureQueriesContext(connection) as short_trip:
+            self.assertEqual(self.purchase(2).status_code, 302)
+        with self.assertNumQueries(len(short_trip.captured_queries)):
+            self.assertEqual(self.purchase(20).status_code, 302)
+        self.assertFalse(any(
+            'metro_connection' in q['sql'] for q in short_trip.captured_queries
+        ))
+
+
+class ReferenceDataRegistryTests(TestCase):
+    REFERENCE_TABLES = ('"metro_station"', '"metro_metroline"')
+
+    def setUp(self):
+        build_network(self, stations=4)
+        self.staff = User.objects.create_user('staff', email='staff@example.com', password='pw', is_staff=True)
+        self.client.force_login(self.staff)
+
+    def reference_queries(self, method, name, data=None):
+        getattr(self.client, method)(reverse(name), data)
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(reverse(name), data)
+        self.assertLess(response.status_code, 400)
+        return [q['sql'] for q in queries.captured_queries
+                if any(table in q['sql'] for table in self.REFERENCE_TABLES)]
+
+    def test_pages_render_and_validate_without_reference_queries(self):
+        self.assertEqual(self.reference_queries('get', 'metro_ticket_buy'), [])
+        self.assertEqual(self.reference_queries('get', 'metro_scanner_scan'), [])
+        self.assertEqual(self.reference_queries('get', 'metro_scanner_offline'), [])
+        self.assertEqual(self.reference_queries('post', 'metro_scanner_offline', {
+            'source': self.stations[0].id, 'destination': self.stations[2].id,
+        }), [])
+
+    def test_new_station_shows_up_in_forms(self):
+        form = TicketPurchaseForm()
+        self.assertEqual(len(list(form.fields['source'].choices)), 5)
+
+        Station.objects.create(code='NEW', name='New Station')
+        form = TicketPurchaseForm({'source': self.stations[0].id, 'destination': Station.objects.get(code='NEW').id})
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['destination'].code, 'NEW')
+
+
+class TicketExpiryTests(TestCase):
+    def setUp(self):
+        build_network(self, stations=3)
+        self.user = User.objects.create_user('rider', password='pw')
+        self.client.force_login(self.user)
+        past = timezone.now() - timedelta(minutes=5)
+        self.overdue = [
+            Ticket.objects.create(passenger=self.user.profile, source=self.stations[0],
+                                  destination=self.stations[2], status=status, expires_at=past)
+            for status in ('ACTIVE', 'IN_USE', 'ACTIVE', 'USED')
+        ]
+        self.valid = Ticket.objects.create(passenger=self.user.profile, source=self.stations[0],
+                                           destination=self.stations[2],
+                                           expires_at=timezone.now() + timedelta(hours=1))
+
+    def test_views_show_effective_status_without_writing(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('metro_ticket_list'))
+            detail = self.client.get(reverse('metro_ticket_detail', args=[self.overdue[0].id]))
+
+        self.assertContains(response, '[EXPIRED]', count=3)
+        self.assertContains(response, '[USED]', count=1)
+        self.assertContains(response, '[ACTIVE]', count=1)
+        self.assertContains(detail, 'EXPIRED')
+        self.assertFalse([q for q in queries.captured_queries if q['sql'].startswith('UPDATE')])
+        self.assertEqual(Ticket.objects.filter(status='EXPIRED').count(), 0)
+
+    def test_sweeper_expires_overdue_tickets_in_batches(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(expire_overdue_tickets(batch_size=2), 3)
+        self.assertEqual(len([q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]), 2)
+
+        statuses = dict(Ticket.objects.values_list('id', 'status'))
+        self.assertEqual([statuses[t.id] for t in self.overdue], ['EXPIRED', 'EXPIRED', 'EXPIRED', 'USED'])
+        self.assertEqual(statuses[self.valid.id], 'ACTIVE')
+        self.assertEqual(expire_overdue_tickets(), 0)
+
+
+class TicketHistoryPagingTests(TestCase):
+    def setUp(self):
+        build_network(self, stations=3)
+        self.user = User.objects.create_user('commuter', password='pw')
+        self.client.force_login(self.user)
+        Ticket.objects.bulk_create([
+            Ticket(passenger=self.user.profile, source=self.stations[0], destination=self.stations[2])
+            for _ in range(60)
+        ])
+        # Same created_at for a run of tickets, so the id tie-break matters.
+        Ticket.objects.filter(pk__in=Ticket.objects.values('pk')[:20]).update(created_at=timezone.now())
+
+    def test_pages_cover_history_once_with_constant_queries(self):
+        seen = []
+        before = None
+        query_counts = set()
+        while True:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('metro_ticket_list'), {'before': before} if before else {})
+            query_counts.add(len(queries.captured_queries))
+            self.assertLessEqual(len(response.context['tickets']), 25)
+            seen.extend(t.id for t in response.context['tickets'])
+            before = response.context['next_cursor']
+            if not before:
+                break
+
+        expected = list(Ticket.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(query_counts), 1)
+
+    def test_bad_cursor_redirects_to_first_page(self):
+        response = self.client.get(reverse('metro_ticket_list'), {'before': '99999999999999999999.zz'})
+        self.assertRedirects(response, reverse('metro_ticket_list'))
+
+
+class QueryPlanTests(TestCase):
+    """
+    EXPLAIN every hot query on a seeded dataset and fail on sequential scans.
+    On PostgreSQL seq scans are disabled first, so one that still shows up
+    means no usable index exists; SQLite reports a plain "SCAN <table>".
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        invalidate_graph_cache()
+        line = MetroLine.objects.create(name='Red', code='R')
+        cls.stations = Station.objects.bulk_create([Station(code=f'Q{i}', name=f'Q{i}') for i in range(20)])
+        Connection.objects.bulk_create([
+            Connection(line=line, from_station=a, to_station=b) for a, b in zip(cls.stations, cls.stations[1:])
+        ])
+        users = [User.objects.create_user(f'plan{i}') for i in range(10)]
+        cls.user = users[0]
+        now = timezone.now()
+        tickets = Ticket.objects.bulk_create([
+            Ticket(passenger=users[i % 10].profile, source=cls.stations[i % 20], destination=cls.stations[(i + 5) % 20],
+                   status=('ACTIVE', 'IN_USE', 'USED', 'EXPIRED')[i % 4], expires_at=now + timedelta(hours=i % 48 - 24))
+            for i in range(2000)
+        ])
+        TicketScan.objects.bulk_create([
+            TicketScan(ticket=tickets[i], station=cls.stations[i % 20], direction='ENTRY',
+                       scanned_at=now - timedelta(minutes=i), gate_id=f'G{i % 5}', gate_seq=i)
+            for i in range(2000)
+        ])
+        GateScanSeq.objects.bulk_create([GateScanSeq(gate_id=f'G{i % 5}', gate_seq=i) for i in range(2000)])
+        PurchaseOTP.objects.bulk_create([
+            PurchaseOTP(user=users[i % 10], code='000000', payload={}, is_used=i % 5 != 0,
+                        expires_at=now + timedelta(minutes=5))
+            for i in range(1000)
+        ])
+        WalletTransaction.objects.bulk_create([
+            WalletTransaction(passenger=users[i % 10].profile, amount=Decimal(i % 7 - 3))
+            for i in range(2000)
+        ])
+        rebuild_footfall()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def hot_queries(self):
+        now = timezone.now()
+        station = self.stations[3]
+        newest = Ticket.objects.filter(passenger=self.user.profile).order_by('-created_at', '-id').first()
+        return {
+            'pending otp': (PurchaseOTP.objects
+                            .filter(user=self.user, purpose='TICKET_PURCHASE', is_used=False)
+                            .order_by('-created_at')[:1]),
+            'expiry sweep batch': Ticket.objects.filter(overdue(now)).order_by('expires_at').values('pk')[:1000],
+            'ticket history page': (with_effective_status(
+                Ticket.objects.filter(passenger=self.user.profile)
+                .select_related('source', 'destination')
+                .filter(created_at__lte=newest.created_at)
+                .filter(Q(created_at__lt=newest.created_at) | Q(created_at=newest.created_at, id__lt=newest.id))
+                .order_by('-created_at', '-id'))[:26]),
+            'footfall report': footfall_rows(now - timedelta(hours=6), now, 'hour'),
+            'footfall rebuild range': (TicketScan.objects
+                                       .filter(scanned_at__gte=now - timedelta(hours=6), scanned_at__lt=now)
+                                       .values_list('station_id', 'direction')
+                                       .annotate(count=Count('id'))
+                                       .order_by()),
+            'gate feed delta': (Ticket.objects
+                                .filter(Q(source_id=station.id) | Q(destination_id=station.id), updated_at__lte=now)
+                                .filter(Q(updated_at__gt=now - timedelta(hours=1)))
+                                .order_by('updated_at', 'id')[:100]),
+            'gate seq dedupe': GateScanSeq.objects.filter(gate_id='G1', gate_seq__in=[1, 6, 11]).values_list('gate_seq'),
+            'wallet statement page': (WalletTransaction.objects
+                                      .filter(passenger=self.user.profile, created_at__lte=now)
+                                      .filter(Q(created_at__lt=now) | Q(created_at=now, id__lt=10**6))
+                                      .order_by('-created_at', '-id')[:26]),
+            'wallet monthly totals': monthly_totals(self.user.profile),
+        }
+
+    def sequential_scans(self, plan):
+        if connection.vendor == 'postgresql':
+            return re.findall(r'Seq Scan on (\w+)', plan)
+        return re.findall(r'\bSCAN (\w+)$', plan, re.MULTILINE)
+
+    def test_hot_queries_use_indexes(self):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+        for name, queryset in self.hot_queries().items():
+            with self.subTest(name):
+                plan = queryset.explain()
+                self.assertFalse(self.sequential_scans(plan), f"{name} scans a table:\n{plan}")
+
+
+class FootfallRollupTests(TestCase):
+    def setUp(self):
+        build_network(self, stations=4)
+        self.client.force_login(User.objects.create_user('staff', password='pw', is_staff=True))
+
+    def scan_pairs(self, count):
+        for _ in range(count):
+            ticket = Ticket.objects.create(source=self.stations[0], destination=self.stations[3])
+            apply_scan(ticket.id, self.stations[0].id, 'ENTRY')
+            apply_scan(ticket.id, self.stations[3].id, 'EXIT')
+
+    def buckets(self):
+        return sorted(StationFootfall.objects.values_list('station_id', 'hour', 'direction', 'count'))
+
+    def test_incremental_rollup_matches_rebuild(self):
+        self.scan_pairs(3)
+        old = Ticket.objects.create(source=self.stations[1], destination=self.stations[2], status='USED')
+        TicketScan.objects.bulk_create([
+            TicketScan(ticket=old, station=self.stations[1], direction='ENTRY',
+                       scanned_at=timezone.now() - timedelta(days=3, minutes=m))
+            for m in range(5)
+        ])
+        record_scans((self.stations[1].id, scan.scanned_at, 'ENTRY') for scan in TicketScan.objects.filter(ticket=old))
+
+        incremental = self.buckets()
+        self.assertEqual(sum(row[3] for row in incremental), 11)
+        rebuild_footfall()
+        self.assertEqual(self.buckets(), incremental)
+
+    def test_report_reads_rollup_by_day_and_hour(self):
+        self.scan_pairs(2)
+        today = timezone.localdate().isoformat()
+
+        with CaptureQueriesContext(connection) as queries:
+            daily = self.client.get(reverse('metro_footfall'), {'start': today, 'end': today})
+        self.assertFalse([q for q in queries.captured_queries if '"metro_ticketscan"' in q['sql']])
+        rows = {row['station_name']: (row['entries'], row['exits'], row['count']) for row in daily.context['rows']}
+        self.assertEqual(rows, {'Station 0': (2, 0, 2), 'Station 3': (0, 2, 2)})
+
+        hourly = self.client.get(reverse('metro_footfall'), {'start': today, 'end': today, 'granularity': 'hour'})
+        self.assertEqual({row['bucket'] for row in hourly.context['rows']}, {bucket_start(timezone.now())})
+
+        too_long = self.client.get(reverse('metro_footfall'), {
+            'start': '2020-01-01', 'end': today, 'granularity': 'hour',
+        })
+        self.assertEqual(too_long.context['rows'], [])
+        self.assertContains(too_long, 'at most 31 days')
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        build_network(self, stations=4)
+        self.client.force_login(User.objects.create_user('analyst', password='pw', is_staff=True))
+
+    def seed_scans(self, count, station):
+        ticket = Ticket.objects.create(source=self.stations[0], destination=self.stations[3], status='USED')
+        TicketScan.objects.bulk_create([
+            TicketScan(ticket=ticket, station=station, direction='ENTRY',
+                       scanned_at=timezone.now() - timedelta(seconds=i))
+            for i in range(count)
+        ], batch_size=1000)
+
+    def export(self, dataset, **params):
+        response = self.client.get(reverse('metro_export', args=[dataset]), params)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_and_ndjson_with_filters(self):
+        self.seed_scans(3, self.stations[0])
+        self.seed_scans(2, self.stations[1])
+        today = timezone.localdate().isoformat()
+
+        lines = self.export('scans', station=self.stations[1].id, start=today, end=today).splitlines()
+        self.assertEqual(lines[0].split(',')[:4], ['id', 'ticket_id', 'station', 'direction'])
+        self.assertEqual([line.split(',')[2] for line in lines[1:]], ['S1', 'S1'])
+
+        yesterday = (timezone.localdate() - timedelta(days=1)).isoformat()
+        self.assertEqual(self.export('scans', end=yesterday).splitlines()[1:], [])
+
+        tickets = [json.loads(line) for line in self.export('tickets', format='ndjson').splitlines()]
+        self.assertEqual({t['source'] for t in tickets}, {'S0'})
+        self.assertEqual(tickets[0]['price'], '0.00')
+
+    def test_memory_does_not_grow_with_row_count(self):
+        def peak(count):
+            TicketScan.objects.all().delete()
+            self.seed_scans(count, self.stations[0])
+            response = self.client.get(reverse('metro_export', args=['scans']))
+            tracemalloc.start()
+            rows = sum(chunk.count(b'\n') for chunk in response.streaming_content)
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.assertEqual(rows, count + 1)
+            return peak_bytes
+
+        small, large = peak(2000), peak(20000)
+        self.assertLess(large, small * 2)
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        build_network(self, stations=4)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(METRO_ARCHIVE_DIR=directory.name, METRO_RETENTION_MONTHS=6))
+        self.old_month = add_months(month_start(), -8)
+
+    def ticket(self, created_at, **fields):
+        ticket = Ticket.objects.create(source=self.stations[0], destination=self.stations[3], **fields)
+        Ticket.objects.filter(pk=ticket.pk).update(created_at=created_at)
+        return ticket
+
+    def scan(self, ticket, scanned_at, direction='ENTRY'):
+        TicketScan.objects.create(ticket=ticket, station=self.stations[0], direction=direction, scanned_at=scanned_at)
+        record_scans([(self.stations[0].id, scanned_at, direction)])
+
+    def test_archives_months_past_retention_and_reads_them_back(self):
+        old = self.old_month + timedelta(days=3)
+        used = self.ticket(old, status='USED')
+        self.scan(used, old)
+        self.scan(used, old + timedelta(minutes=20), 'EXIT')
+        unexpired = self.ticket(old)
+        recent = self.ticket(timezone.now())
+        self.scan(recent, timezone.now())
+
+        call_command('archive_history', stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(list(TicketScan.objects.values_list('ticket_id', flat=True)), [recent.id])
+        self.assertEqual(set(Ticket.objects.values_list('id', flat=True)), {unexpired.id, recent.id})
+        # The rollup outlives the raw scans.
+        self.assertEqual(StationFootfall.objects.filter(hour__lt=add_months(self.old_month, 1)).count(), 2)
+
+        scan_files = archive_files('scans', self.old_month)
+        self.assertEqual(len(scan_files), 1)
+        self.assertEqual(scan_files[0].stat().st_mode & 0o777, 0o444)
+        scans = list(read_archive('scans', self.old_month))
+        self.assertEqual([row['direction'] for row in scans], ['ENTRY', 'EXIT'])
+        self.assertEqual({row['ticket_id'] for row in scans}, {str(used.id)})
+        tickets = list(read_archive('tickets', self.old_month))
+        self.assertEqual([(row['id'], row['status']) for row in tickets], [(str(used.id), 'USED')])
+
+    def test_late_rows_go_to_a_new_part(self):
+        old = self.old_month + timedelta(days=3)
+        ticket = self.ticket(old, status='USED')
+        self.scan(ticket, old)
+        self.assertEqual(archive_month('scans', self.old_month), 1)
+        self.scan(ticket, old + timedelta(minutes=5), 'EXIT')
+        self.assertEqual(archive_month('scans', self.old_month), 1)
+        self.assertEqual(archive_month('scans', self.old_month), 0)
+
+        self.assertEqual([path.name for path in archive_files('scans', self.old_month)], [
+            f"scans-{self.old_month:%Y-%m}.ndjson.gz",
+            f"scans-{self.old_month:%Y-%m}.2.ndjson.gz",
+        ])
+        self.assertEqual([row['direction'] for row in read_archive('scans', self.old_month)], ['ENTRY', 'EXIT'])
+
+    def test_rebuilding_footfall_keeps_archived_months(self):
+        old = self.old_month + timedelta(days=3)
+        ticket = self.ticket(old, status='USED')
+        self.scan(ticket, old)
+        self.scan(ticket, timezone.now())
+        archive_month('scans', self.old_month)
+
+        self.assertEqual(rebuild_footfall(), 1)
+        self.assertEqual(rebuild_footfall(start=self.old_month, end=add_months(self.old_month, 1)), 0)
+        self.assertEqual(StationFootfall.objects.count(), 2)
+        self.assertTrue(StationFootfall.objects.filter(hour=bucket_start(old)).exists())
+
+
+class MetroMapTests(TestCase):
+    def setUp(self):
+        build_network(self, stations=6)
+        caches['default'].clear()
+        self.url = reverse('metro_map_image')
+
+    def ticket(self, path_repr):
+        codes = path_repr.split('-')
+        return Ticket.objects.create(
+            source=Station.objects.get(code=codes[0]), destination=Station.objects.get(code=codes[-1]),
+            path_repr=path_repr,
+        )
+
+    def test_revalidation_returns_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response['ETag'])
+        self.assertTrue(response['Last-Modified'])
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(
+            self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+        bump_topology_version()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_overlay_is_rendered_once_per_path(self):
+        from . import maps
+
+        first, same, other = self.ticket('S0-S1-S2'), self.ticket('S0-S1-S2'), self.ticket('S2-S3')
+        with mock.patch('metro.maps._new_axes', wraps=maps._new_axes) as new_axes:
+            etags = [self.client.get(self.url, {'highlight': str(t.id)})['ETag'] for t in (first, same, other)]
+
+        # The base map once, then one overlay for each distinct path.
+        self.assertEqual(new_axes.call_count, 3)
+        self.assertEqual(etags[0], etags[1])
+        self.assertNotEqual(etags[0], etags[2])
+
+    def test_svg_is_streamed_with_the_highlighted_path(self):
+        from xml.etree import ElementTree
+
+        ticket = self.ticket('S1-S2-S3')
+        response = self.client.get(self.url, {'format': 'svg', 'highlight': str(ticket.id)})
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        root = ElementTree.fromstring(b''.join(response.streaming_content))
+        polylines = root.findall('{http://www.w3.org/2000/svg}polyline')
+        self.assertEqual(len(polylines), 1)
+        self.assertEqual(len(polylines[0].get('points').split()), 3)
+
+    def test_invalid_highlight_serves_the_plain_map(self):
+        plain = self.client.get(self.url, {'format': 'svg'})
+        for highlight in ('bad', '00000000-0000-0000-0000-000000000000'):
+            response = self.client.get(self.url, {'format': 'svg', 'highlight': highlight})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['ETag'], plain['ETag'])
+            self.assertNotIn(b'<polyline', b''.join(response.streaming_content))
+
+    def place_stations(self):
+        for i, station in enumerate(self.stations):
+            Station.objects.filter(pk=station.pk).update(map_x=float(i), map_y=0.0)
+
+    def test_stored_positions_are_reused(self):
+        self.place_stations()
+        with mock.patch('networkx.spring_layout', side_effect=AssertionError("layout recomputed")):
+            data = self.client.get(reverse('metro_map_data')).json()
+
+        self.assertEqual([(s['code'], s['x'], s['y']) for s in data['stations']],
+                         [(f'S{i}', float(i), 0.0) for i in range(6)])
+        self.assertEqual(len(data['connections']), 5)
+
+    def test_new_station_is_placed_next_to_its_neighbours(self):
+        from . import maps
+
+        self.place_stations()
+        extra = Station.objects.create(code='X', name='Extra')
+        Connection.objects.create(line=self.red, from_station=self.stations[2], to_station=extra)
+        Connection.objects.create(line=self.red, from_station=extra, to_station=self.stations[3])
+
+        with mock.patch('networkx.spring_layout', side_effect=AssertionError("layout recomputed")):
+            x, y = maps.map_layout(current_map_version())['pos']['X']
+        # Within 5% of the map's span (5) of its neighbours' centroid.
+        self.assertLessEqual(((x - 2.5) ** 2 + y ** 2) ** 0.5, 0.25 + 1e-9)
+
+    def test_unplaced_network_is_drawn_without_a_layout_until_maintenance_runs(self):
+        from . import maps
+
+        with mock.patch('networkx.spring_layout', side_effect=AssertionError("layout in a request")), \
+                self.assertLogs('metro.maps', 'WARNING'):
+            pos = maps.map_layout(current_map_version())['pos']
+        self.assertEqual(len(pos), 6)
+
+        before = current_map_version(force=True)
+        call_command('run_maintenance', once=True, stdout=open(os.devnull, 'w'))
+        self.assertFalse(Station.objects.filter(map_x__isnull=True).exists())
+        self.assertNotEqual(current_map_version(force=True), before)
+
+    def test_layout_command_refreshes_maps_but_not_routes(self):
+        self.place_stations()
+        Station.objects.filter(code='S5').update(map_x=None, map_y=None)
+        rebuild_route_table()
+        version = current_topology_version(force=True)
+        etag = self.client.get(reverse('metro_map_data'))['ETag']
+
+        call_command('compute_station_layout', stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(current_topology_version(force=True), version)
+        self.assertEqual(set(RouteFare.objects.values_list('topology_version', flat=True)), {version})
+        self.assertIsNotNone(Station.objects.get(code='S5').map_x)
+        response = self.client.get(reverse('metro_map_data'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class GateScanApiTests(TestCase):
+    def setUp(self):
+        build_network(self, stations=4)
+        self.staff = User.objects.create_user('gate', password='pw', is_staff=True)
+        self.client.force_login(self.staff)
+        self.ticket = Ticket.objects.create(
+            source=self.stations[0], destination=self.stations[3], price=Decimal('15.00'),
+        )
+
+    def tap(self, station, direction, ticket_id=None):
+        return self.client.post(reverse('metro_gate_scan'), {
+            'ticket_id': str(ticket_id or self.ticket.id),
+            'station': station.code,
+            'direction': direction,
+        }, content_type='application/json')
+
+    def test_entry_then_exit(self):
+        get_routing_engine()
+        warm_up = Ticket.objects.create(source=self.stations[0], destination=self.stations[3])
+        apply_scan(warm_up.id, self.stations[0].id, 'ENTRY')
+        # session, user, then inside a savepoint: conditional UPDATE, scan
+        # INSERT and the footfall bucket UPDATE
+        with self.assertNumQueries(7):
+            entry = self.tap(self.stations[0], 'ENTRY').json()
+        self.assertEqual(entry, {'ok': True, 'verdict': 'OK', 'status': 'IN_USE'})
+
+        exit_ = self.tap(self.stations[3], 'EXIT').json()
+        self.assertEqual(exit_, {'ok': True, 'verdict': 'OK', 'status': 'USED'})
+        self.assertEqual(TicketScan.objects.filter(ticket=self.ticket).count(), 2)
+
+    def test_rejections_leave_ticket_untouched(self):
+        self.assertEqual(self.tap(self.stations[1], 'ENTRY').json()['verdict'], 'WRONG_STATION')
+        self.assertEqual(self.tap(self.stations[3], 'EXIT').json()['verdict'], 'WRONG_STATUS')
+        self.assertEqual(self.tap(self.stations[0], 'ENTRY', ticket_id='not-a-uuid').json()['verdict'], 'NOT_FOUND')
+
+        self.ticket.refresh_from_db()
+        self.assertEqual(self.ticket.status, 'ACTIVE')
+        self.assertFalse(TicketScan.objects.exists())
+
+    def test_second_entry_is_rejected(self):
+        self.tap(self.stations[0], 'ENTRY')
+        self.assertEqual(self.tap(self.stations[0], 'ENTRY').json()['verdict'], 'WRONG_STATUS')
+        self.assertEqual(TicketScan.objects.count(), 1)
+
+    def test_non_staff_is_forbidden(self):
+        self.client.force_login(User.objects.create_user('rider', password='pw'))
+        self.assertEqual(self.tap(self.stations[0], 'ENTRY').status_code, 403)
+
+    def test_posts_need_the_csrf_token_from_the_feed(self):
+        self.client = Client(enforce_csrf_checks=True)
+        self.client.force_login(self.staff)
+
+        response = self.tap(self.stations[0], 'ENTRY')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json(), {'ok': False, 'verdict': 'CSRF_FAILED'})
+        self.assertFalse(TicketScan.objects.exists())
+
+        self.client.get(reverse('metro_gate_ticket_feed', args=[self.stations[0].code]))
+        response = self.client.post(reverse('metro_gate_scan'), {
+            'ticket_id': str(self.ticket.id), 'station': self.stations[0].code, 'direction': 'ENTRY',
+        }, content_type='application/json', HTTP_X_CSRFTOKEN=self.client.cookies['csrftoken'].value)
+        self.assertEqual(response.json()['verdict'], 'OK')
+
+
+class GateScanUploadTests(TestCase):
+    def setUp(self):
+        build_network(self, stations=4)
+        self.client.force_login(User.objects.create_user('gate', password='pw', is_staff=True))
+        self.tickets = [
+            Ticket.objects.create(source=self.stations[0], destination=self.stations[3], price=Decimal('15.00'))
+            for _ in range(3)
+        ]
+
+    def upload(self, scans):
+        return self.upload_as('G-7', scans)
+
+    def upload_as(self, gate_id, scans=None):
+        return self.client.post(reverse('metro_gate_scan_upload'), {
+            'gate_id': gate_id, 'scans': self.scans() if scans is None else scans,
+        }, content_type='application/json').json()
+
+    def scans(self):
+        start = bucket_start(timezone.now())
+        records = []
+        for i, ticket in enumerate(self.tickets):
+            for offset, (station, direction) in enumerate(((self.stations[0], 'ENTRY'), (self.stations[3], 'EXIT'))):
+                records.append({
+                    'seq': 2 * i + offset,
+                    'ticket_id': str(ticket.id),
+                    'station': station.code,
+                    'direction': direction,
+                    'scanned_at': (start + timedelta(seconds=2 * i + offset)).isoformat(),
+                })
+        return records[::-1]
+
+    def test_upload_applies_in_seq_order_and_replay_is_a_no_op(self):
+        records = self.scans()
+        records.append({**records[0], 'seq': 99, 'direction': 'ENTRY'})
+
+        result = self.upload(records)
+        self.assertEqual((result['applied'], result['duplicates']), (6, 0))
+        self.assertEqual(result['rejected'], [{'seq': 99, 'verdict': 'USED'}])
+        self.assertEqual(set(Ticket.objects.values_list('status', flat=True)), {'USED'})
+        first = TicketScan.objects.get(gate_id='G-7', gate_seq=0)
+        self.assertEqual(first.scanned_at, min(s.scanned_at for s in TicketScan.objects.all()))
+
+        replay = self.upload(records)
+        self.assertEqual((replay['applied'], replay['duplicates']), (0, 6))
+        self.assertEqual(TicketScan.objects.count(), 6)
+
+    def test_malformed_records_are_rejected_individually(self):
+        records = self.scans()
+        bad = [
+            {**records[0], 'seq': 100, 'direction': []},
+            {**records[0], 'seq': 1e30},
+            {**records[0], 'seq': 2 ** 63},
+            {**records[0], 'seq': -1},
+            ['not', 'a', 'record'],
+        ]
+        result = self.upload(records + bad)
+
+        self.assertEqual(result['applied'], 6)
+        self.assertEqual([item['verdict'] for item in result['rejected']], ['BAD_RECORD'] * 5)
+        self.assertEqual([item['seq'] for item in result['rejected']], [100, 1e30, 2 ** 63, -1, None])
+
+    def test_gate_id_must_be_a_short_string(self):
+        for gate_id in ('G' * 65, '', 5, {'id': 'G-7'}):
+            response = self.client.post(reverse('metro_gate_scan_upload'), {
+                'gate_id': gate_id, 'scans': self.scans(),
+            }, content_type='application/json')
+            self.assertEqual(response.status_code, 400, gate_id)
+        self.assertEqual(self.upload_as('G' * 64)['applied'], 6)
+        self.assertFalse(TicketScan.objects.exclude(gate_id='G' * 64).exists())
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as fh:
+            json.dump({'gate_id': 'G' * 65, 'scans': []}, fh)
+            fh.flush()
+            with self.assertRaises(CommandError):
+                call_command('import_gate_scans', fh.name)
+
+    def test_import_command_rejects_a_body_that_is_not_an_object(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as fh:
+            json.dump([{'gate_id': 'G-7'}], fh)
+            fh.flush()
+            with self.assertRaises(CommandError):
+                call_command('import_gate_scans', fh.name)
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        # Creates the footfall buckets, so both measured uploads only update them.
+        apply_offline_scans('G-0', self.scans()[-2:])
+        self.tickets = [Ticket.objects.create(source=self.stations[0], destination=self.stations[3])]
+        with CaptureQueriesContext(connection) as small:
+            apply_offline_scans('G-1', self.scans()[-2:])
+        self.tickets = [
+            Ticket.objects.create(source=self.stations[0], destination=self.stations[3])
+            for _ in range(30)
+        ]
+        with self.assertNumQueries(len(small.captured_queries)):
+            self.assertEqual(apply_offline_scans('G-2', self.scans())['applied'], 60)
+
+
+@override_settings(METRO_GATE_FEED_LAG_SECONDS=0)
+class GateTicketFeedTests(TestCase):
+    def setUp(self):
+        build_network(self, stations=4)
+        self.client.force_login(User.objects.create_user('gate', password='pw', is_staff=True))
+
+    def ticket(self, **kwargs):
+        return Ticket.objects.create(source=self.stations[0], destination=self.stations[3], **kwargs)
+
+    def feed(self, station, since=None, limit=None):
+        params = {key: value for key, value in (('since', since), ('limit', limit)) if value}
+        return self.client.get(
+            reverse('metro_gate_ticket_feed', args=[station.code]), params,
+        ).json()
+
+    def test_snapshot_then_deltas_with_revocations(self):
+        live = self.ticket()
+        self.ticket(status='USED')
+        self.ticket(expires_at=timezone.now() - timedelta(hours=1))
+        Ticket.objects.create(source=self.stations[1], destination=self.stations[2])
+
+        snapshot = self.feed(self.stations[0])
+        self.assertEqual(snapshot['tickets'], [[str(live.id), 'ACTIVE', 'S0', 'S3', None]])
+        self.assertEqual(snapshot['revoked'], [])
+
+        self.assertEqual(self.feed(self.stations[0], since=snapshot['cursor'])['tickets'], [])
+
+        apply_scan(live.id, self.stations[0].id, 'ENTRY')
+        delta = self.feed(self.stations[0], since=snapshot['cursor'])
+        self.assertEqual(delta['tickets'], [[str(live.id), 'IN_USE', 'S0', 'S3', None]])
+
+        apply_scan(live.id, self.stations[3].id, 'EXIT')
+        delta = self.feed(self.stations[3], since=delta['cursor'])
+        self.assertEqual((delta['tickets'], delta['revoked']), ([], [str(live.id)]))
+
+    def test_delta_pages_resume_from_cursor(self):
+        cursor = self.feed(self.stations[0])['cursor']
+        created = {str(self.ticket().id) for _ in range(5)}
+
+        seen = set()
+        while True:
+            page = self.feed(self.stations[0], since=cursor, limit=2)
+            self.assertLessEqual(len(page['tickets']), 2)
+            seen.update(row[0] for row in page['tickets'])
+            cursor = page['cursor']
+            if not page['more']:
+                break
+        self.assertEqual(seen, created)
+
+    def test_snapshot_is_paged_up_to_its_first_cutoff(self):
+        live = {str(self.ticket().id) for _ in range(5)}
+        self.ticket(status='USED')
+
+        page = self.feed(self.stations[0], limit=2)
+        late = self.ticket()
+        seen, pages = set(), 0
+        while True:
+            pages += 1
+            self.assertLessEqual(len(page['tickets']), 2)
+            self.assertEqual(page['revoked'], [])
+            seen.update(row[0] for row in page['tickets'])
+            if not page['more']:
+                break
+            page = self.feed(self.stations[0], since=page['cursor'], limit=2)
+        self.assertEqual((seen, pages), (live, 3))
+
+        delta = self.feed(self.stations[0], since=page['cursor'])
+        self.assertEqual([row[0] for row in delta['tickets']], [str(late.id)])
+
+    def test_station_unknown_to_the_engine_is_looked_up(self):
+        get_routing_engine()
+        with mock.patch('metro.signals.bump_topology_version'):
+            # Added through another worker; this one has not noticed yet.
+            extra = Station.objects.create(code='X', name='Extra')
+            ticket = Ticket.objects.create(source=self.stations[0], destination=extra)
+            feed = self.feed(self.stations[0])
+        self.assertEqual(feed['tickets'], [[str(ticket.id), 'ACTIVE', 'S0', 'X', None]])
+
+    def test_bad_cursor_is_rejected(self):
+        for since in ('nope', 'snapshot:nope', 'snapshot:1.2'):
+            response = self.client.get(reverse('metro_gate_ticket_feed', args=['S0']), {'since': since})
+            self.assertEqual(response.status_code, 400, since)
+
+
+class TicketTokenTests(TestCase):
+    def setUp(self):
+        build_network(self)
+        self.keys = tempfile.TemporaryDirectory()
+        self.addCleanup(self.keys.cleanup)
+        self.settings_override = override_settings(METRO_TICKET_KEY_DIR=self.keys.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        generate_key(self.keys.name, 'k1')
+
+        self.user = User.objects.create_user('rider', email='rider@example.com', password='pw')
+        credit(self.user.profile, Decimal('500.00'))
+        self.client.force_login(self.user)
+
+    def buy(self):
+        self.client.post(reverse('metro_ticket_buy'), {
+            'source': self.stations[2].id,
+            'destination': self.stations[5].id,
+        })
+        otp = PurchaseOTP.objects.latest('created_at')
+        self.client.post(reverse('metro_ticket_buy_verify_otp'), {'code': otp.code})
+        return Ticket.objects.latest('created_at')
+
+    def gate_keys(self):
+        """
+        Keys as a gate would hold them after fetching the JWKS endpoint.
+        """
+        import jwt
+
+        jwks = self.client.get(reverse('metro_ticket_keys')).json()
+        return {key['kid']: jwt.PyJWK(key).key for key in jwks['keys']}
+
+    def test_purchase_issues_a_token_gates_verify_offline(self):
+        ticket = self.buy()
+        keys = self.gate_keys()
+
+        with self.assertNumQueries(0):
+            entry = check_token_at_gate(ticket.token, 'S2', 'ENTRY', keys)
+        self.assertEqual(entry, {'ok': True, 'verdict': 'OK', 'ticket_id': str(ticket.id)})
+        self.assertEqual(check_token_at_gate(ticket.token, 'S4', 'EXIT', keys)['verdict'], 'WRONG_STATION')
+        self.assertEqual(check_token_at_gate(ticket.token[:-4] + 'AAAA', 'S2', 'ENTRY', keys)['verdict'], 'BAD_TOKEN')
+
+    def test_rotated_key_keeps_verifying_old_tickets(self):
+        old = self.buy()
+        generate_key(self.keys.name, 'k2')
+        retire_key(self.keys.name, 'k1')
+        new = self.buy()
+        keys = self.gate_keys()
+
+        self.assertEqual(sorted(keys), ['k1', 'k2'])
+        self.assertTrue(check_token_at_gate(old.token, 'S2', 'ENTRY', keys)['ok'])
+        self.assertTrue(check_token_at_gate(new.token, 'S2', 'ENTRY', keys)['ok'])
+
+    def test_expired_token_is_rejected(self):
+        ticket = self.buy()
+        ticket.expires_at = timezone.now() - timedelta(minutes=1)
+        ticket.token = issue_token(ticket)
+        self.assertEqual(check_token_at_gate(ticket.token, 'S2', 'ENTRY', self.gate_keys())['verdict'], 'EXPIRED')
+
+
+class WalletTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('rider', email='rider@example.com', password='pw')
+        self.profile = self.user.profile
+
+    def balance(self):
+        self.profile.refresh_from_db()
+        return self.profile.balance
+
+    def test_stale_instances_do_not_lose_updates(self):
+        other = User.objects.get(pk=self.user.pk).profile
+        credit(self.profile, Decimal('10.00'))
+        credit(other, Decimal('5.00'))
+        debit(other, Decimal('3.00'))
+        # Saving a profile loaded before those changes leaves the balance alone.
+        other.phone = '555'
+        other.save()
+        self.user.save()
+        self.assertEqual(self.balance(), Decimal('12.00'))
+        self.assertEqual(list(mismatched_wallets()), [])
+
+    def test_debit_is_refused_without_funds(self):
+        credit(self.profile, Decimal('4.00'))
+        with self.assertRaises(InsufficientBalance):
+            debit(self.profile, Decimal('4.01'))
+        debit(self.profile, Decimal('4.00'))
+        self.assertEqual(self.balance(), Decimal('0.00'))
+        self.assertEqual(self.profile.transactions.count(), 2)
+
+    def test_topup_view_books_the_ledger(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('metro_wallet_add'), {'amount': '25.00'})
+        self.assertEqual(self.balance(), Decimal('25.00'))
+        self.assertEqual(list(self.profile.transactions.values_list('amount', flat=True)), [Decimal('25.00')])
+
+    def test_reconcile_reports_and_fixes_drift(self):
+        credit(self.profile, Decimal('8.00'))
+        type(self.profile).objects.filter(pk=self.profile.pk).update(balance=Decimal('80.00'))
+        out = open(os.devnull, 'w')
+        with self.assertRaises(CommandError):
+            call_command('reconcile_wallets', stdout=out)
+        call_command('reconcile_wallets', '--fix', stdout=out)
+        self.assertEqual(self.balance(), Decimal('8.00'))
+        call_command('reconcile_wallets', stdout=out)
+
+
+class WalletStatementTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('rider', password='pw')
+        self.client.force_login(self.user)
+        profile = self.user.profile
+        this_month = timezone.localtime().replace(day=15, hour=12)
+        last_month = (this_month.replace(day=1) - timedelta(days=1)).replace(day=15)
+        WalletTransaction.objects.bulk_create(
+            [WalletTransaction(passenger=profile, amount=Decimal('10.00')) for _ in range(30)]
+            + [WalletTransaction(passenger=profile, amount=Decimal('-4.00')) for _ in range(30)]
+        )
+        entries = WalletTransaction.objects.order_by('id').values_list('pk', flat=True)
+        # Half last month, and a run of identical timestamps so the id tie-break matters.
+        WalletTransaction.objects.filter(pk__in=list(entries[:20]) + list(entries[30:40])).update(created_at=last_month)
+        WalletTransaction.objects.filter(pk__in=list(entries[20:30]) + list(entries[40:])).update(created_at=this_month)
+
+    def test_pages_cover_statement_once_with_constant_queries(self):
+        seen = []
+        before = None
+        query_counts = set()
+        while True:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('metro_wallet_statement'), {'before': before} if before else {})
+            query_counts.add(len(queries.captured_queries))
+            seen.extend(entry.id for entry in response.context['entries'])
+            before = response.context['next_cursor']
+            if not before:
+                break
+
+        expected = list(WalletTransaction.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(query_counts), 1)
+
+        months = response.context['months']
+        self.assertEqual([(m['credits'], m['debits'], m['entries']) for m in months], [
+            (Decimal('100.00'), Decimal('80.00'), 30),
+            (Decimal('200.00'), Decimal('40.00'), 30),
+        ])
+
+    def test_bad_cursor_redirects_to_first_page(self):
+        response = self.client.get(reverse('metro_wallet_statement'), {'before': '12.notanid'})
+        self.assertRedirects(response, reverse('metro_wallet_statement'))
+
+    def test_admin_changelist_does_not_query_per_row(self):
+        self.client.force_login(User.objects.create_superuser('admin', password='pw'))
+        url = reverse('admin:metro_wallettransaction_changelist')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertLess(len(queries.captured_queries), 10)
+
+
+@skipUnless(connection.vendor == 'postgresql', "SQLite serialises writers, so there is no race to test.")
+class WalletConcurrencyTests(TransactionTestCase):
+    def test_no_lost_updates_under_concurrency(self):
+        call_command('stress_wallet', threads=8, operations=100)
+
+
+@skipUnless(connection.vendor == 'postgresql', "Scan partitions exist on PostgreSQL only.")
+class ScanPartitionTests(TransactionTestCase):
+    """
+    The raw SQL behind migration 0013 and metro.archive, against the test
+    database's partitioned metro_ticketscan.
+    """
+
+    def setUp(self):
+        build_network(self, stations=4)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(METRO_ARCHIVE_DIR=directory.name))
+
+    def execute(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def scalar(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0]
+
+    def partition_exists(self, month):
+        return self.scalar("SELECT to_regclass(%s) IS NOT NULL", [partition_name(month)])
+
+    def drop_partition_later(self, month):
+        self.addCleanup(self.execute, f"DROP TABLE IF EXISTS {partition_name(month)}")
+
+    def scan(self, scanned_at):
+        ticket = Ticket.objects.create(source=self.stations[0], destination=self.stations[3], status='USED')
+        return TicketScan.objects.create(ticket=ticket, station=self.stations[0], direction='ENTRY',
+                                         scanned_at=scanned_at)
+
+    def test_migration_partitions_the_scan_table(self):
+        self.assertTrue(is_partitioned())
+        self.assertTrue(self.partition_exists(month_start()))
+        self.assertTrue(self.partition_exists(add_months(month_start(), 2)))
+        primary_key = self.scalar(
+            "SELECT array_agg(a.attname::text ORDER BY a.attname) FROM pg_index i "
+            "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+            "WHERE i.indrelid = 'metro_ticketscan'::regclass AND i.indisprimary")
+        self.assertEqual(primary_key, ['id', 'scanned_at'])
+        self.assertFalse(self.scalar("SELECT to_regclass('uniq_ticketscan_gate_seq') IS NOT NULL"))
+
+    def test_partition_for_a_month_with_rows_in_the_default_partition(self):
+        month = add_months(month_start(), 5)
+        self.drop_partition_later(month)
+        self.scan(month + timedelta(days=3))
+        self.assertEqual(self.scalar("SELECT count(*) FROM metro_ticketscan_default"), 1)
+
+        self.assertEqual(ensure_scan_partitions(months_ahead=0, now=month + timedelta(days=3)),
+                         [partition_name(month)])
+
+        self.assertEqual(self.scalar("SELECT count(*) FROM metro_ticketscan_default"), 0)
+        self.assertEqual(self.scalar(f"SELECT count(*) FROM {partition_name(month)}"), 1)
+        self.assertEqual(TicketScan.objects.count(), 1)
+
+    def test_maintenance_creates_missing_partitions(self):
+        month = add_months(month_start(), 2)
+        self.execute(f"DROP TABLE {partition_name(month)}")
+        self.assertFalse(self.partition_exists(month))
+
+        call_command('run_maintenance', once=True, stdout=open(os.devnull, 'w'))
+
+        self.assertTrue(self.partition_exists(month))
+
+    def test_archiving_a_month_drops_its_partition(self):
+        month = add_months(month_start(), -8)
+        self.drop_partition_later(month)
+        self.assertEqual(ensure_scan_partitions(months_ahead=0, now=month), [partition_name(month)])
+        scan = self.scan(month + timedelta(days=3))
+
+        self.assertEqual(archive_month('scans', month), 1)
+
+        self.assertFalse(self.partition_exists(month))
+        self.assertFalse(TicketScan.objects.exists())
+        self.assertEqual([row['id'] for row in read_archive('scans', month)], [str(scan.id)])
+
+    def test_concurrent_uploads_of_one_seq_record_it_once(self):
+        import threading
+
+        tickets = [Ticket.objects.create(source=self.stations[0], destination=self.stations[3]) for _ in range(2)]
+        get_routing_engine()
+        barrier = threading.Barrier(2)
+        results = []
+
+        def upload(ticket):
+            try:
+                barrier.wait()
+                results.append(apply_offline_scans('G-9', [{
+                    'seq': 1, 'ticket_id': str(ticket.id), 'station': 'S0', 'direction': 'ENTRY',
+                    'scanned_at': timezone.now().isoformat(),
+                }]))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=upload, args=(ticket,)) for ticket in tickets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted((r['applied'], r['duplicates']) for r in results), [(0, 1), (1, 0)])
+        self.assertEqual(TicketScan.objects.filter(gate_id='G-9').count(), 1)
+        self.assertEqual(GateScanSeq.objects.filter(gate_id='G-9').count(), 1)
+
+
+class ImportTimeTests(SimpleTestCase):
+    """
+    Boot cost of a gunicorn worker, measured with python -X importtime.
+    """
+    BUDGET_MS = 1500
+    HEAVY_MODULES = ('matplotlib', 'networkx', 'numpy', 'PIL', 'jwt', 'cryptography')
+    LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)')
+
+    def importtime_report(self):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import mysite.wsgi; from django.urls import get_resolver; get_resolver().url_patterns'],
+            cwd=settings.BASE_DIR, env=os.environ.copy(), capture_output=True, text=True, check=True,
+        )
+        modules = {}
+        for match in self.LINE.finditer(result.stderr):
+            modules[match.group(4)] = int(match.group(2)) / 1000
+        return modules
+
+    def format_report(self, modules, top=15):
+        slowest = sorted(modules.items(), key=lambda item: item[1], reverse=True)[:top]
+        return "\n".join(f"{ms:9.1f} ms  {name}" for name, ms in slowest)
+
+    def test_wsgi_import_skips_heavy_libraries_and_fits_budget(self):
+        modules = self.importtime_report()
+        report = self.format_report(modules)
+
+        heavy = sorted({name.split('.')[0] for name in modules} & set(self.HEAVY_MODULES))
+        self.assertFalse(heavy, f"{', '.join(heavy)} imported at boot:\n{report}")
+        self.assertLess(
+            modules['mysite.wsgi'], self.BUDGET_MS,
+            f"mysite.wsgi import took {modules['mysite.wsgi']:.0f} ms:\n{report}",
+        )
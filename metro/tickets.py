@@ -0,0 +1,107 @@
+"""
+Ticket expiry and history paging.
+
+Overdue tickets are flipped to EXPIRED in bulk by the expire_tickets
+command; until that runs, reads derive the status a ticket should have
+from expires_at instead of writing it back.
+"""
+import uuid
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db.models import Case, CharField, F, Q, Value, When
+from django.utils import timezone
+
+from .models import LIVE_TICKET, Ticket
+
+LIVE_STATUSES = ('ACTIVE', 'IN_USE')
+HISTORY_PAGE_SIZE = 25
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def _micros(moment):
+    return (moment - _EPOCH) // timedelta(microseconds=1)
+
+
+def encode_cursor(moment, pk):
+    """
+    Opaque keyset cursor for a (timestamp, id) position; pk is a ticket's
+    UUID or an integer id.
+    """
+    return f"{_micros(moment)}.{getattr(pk, 'hex', pk)}"
+
+
+def decode_cursor(cursor, parse_pk=lambda text: uuid.UUID(hex=text)):
+    """
+    Inverse of encode_cursor(), parse_pk turning the id back into a key
+    (int for integer ids); raises ValueError for a malformed cursor.
+    """
+    micros, _, pk = str(cursor).partition('.')
+    try:
+        moment = _EPOCH + timedelta(microseconds=int(micros))
+    except OverflowError:
+        raise ValueError(cursor)
+    return moment, parse_pk(pk)
+
+
+def overdue(now=None):
+    """
+    Q for live tickets whose expiry has passed.
+    """
+    return LIVE_TICKET & Q(expires_at__lte=now or timezone.now())
+
+
+def with_effective_status(queryset, now=None):
+    """
+    Annotate effective_status: EXPIRED for overdue tickets, else status.
+    """
+    return queryset.annotate(effective_status=Case(
+        When(overdue(now), then=Value('EXPIRED')),
+        default=F('status'),
+        output_field=CharField(),
+    ))
+
+
+def expire_overdue_tickets(batch_size=1000, now=None):
+    """
+    Mark every overdue ticket EXPIRED, batch_size rows per UPDATE so no
+    statement holds locks on a large part of the table. Each batch commits
+    on its own. Returns the number of tickets expired.
+    """
+    now = now or timezone.now()
+    total = 0
+    while True:
+        batch = Ticket.objects.filter(overdue(now)).order_by('expires_at').values('pk')[:batch_size]
+        updated = (Ticket.objects
+                   .filter(overdue(now), pk__in=batch)
+                   .update(status='EXPIRED', updated_at=now))
+        total += updated
+        if updated < batch_size:
+            return total
+
+
+def ticket_history_page(passenger, before=None, size=HISTORY_PAGE_SIZE):
+    """
+    One page of a passenger's tickets, newest first, with stations joined
+    and effective_status annotated. before is the cursor of the previous
+    page's last ticket. Returns (tickets, cursor for the next page or None).
+
+    Served by the (passenger, created_at, id) index: the query seeks to the
+    cursor and reads size + 1 entries, however long the history is.
+    """
+    tickets = (Ticket.objects
+               .filter(passenger=passenger)
+               .select_related('source', 'destination')
+               .order_by('-created_at', '-id'))
+    if before:
+        created_at, ticket_id = decode_cursor(before)
+        # The plain created_at bound gives the planner an index range to seek
+        # into; the OR then settles ties on the cursor's timestamp.
+        tickets = tickets.filter(created_at__lte=created_at).filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=ticket_id)
+        )
+
+    tickets = list(with_effective_status(tickets)[:size + 1])
+    if len(tickets) <= size:
+        return tickets, None
+    tickets = tickets[:size]
+    return tickets, encode_cursor(tickets[-1].created_at, tickets[-1].id)
@@ -0,0 +1,206 @@
+"""
+Signed ticket tokens that gates can check offline with a public key.
+
+Tokens are ES256 JWTs carrying the ticket id, source and destination codes
+and expiry. Signing keys are PEM files in METRO_TICKET_KEY_DIR named
+<kid>.pem; the kid goes in the token header so gates pick the matching
+public key. To rotate, add a new key (manage.py generate_ticket_key) and
+keep the old one until every ticket it signed has expired; retiring a key
+replaces <kid>.pem with <kid>.pub.pem, which can still verify but not sign.
+"""
+import os
+from pathlib import Path
+
+from django.conf import settings
+from django.utils import timezone
+
+# PyJWT and cryptography take ~100 ms to import, so they are imported in the
+# functions that sign or verify rather than when metro.views loads.
+
+ALGORITHM = 'ES256'
+PUBLIC_SUFFIX = '.pub.pem'
+
+
+class TicketTokenError(Exception):
+    pass
+
+
+class TicketTokenExpired(TicketTokenError):
+    pass
+
+
+def key_dir():
+    directory = getattr(settings, 'METRO_TICKET_KEY_DIR', None)
+    return Path(directory) if directory else None
+
+
+_keyring = {}
+
+
+def _load_keys():
+    """
+    Return (signing_keys, public_keys), both {kid: key}, re-reading the key
+    directory only when a file in it has been added, removed or changed.
+    """
+    directory = key_dir()
+    if directory is None or not directory.is_dir():
+        return {}, {}
+
+    entries = sorted(
+        (entry.name, entry.stat().st_mtime_ns)
+        for entry in os.scandir(directory)
+        if entry.name.endswith('.pem')
+    )
+    signature = (str(directory), tuple(entries))
+    if _keyring.get('signature') == signature:
+        return _keyring['signing'], _keyring['public']
+
+    from cryptography.hazmat.primitives import serialization
+
+    signing, public = {}, {}
+    for name, _mtime in entries:
+        data = (directory / name).read_bytes()
+        if name.endswith(PUBLIC_SUFFIX):
+            public[name[:-len(PUBLIC_SUFFIX)]] = serialization.load_pem_public_key(data)
+        else:
+            kid = name[:-len('.pem')]
+            signing[kid] = serialization.load_pem_private_key(data, password=None)
+            public[kid] = signing[kid].public_key()
+
+    _keyring.update(signature=signature, signing=signing, public=public)
+    return signing, public
+
+
+def active_kid():
+    """
+    The kid new tickets are signed with: METRO_TICKET_SIGNING_KID if set,
+    otherwise the last signing key in name order (generated kids sort by
+    creation time). None when no signing key is configured.
+    """
+    signing, _public = _load_keys()
+    kid = getattr(settings, 'METRO_TICKET_SIGNING_KID', None)
+    if kid:
+        return kid if kid in signing else None
+    return max(signing) if signing else None
+
+
+def issue_token(ticket):
+    """
+    Signed token for ticket, or '' when ticket signing is not configured.
+    Only needs the ticket's id, stations and expiry, so it can be called
+    before the ticket is saved.
+    """
+    kid = active_kid()
+    if kid is None:
+        return ''
+    import jwt
+
+    signing, _public = _load_keys()
+
+    claims = {
+        'tid': str(ticket.id),
+        'src': ticket.source.code,
+        'dst': ticket.destination.code,
+        'iat': int(timezone.now().timestamp()),
+    }
+    if ticket.expires_at:
+        claims['exp'] = int(ticket.expires_at.timestamp())
+    return jwt.encode(claims, signing[kid], algorithm=ALGORITHM, headers={'kid': kid})
+
+
+def verify_token(token, public_keys=None):
+    """
+    Check a ticket token's signature and expiry and return its claims.
+    public_keys ({kid: key}) defaults to the server's keys; a gate passes
+    the set it fetched from the public key endpoint. Raises
+    TicketTokenError if the token cannot be trusted.
+    """
+    import jwt
+
+    if public_keys is None:
+        _signing, public_keys = _load_keys()
+    try:
+        kid = jwt.get_unverified_header(token).get('kid')
+        if kid not in public_keys:
+            raise TicketTokenError(f"Unknown signing key {kid!r}.")
+        return jwt.decode(
+            token, public_keys[kid], algorithms=[ALGORITHM],
+            options={'require': ['tid', 'src', 'dst', 'iat']},
+        )
+    except jwt.ExpiredSignatureError:
+        raise TicketTokenExpired("Ticket has expired.")
+    except jwt.InvalidTokenError as exc:
+        raise TicketTokenError(str(exc))
+
+
+def check_token_at_gate(token, station_code, direction, public_keys=None):
+    """
+    What a gate can decide without the database: whether the token is
+    genuine, unexpired, and valid for this station. Returns a verdict dict
+    like metro.gates.apply_scan(); the status transition itself is settled
+    when the gate uploads the scan.
+    """
+    try:
+        claims = verify_token(token, public_keys)
+    except TicketTokenExpired:
+        return {'ok': False, 'verdict': 'EXPIRED', 'ticket_id': None}
+    except TicketTokenError:
+        return {'ok': False, 'verdict': 'BAD_TOKEN', 'ticket_id': None}
+
+    expected = claims['src'] if direction == 'ENTRY' else claims['dst']
+    verdict = 'OK' if station_code == expected else 'WRONG_STATION'
+    return {'ok': verdict == 'OK', 'verdict': verdict, 'ticket_id': claims['tid']}
+
+
+def public_jwks():
+    """
+    Every verification key as a JSON Web Key Set, for distribution to gates.
+    """
+    import jwt
+
+    _signing, public = _load_keys()
+    keys = []
+    for kid, key in sorted(public.items()):
+        jwk = jwt.algorithms.ECAlgorithm.to_jwk(key, as_dict=True)
+        jwk.update(kid=kid, alg=ALGORITHM, use='sig')
+        keys.append(jwk)
+    return {'keys': keys}
+
+
+def generate_key(directory, kid):
+    """
+    Create a P-256 signing key as <directory>/<kid>.pem, readable by the
+    owner only, and return its path.
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{kid}.pem"
+    pem = ec.generate_private_key(ec.SECP256R1()).private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(pem)
+    return path
+
+
+def retire_key(directory, kid):
+    """
+    Keep only the public half of a signing key, so it verifies tickets it
+    already signed but signs no new ones.
+    """
+    from cryptography.hazmat.primitives import serialization
+
+    directory = Path(directory)
+    private_path = directory / f"{kid}.pem"
+    key = serialization.load_pem_private_key(private_path.read_bytes(), password=None)
+    (directory / f"{kid}{PUBLIC_SUFFIX}").write_bytes(key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    ))
+    private_path.unlink()
@@ -4,6 +4,7 @@ from . import views
 urlpatterns = [
     path('', views.dashboard_view, name='metro_dashboard'),
 
+    path('wallet/', views.wallet_statement_view, name='metro_wallet_statement'),
     path('wallet/add/', views.wallet_topup_view, name='metro_wallet_add'),
 
     path('tickets/', views.ticket_list_view, name='metro_ticket_list'),
@@ -13,9 +14,16 @@ urlpatterns = [
     path('scanner/scan/', views.scanner_scan_view, name='metro_scanner_scan'),
     path('scanner/offline-ticket/', views.scanner_offline_ticket_view, name='metro_scanner_offline'),
     path('footfall/', views.footfall_report_view, name='metro_footfall'),
+    path('footfall/export/<str:dataset>/', views.export_view, name='metro_export'),
 
     path('map/', views.metro_map_view, name='metro_map_page'),
     path('map/image/', views.metro_map_image, name='metro_map_image'),
+    path('map/network.json', views.metro_map_data, name='metro_map_data'),
     path('tickets/buy/verify-otp/', views.ticket_purchase_otp_view, name='metro_ticket_buy_verify_otp'),
+    path('api/quotes/', views.route_quotes_api, name='metro_route_quotes'),
+    path('api/gate/scan/', views.gate_scan_api, name='metro_gate_scan'),
+    path('api/gate/scans/', views.gate_scan_upload_api, name='metro_gate_scan_upload'),
+    path('api/gate/keys/', views.ticket_keys_api, name='metro_ticket_keys'),
+    path('api/gate/stations/<str:station_code>/tickets/', views.gate_ticket_feed_api, name='metro_gate_ticket_feed'),
 
 ]
@@ -1,45 +1,49 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.db.models import Count
-from django.db.models.functions import TruncDate
 from django.contrib.admin.views.decorators import staff_member_required
 
-from django import forms
-
 import random
+from django.db import transaction
 from datetime import timedelta
 from django.utils import timezone
 from django.core.mail import send_mail
 from django.conf import settings
 
-from .models import Ticket, WalletTransaction, MetroLine, Station, TicketScan, Connection, PurchaseOTP
-from .forms import WalletTopupForm, TicketPurchaseForm, OfflineTicketForm, OTPVerifyForm
-from .services import shortest_path_between_stations, calculate_price_from_path
-
-import io
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.lines as mlines
-import networkx as nx
-from django.http import HttpResponse
+from .models import Ticket, TicketScan, PurchaseOTP
+from .forms import (
+    WalletTopupForm, TicketPurchaseForm, OfflineTicketForm, OTPVerifyForm, TicketScanForm, FootfallFilterForm,
+    ExportFilterForm,
+)
+from . import exports, maps
+from .gates import TRANSITIONS, apply_offline_scans, apply_scan, check_gate_id, station_ticket_feed
+from .footfall import day_range, footfall_rows, record_scans
+from .registry import get_registry
+from .tickets import ticket_history_page, with_effective_status
+from .tokens import issue_token, public_jwks
+from .wallet import InsufficientBalance, credit, debit, monthly_totals, statement_page
+from .services import (
+    get_route_quote, get_routing_engine, quote_pairs, current_map_version, topology_updated_at,
+)
+
+import json
+from functools import wraps
+from django.core.exceptions import ValidationError
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.cache import patch_cache_control
+from django.middleware.csrf import CsrfViewMiddleware
+from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
+from django.views.decorators.http import condition, require_GET, require_POST
 
 
 def scanner_check(user):
     return user.is_active and user.is_staff
 
 
-class TicketScanForm(forms.Form):
-    ticket_id = forms.CharField(label="Ticket ID")
-    station = forms.ModelChoiceField(queryset=Station.objects.all())
-    direction = forms.ChoiceField(choices=TicketScan.DIRECTION_CHOICES)
-
-
 @login_required
 def dashboard_view(request):
     profile = request.user.profile
-    recent_tickets = profile.tickets.order_by('-created_at')[:5]
+    recent_tickets, _ = ticket_history_page(profile, size=5)
 
     context = {
         'balance': profile.balance,
@@ -55,15 +59,7 @@ def wallet_topup_view(request):
     if request.method == 'POST':
         form = WalletTopupForm(request.POST)
         if form.is_valid():
-            amount = form.cleaned_data['amount']
-            profile.balance += amount
-            profile.save()
-
-            WalletTransaction.objects.create(
-                passenger=profile,
-                amount=amount,
-                description='Wallet top-up'
-            )
+            credit(profile, form.cleaned_data['amount'], 'Wallet top-up')
             return redirect('metro_dashboard')
     else:
         form = WalletTopupForm()
@@ -71,33 +67,52 @@ def wallet_topup_view(request):
     return render(request, 'metro/wallet_add.html', {'form': form})
 
 
+@login_required
+def wallet_statement_view(request):
+    profile = request.user.profile
+    before = request.GET.get('before')
+    try:
+        entries, next_cursor = statement_page(profile, before=before)
+    except ValueError:
+        return redirect('metro_wallet_statement')
+    return render(request, 'metro/wallet_statement.html', {
+        'balance': profile.balance,
+        'entries': entries,
+        'months': monthly_totals(profile),
+        'next_cursor': next_cursor,
+        'is_first_page': not before,
+    })
+
+
 @login_required
 def ticket_list_view(request):
     profile = request.user.profile
-    tickets = profile.tickets.order_by('-created_at')
-    for t in tickets:
-        if t.status in ('ACTIVE', 'IN_USE') and t.is_expired():
-            t.status = 'EXPIRED'
-            t.save()
-    return render(request, 'metro/ticket_list.html', {'tickets': tickets})
+    before = request.GET.get('before')
+    try:
+        tickets, next_cursor = ticket_history_page(profile, before=before)
+    except ValueError:
+        return redirect('metro_ticket_list')
+    return render(request, 'metro/ticket_list.html', {
+        'tickets': tickets,
+        'next_cursor': next_cursor,
+        'is_first_page': not before,
+    })
 
 
 @login_required
 def ticket_detail_view(request, ticket_id):
     profile = request.user.profile
-    ticket = get_object_or_404(Ticket, id=ticket_id, passenger=profile)
-    if ticket.status in ('ACTIVE', 'IN_USE') and ticket.is_expired():
-        ticket.status = 'EXPIRED'
-        ticket.save()
+    ticket = get_object_or_404(
+        with_effective_status(Ticket.objects.select_related('source', 'destination')),
+        id=ticket_id, passenger=profile,
+    )
     return render(request, 'metro/ticket_detail.html', {'ticket': ticket})
 
 
 @login_required
 def ticket_purchase_view(request):
     profile = request.user.profile
-    has_active_line = MetroLine.objects.filter(
-        is_enabled=True,
-    ).exists()
+    has_active_line = get_registry().has_enabled_line
 
     if not has_active_line:
         return render(request, 'metro/ticket_buy.html', {
@@ -116,43 +131,23 @@ def ticket_purchase_view(request):
             source = form.cleaned_data['source']
             destination = form.cleaned_data['destination']
 
-            path_ids = shortest_path_between_stations(
-                source, destination, only_enabled=True
-            )
-            if not path_ids:
+            quote = get_route_quote(source, destination)
+            if not quote:
                 return render(request, 'metro/ticket_buy.html', {
                     'form': form,
                     'error': "No path found between selected stations."
                 })
 
-            price = calculate_price_from_path(path_ids)
+            price = quote['price']
             if profile.balance < price:
                 return render(request, 'metro/ticket_buy.html', {
                     'form': form,
                     'error': f"Insufficient balance. Ticket costs ₹{price}, your balance is ₹{profile.balance}."
                 })
 
-            path_repr = "-".join(Station.objects.get(id=sid).code for sid in path_ids)
-
-            lines_in_order = []
-            if len(path_ids) > 1:
-                for i in range(len(path_ids) - 1):
-                    a = Station.objects.get(id=path_ids[i])
-                    b = Station.objects.get(id=path_ids[i + 1])
-                    conn = (
-                        Connection.objects.filter(from_station=a, to_station=b)
-                        .select_related('line')
-                        .first()
-                        or Connection.objects.filter(from_station=b, to_station=a)
-                        .select_related('line')
-                        .first()
-                    )
-                    if conn and conn.line:
-                        ln = conn.line.name
-                        if ln not in lines_in_order:
-                            lines_in_order.append(ln)
-
-            lines_used_str = ", ".join(lines_in_order)
+            path_ids = quote['path_ids']
+            path_repr = quote['path_repr']
+            lines_used_str = quote['lines_used']
 
             code = f"{random.randint(0, 999999):06d}"
             PurchaseOTP.objects.create(
@@ -185,6 +180,34 @@ def ticket_purchase_view(request):
 
     return render(request, 'metro/ticket_buy.html', {'form': form})
 
+
+# Exempt on purpose: public, needs no session and changes nothing.
+@csrf_exempt
+@require_POST
+def route_quotes_api(request):
+    """
+    Batch fare quotes for kiosks and journey planners.
+    Body: {"pairs": [["S1", "S5"], ...]} using station codes.
+    """
+    try:
+        pairs = json.loads(request.body)['pairs']
+        if not isinstance(pairs, list) or not all(isinstance(pair, list) and len(pair) == 2 for pair in pairs):
+            raise ValueError(pairs)
+        pairs = [(str(src), str(dest)) for src, dest in pairs]
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': "Expected {\"pairs\": [[source_code, destination_code], ...]}."}, status=400)
+
+    limit = settings.METRO_QUOTE_BATCH_LIMIT
+    if len(pairs) > limit:
+        return JsonResponse({'error': f"At most {limit} pairs per request."}, status=400)
+
+    quotes = quote_pairs(pairs)
+    for quote in quotes:
+        if 'price' in quote:
+            quote['price'] = str(quote['price'])
+    return JsonResponse({'quotes': quotes})
+
+
 @login_required
 def ticket_purchase_otp_view(request):
     profile = request.user.profile
@@ -302,27 +325,19 @@ def ticket_purchase_otp_view(request):
         from decimal import Decimal
         price = Decimal(otp.payload['price'])
 
-        if profile.balance < price:
+        registry = get_registry()
+        source = registry.station(otp.payload['source_id'])
+        destination = registry.station(otp.payload['destination_id'])
+        if source is None or destination is None:
             return render(request, 'metro/ticket_buy_otp.html', {
                 'form': form,
-                'error': "Insufficient balance at verification time."
+                'error': "One of the selected stations no longer exists. Please start a new purchase."
             })
-
-        source = Station.objects.get(id=otp.payload['source_id'])
-        destination = Station.objects.get(id=otp.payload['destination_id'])
         path_repr = otp.payload['path_repr']
         lines_used_str = otp.payload['lines_used']
 
-        profile.balance -= price
-        profile.save()
-        WalletTransaction.objects.create(
-            passenger=profile,
-            amount=-price,
-            description=f'Ticket purchase {source.code}->{destination.code}'
-        )
-
         expiry = timezone.now() + timedelta(days=1)
-        ticket = Ticket.objects.create(
+        ticket = Ticket(
             passenger=profile,
             source=source,
             destination=destination,
@@ -331,6 +346,16 @@ def ticket_purchase_otp_view(request):
             lines_used=lines_used_str,
             expires_at=expiry,
         )
+        ticket.token = issue_token(ticket)
+        try:
+            with transaction.atomic():
+                debit(profile, price, f'Ticket purchase {source.code}->{destination.code}')
+                ticket.save(force_insert=True)
+        except InsufficientBalance:
+            return render(request, 'metro/ticket_buy_otp.html', {
+                'form': form,
+                'error': "Insufficient balance at verification time."
+            })
 
         send_mail(
             subject="Metro Ticket Purchased",
@@ -356,54 +381,146 @@ def scanner_scan_view(request):
             station = form.cleaned_data['station']
             direction = form.cleaned_data['direction']
 
-            ticket = get_object_or_404(Ticket, id=ticket_id)
-
-            if ticket.status in ('USED', 'EXPIRED'):
-                message = f"Cannot scan. Ticket status is {ticket.status}."
-                return render(request, 'metro/scanner_scan.html', {'form': form, 'message': message})
-
-            if direction == 'ENTRY':
-                if ticket.status != 'ACTIVE':
-                    message = f"ENTRY denied. Ticket status is {ticket.status}, expected ACTIVE."
-                elif station.id != ticket.source_id:
-                    message = (
-                        f"ENTRY denied at {station.name}. "
-                        f"Ticket source is {ticket.source.name}."
-                    )
-                else:
-                    ticket.status = 'IN_USE'
-                    ticket.save()
-                    TicketScan.objects.create(
-                        ticket=ticket,
-                        station=station,
-                        direction='ENTRY',
-                        scanned_by=request.user,
-                    )
-                    message = "Entry scan successful. Ticket is now IN_USE."
-            else: 
-                if ticket.status != 'IN_USE':
-                    message = f"EXIT denied. Ticket status is {ticket.status}, expected IN_USE."
-                elif station.id != ticket.destination_id:
-                    message = (
-                        f"EXIT denied at {station.name}. "
-                        f"Ticket destination is {ticket.destination.name}."
-                    )
-                else:
-                    ticket.status = 'USED'
-                    ticket.save()
-                    TicketScan.objects.create(
-                        ticket=ticket,
-                        station=station,
-                        direction='EXIT',
-                        scanned_by=request.user,
-                    )
-                    message = "Exit scan successful. Ticket is now USED."
+            result = apply_scan(ticket_id, station.id, direction, user=request.user)
+            ticket = result.get('ticket')
+            verdict = result['verdict']
+
+            if verdict == 'OK' and direction == 'ENTRY':
+                message = "Entry scan successful. Ticket is now IN_USE."
+            elif verdict == 'OK':
+                message = "Exit scan successful. Ticket is now USED."
+            elif verdict == 'NOT_FOUND':
+                raise Http404("No Ticket matches the given query.")
+            elif verdict in ('USED', 'EXPIRED'):
+                message = f"Cannot scan. Ticket status is {result['status']}."
+            elif verdict == 'WRONG_STATUS':
+                expected = TRANSITIONS[direction][0]
+                message = f"{direction} denied. Ticket status is {ticket.status}, expected {expected}."
+            elif direction == 'ENTRY':
+                message = (
+                    f"ENTRY denied at {station.name}. "
+                    f"Ticket source is {ticket.source.name}."
+                )
+            else:
+                message = (
+                    f"EXIT denied at {station.name}. "
+                    f"Ticket destination is {ticket.destination.name}."
+                )
     else:
         form = TicketScanForm()
 
     return render(request, 'metro/scanner_scan.html', {'form': form, 'message': message})
 
 
+_csrf_check = CsrfViewMiddleware(lambda request: None)
+
+
+def gate_api(view):
+    """
+    Staff-only JSON endpoint: answers 403 as JSON instead of redirecting
+    to the login page or rendering Django's CSRF page, since callers are
+    gate devices.
+
+    Gates sign in as a staff user and keep the session cookie. The ticket
+    feed sets the csrftoken cookie; POSTs send its value back in the
+    X-CSRFToken header (over HTTPS, with an Origin or Referer header from
+    a trusted origin too). A missing or wrong token gets CSRF_FAILED.
+    """
+    @csrf_exempt
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if not scanner_check(request.user):
+            return JsonResponse({'ok': False, 'verdict': 'FORBIDDEN'}, status=403)
+        if _csrf_check.process_view(request, None, (), {}) is not None:
+            return JsonResponse({'ok': False, 'verdict': 'CSRF_FAILED'}, status=403)
+        return view(request, *args, **kwargs)
+    return wrapped
+
+
+@require_POST
+@gate_api
+def gate_scan_api(request):
+    """
+    Turnstile tap. Body: {"ticket_id": "...", "station": "<code>", "direction": "ENTRY"|"EXIT"}.
+    Returns {"ok": bool, "verdict": "...", "status": "..."}.
+    """
+    try:
+        body = json.loads(request.body)
+        ticket_id = str(body['ticket_id'])
+        station_code = str(body['station'])
+        direction = body['direction']
+        if direction not in TRANSITIONS:
+            raise ValueError(direction)
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'ok': False, 'verdict': 'BAD_REQUEST'}, status=400)
+
+    station_id = get_routing_engine().id_for_code(station_code)
+    if station_id is None:
+        return JsonResponse({'ok': False, 'verdict': 'UNKNOWN_STATION'}, status=400)
+
+    result = apply_scan(ticket_id, station_id, direction, user=request.user)
+    return JsonResponse({'ok': result['ok'], 'verdict': result['verdict'], 'status': result['status']})
+
+
+@require_POST
+@gate_api
+def gate_scan_upload_api(request):
+    """
+    Scans buffered by a gate while offline.
+    Body: {"gate_id": "...", "scans": [{"seq": 1, "ticket_id": "...", "station": "<code>",
+    "direction": "ENTRY", "scanned_at": "2026-01-01T08:00:00+05:30"}, ...]}.
+    Safe to retry: seqs the gate already uploaded are counted as duplicates.
+    """
+    try:
+        body = json.loads(request.body)
+        gate_id = check_gate_id(body['gate_id'])
+        scans = body['scans']
+        if not isinstance(scans, list):
+            raise ValueError(body)
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'ok': False, 'error': "Expected {\"gate_id\": ..., \"scans\": [...]}."}, status=400)
+
+    limit = settings.METRO_GATE_UPLOAD_LIMIT
+    if len(scans) > limit:
+        return JsonResponse({'ok': False, 'error': f"At most {limit} scans per upload."}, status=400)
+
+    result = apply_offline_scans(gate_id, scans, user=request.user)
+    return JsonResponse({'ok': True, **result})
+
+
+@require_GET
+@ensure_csrf_cookie
+@gate_api
+def gate_ticket_feed_api(request, station_code):
+    """
+    Live tickets for a station's gates. Call without ?since= to start a
+    snapshot and keep passing back the returned cursor: while "more" is
+    true it pages through the snapshot, then it returns only changes.
+    """
+    station_id = get_routing_engine().id_for_code(station_code)
+    if station_id is None:
+        return JsonResponse({'ok': False, 'error': f"Unknown station {station_code}."}, status=404)
+
+    try:
+        limit = min(int(request.GET.get('limit') or settings.METRO_GATE_FEED_PAGE_SIZE),
+                    settings.METRO_GATE_FEED_PAGE_SIZE)
+        feed = station_ticket_feed(station_id, cursor=request.GET.get('since') or None, limit=max(limit, 1))
+    except ValueError:
+        return JsonResponse({'ok': False, 'error': "Invalid since cursor or limit."}, status=400)
+    return JsonResponse({'ok': True, 'station': station_code, **feed})
+
+
+@require_GET
+def ticket_keys_api(request):
+    """
+    Public keys for verifying ticket tokens, as a JSON Web Key Set.
+    Gates poll this so they keep verifying offline across key rotations.
+    """
+    response = JsonResponse(public_jwks())
+    patch_cache_control(response, public=True, max_age=300)
+    return response
+
+
 @staff_member_required
 def scanner_offline_ticket_view(request):
     message = None
@@ -415,32 +532,15 @@ def scanner_offline_ticket_view(request):
             source = form.cleaned_data['source']
             destination = form.cleaned_data['destination']
 
-            path_ids = shortest_path_between_stations(source, destination, only_enabled=True)
-            if not path_ids:
+            quote = get_route_quote(source, destination)
+            if not quote:
                 message = "No path found between selected stations."
             else:
-                price = calculate_price_from_path(path_ids)
-
-                path_repr = "-".join(Station.objects.get(id=sid).code for sid in path_ids)
-
-                lines_in_order = []
-                if len(path_ids) > 1:
-                    for i in range(len(path_ids) - 1):
-                        a = Station.objects.get(id=path_ids[i])
-                        b = Station.objects.get(id=path_ids[i+1])
-
-                        conn = Connection.objects.filter(from_station=a, to_station=b).select_related('line').first()
-                        if not conn:
-                            conn = Connection.objects.filter(from_station=b, to_station=a).select_related('line').first()
-
-                        if conn and conn.line:
-                            ln = conn.line.name
-                            if ln not in lines_in_order:
-                                lines_in_order.append(ln)
+                price = quote['price']
+                path_repr = quote['path_repr']
+                lines_used_str = quote['lines_used']
 
-                lines_used_str = ", ".join(lines_in_order)
-
-                ticket_obj = Ticket.objects.create(
+                ticket_obj = Ticket(
                     passenger=None,
                     source=source,
                     destination=destination,
@@ -450,18 +550,25 @@ def scanner_offline_ticket_view(request):
                     lines_used=lines_used_str,
                     expires_at=timezone.now() + timedelta(days=1), 
                 )
-                TicketScan.objects.create(
-                    ticket=ticket_obj,
-                    station=source,
-                    direction='ENTRY',
-                    scanned_by=request.user
-                )
-                TicketScan.objects.create(
-                    ticket=ticket_obj,
-                    station=destination,
-                    direction='EXIT',
-                    scanned_by=request.user
-                )
+                ticket_obj.token = issue_token(ticket_obj)
+                with transaction.atomic():
+                    ticket_obj.save(force_insert=True)
+                    entry = TicketScan.objects.create(
+                        ticket=ticket_obj,
+                        station=source,
+                        direction='ENTRY',
+                        scanned_by=request.user
+                    )
+                    exit_scan = TicketScan.objects.create(
+                        ticket=ticket_obj,
+                        station=destination,
+                        direction='EXIT',
+                        scanned_by=request.user
+                    )
+                    record_scans([
+                        (source.id, entry.scanned_at, 'ENTRY'),
+                        (destination.id, exit_scan.scanned_at, 'EXIT'),
+                    ])
                 message = f"Offline ticket created and marked as USED. Ticket ID: {ticket_obj.id}"
     else:
         form = OfflineTicketForm()
@@ -474,96 +581,115 @@ def scanner_offline_ticket_view(request):
 
 @staff_member_required
 def footfall_report_view(request):
-
-    scans = (
-        TicketScan.objects
-        .annotate(day=TruncDate('scanned_at'))
-        .values('day', 'station__name')
-        .annotate(count=Count('id'))
-        .order_by('-day', 'station__name')
-    )
+    form = FootfallFilterForm(request.GET or {})
+    rows = []
+    if form.is_valid():
+        start, end = day_range(form.cleaned_data['start'], form.cleaned_data['end'])
+        rows = footfall_rows(start, end, form.cleaned_data['granularity'])
 
     context = {
-        'rows': scans,
+        'form': form,
+        'rows': rows,
+        'hourly': form.is_valid() and form.cleaned_data['granularity'] == 'hour',
     }
     return render(request, 'metro/admin_footfall.html', context)
 
 
-LINE_COLOR_MAP = {
-    'R': 'red',
-    'B': 'blue',
-    'O': 'orange',
-    'Y': 'gold',
-    'G': 'green'
-}
-
-def build_graph_from_db():
-    G = nx.Graph()
-    from .models import Station, Connection
-
-    for st in Station.objects.all():
-        G.add_node(st.code, label=st.name)
-
-    # Add edges with line id stored
-    for conn in Connection.objects.select_related('line', 'from_station', 'to_station').all():
-        a = conn.from_station.code
-        b = conn.to_station.code
-        G.add_edge(a, b, line=conn.line.code if conn.line else None)
-
-    return G
-
+@staff_member_required
+def export_view(request, dataset):
+    """
+    Stream raw scans or tickets as CSV or NDJSON. Query parameters: start
+    and end (local dates, inclusive), station (id) and format.
+    """
+    if dataset not in exports.EXPORTS:
+        raise Http404(f"No export named {dataset}.")
+    form = ExportFilterForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    data = form.cleaned_data
+    start = day_range(data['start'], data['start'])[0] if data['start'] else None
+    end = day_range(data['end'], data['end'])[1] if data['end'] else None
+    station = data['station']
+    columns, rows = exports.export_rows(dataset, start, end, station.id if station else None)
+
+    render_rows, content_type = exports.FORMATS[data['format']]
+    response = StreamingHttpResponse(render_rows(columns, rows), content_type=content_type)
+    period = f"{data['start'] or 'start'}_{data['end'] or 'now'}"
+    response['Content-Disposition'] = f'attachment; filename="{dataset}-{period}.{data["format"]}"'
+    return response
+
+
+def _map_highlight_codes(request):
+    """
+    Station codes of the ?highlight=<ticket> path, looked up once per request.
+    """
+    if not hasattr(request, '_map_highlight_codes'):
+        codes = []
+        ticket_id = request.GET.get('highlight')
+        if ticket_id:
+            try:
+                path_repr = Ticket.objects.filter(id=ticket_id).values_list('path_repr', flat=True).first()
+            except ValidationError:
+                path_repr = None
+            codes = path_repr.split('-') if path_repr else []
+        request._map_highlight_codes = codes
+    return request._map_highlight_codes
+
+
+def _map_format(request):
+    return 'svg' if request.GET.get('format') == 'svg' else 'png'
+
+
+def _map_etag(request):
+    codes = _map_highlight_codes(request)
+    suffix = f"-{maps.path_digest(codes)}" if len(codes) > 1 else ""
+    return f"map-v{current_map_version()}{suffix}-{_map_format(request)}"
+
+
+def _map_last_modified(request):
+    return topology_updated_at()
+
+
+@condition(etag_func=_map_etag, last_modified_func=_map_last_modified)
 def metro_map_image(request):
-    from .models import Ticket
-
-    G = build_graph_from_db()
-
-    pos = nx.spring_layout(G, seed=42)
-
-    fig = plt.figure(figsize=(10, 8))
-    ax = fig.add_subplot(111)
-    ax.set_title("Metro Map", fontsize=14, fontweight='bold')
-
-    edges_by_line = {}
-    for u, v, d in G.edges(data=True):
-        line_id = d.get('line') or 'UNKNOWN'
-        edges_by_line.setdefault(line_id, []).append((u, v))
-
-    for line_id, edges in edges_by_line.items():
-        color = LINE_COLOR_MAP.get(line_id, 'gray')
-        nx.draw_networkx_edges(G, pos, edgelist=edges, width=2.5, edge_color=color, alpha=0.9, ax=ax)
-
-    nx.draw_networkx_nodes(G, pos, node_size=400, node_color='lightgray', ax=ax)
-    labels = {n: G.nodes[n].get('label', n) for n in G.nodes()}
-    nx.draw_networkx_labels(G, pos, labels=labels, font_size=8, ax=ax)
-
-    legend_handles = []
-    for line_id, color in LINE_COLOR_MAP.items():
-        from .models import MetroLine
-        line_obj = MetroLine.objects.filter(code=line_id).first()
-        line_name = line_obj.name if line_obj else line_id
-        legend_handles.append(mlines.Line2D([], [], color=color, marker='_', markersize=15, label=f"{line_name}"))
-    ax.legend(handles=legend_handles, title="Lines", loc='upper left')
+    version = current_map_version()
+    codes = _map_highlight_codes(request)
+    if _map_format(request) == 'svg':
+        response = StreamingHttpResponse(maps.iter_svg(version, codes), content_type='image/svg+xml')
+    elif len(codes) > 1:
+        response = HttpResponse(maps.highlighted_map(version, codes), content_type='image/png')
+    else:
+        response = HttpResponse(maps.base_map(version)[0], content_type='image/png')
+
+    patch_cache_control(response, public=True, max_age=60)
+    return response
+
+
+@condition(etag_func=lambda request: f"map-data-v{current_map_version()}",
+           last_modified_func=_map_last_modified)
+def metro_map_data(request):
+    """
+    Stations with their stored map positions, connections and line colours
+    for client-side map rendering, from the same cached layout as the images.
+    """
+    layout = maps.map_layout(current_map_version())
+    pos, labels = layout['pos'], layout['labels']
+    line_names = get_registry().line_names
+    response = JsonResponse({
+        'stations': [
+            {'code': n, 'name': labels.get(n, n), 'x': x, 'y': y}
+            for n, (x, y) in pos.items()
+        ],
+        'connections': [{'from': u, 'to': v, 'line': line} for u, v, line in layout['edges']],
+        'lines': [
+            {'code': code, 'name': name, 'color': maps.LINE_COLOR_MAP.get(code, 'gray')}
+            for code, name in line_names.items()
+        ],
+    })
+    patch_cache_control(response, public=True, max_age=60)
+    return response
 
-    ticket_id = request.GET.get('highlight')
-    if ticket_id:
-        try:
-            ticket = Ticket.objects.get(id=ticket_id)
-            path_codes = ticket.path_repr.split('-') if ticket.path_repr else []
-            path_edges = list(zip(path_codes, path_codes[1:])) if len(path_codes) > 1 else []
-            if path_edges:
-                nx.draw_networkx_edges(G, pos, edgelist=path_edges, width=4.0, edge_color='black', style='dashed', ax=ax)
-                nx.draw_networkx_nodes(G, pos, nodelist=path_codes, node_size=500, node_color='yellow', ax=ax)
-        except Ticket.DoesNotExist:
-            pass
-
-    ax.axis('off')
-    plt.tight_layout()
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=150)
-    plt.close(fig)
-    buf.seek(0)
-    return HttpResponse(buf.getvalue(), content_type='image/png')
 
 @login_required
 def metro_map_view(request):
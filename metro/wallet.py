@@ -0,0 +1,136 @@
+"""
+Passenger wallets.
+
+WalletTransaction is the append-only ledger and the source of truth;
+PassengerProfile.balance is a snapshot of its sum kept so balance checks
+need not add up the ledger. credit() and debit() move both together: one
+conditional UPDATE ... SET balance = balance + amount, so concurrent
+requests cannot overwrite each other's changes and an overdraft is refused
+by the database rather than by a stale read, plus the ledger INSERT, in
+one transaction. reconcile_wallets checks the snapshots against the ledger.
+The statement page reads the ledger through statement_page() and
+monthly_totals().
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Q, Sum, Value
+from django.db.models.functions import Coalesce, TruncMonth
+
+from accounts.models import PassengerProfile
+
+from .models import WalletTransaction
+from .tickets import decode_cursor, encode_cursor
+
+STATEMENT_PAGE_SIZE = 25
+STATEMENT_MONTHS = 12
+
+
+class InsufficientBalance(Exception):
+    pass
+
+
+def _post(passenger_id, amount, description, guard=Q()):
+    with transaction.atomic():
+        updated = (PassengerProfile.objects
+                   .filter(guard, pk=passenger_id)
+                   .update(balance=F('balance') + amount))
+        if not updated:
+            raise InsufficientBalance(f"Balance is less than ₹{-amount}.")
+        return WalletTransaction.objects.create(passenger_id=passenger_id, amount=amount, description=description)
+
+
+def credit(passenger, amount, description=''):
+    """
+    Add amount (> 0) to the passenger's wallet. Returns the ledger entry.
+    The passenger instance's balance attribute is not refreshed.
+    """
+    if amount <= 0:
+        raise ValueError("Credit amount must be positive.")
+    return _post(passenger.pk, amount, description)
+
+
+def debit(passenger, amount, description=''):
+    """
+    Take amount (> 0) from the passenger's wallet, raising
+    InsufficientBalance if the balance at the time of the UPDATE does not
+    cover it. Returns the ledger entry. Call it inside the transaction that
+    records what was paid for, so a failure there refunds it.
+    """
+    if amount <= 0:
+        raise ValueError("Debit amount must be positive.")
+    return _post(passenger.pk, -amount, description, Q(balance__gte=amount))
+
+
+def ledger_balances():
+    """
+    Profiles annotated with ledger, the sum of their wallet transactions.
+    """
+    return PassengerProfile.objects.annotate(ledger=Coalesce(
+        Sum('transactions__amount'), Value(Decimal('0.00')),
+        output_field=DecimalField(max_digits=8, decimal_places=2),
+    ))
+
+
+def mismatched_wallets():
+    """
+    (profile id, balance, ledger sum) for every profile whose balance
+    snapshot disagrees with its ledger, found in one grouped query.
+    """
+    return (ledger_balances()
+            .exclude(balance=F('ledger'))
+            .order_by('pk')
+            .values_list('pk', 'balance', 'ledger'))
+
+
+def repair_wallets(profile_ids):
+    """
+    Reset the balance snapshot of profile_ids to their ledger sums. The
+    profiles are locked first, so no debit or credit is half-applied while
+    the ledger is read. Returns the number of profiles changed.
+    """
+    repaired = 0
+    with transaction.atomic():
+        list(PassengerProfile.objects.select_for_update().filter(pk__in=profile_ids).values_list('pk'))
+        for pk, _balance, ledger in mismatched_wallets().filter(pk__in=profile_ids):
+            repaired += PassengerProfile.objects.filter(pk=pk).update(balance=ledger)
+    return repaired
+
+
+def statement_page(passenger, before=None, size=STATEMENT_PAGE_SIZE):
+    """
+    One page of a passenger's wallet transactions, newest first. before is
+    the cursor of the previous page's last entry. Returns (transactions,
+    cursor for the next page or None). Seeks into the (passenger,
+    created_at, id) index, like metro.tickets.ticket_history_page().
+    """
+    entries = WalletTransaction.objects.filter(passenger=passenger).order_by('-created_at', '-id')
+    if before:
+        created_at, pk = decode_cursor(before, int)
+        entries = entries.filter(created_at__lte=created_at).filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+        )
+
+    entries = list(entries[:size + 1])
+    if len(entries) <= size:
+        return entries, None
+    entries = entries[:size]
+    return entries, encode_cursor(entries[-1].created_at, entries[-1].id)
+
+
+def monthly_totals(passenger, months=STATEMENT_MONTHS):
+    """
+    Credits, debits (as a positive amount) and entry count per local month,
+    newest first, for up to months months with activity, in one grouped
+    query.
+    """
+    zero = Value(Decimal('0.00'))
+    return (WalletTransaction.objects
+            .filter(passenger=passenger)
+            .values(month=TruncMonth('created_at'))
+            .annotate(
+                credits=Sum('amount', filter=Q(amount__gt=0), default=zero),
+                debits=Sum(-F('amount'), filter=Q(amount__lt=0), default=zero),
+                entries=Count('id'),
+            )
+            .order_by('-month')[:months])
@@ -122,6 +122,27 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# The 'routes' cache holds shortest-path results. Point ROUTE_CACHE_BACKEND at
+# a shared backend (e.g. django.core.cache.backends.redis.RedisCache) so all
+# gunicorn workers share it; the default locmem cache is per worker and LRU.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'routes': {
+        'BACKEND': os.getenv('ROUTE_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('ROUTE_CACHE_LOCATION', 'metro-routes'),
+        'TIMEOUT': int(os.getenv('ROUTE_CACHE_TIMEOUT', '3600')),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('ROUTE_CACHE_MAX_ENTRIES', '20000')),
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -186,6 +207,35 @@ SOCIALACCOUNT_PROVIDERS = {
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 OTP_EXPIRY_MINUTES = 5
 
+# How often (seconds) a worker re-reads the shared topology version before
+# trusting its cached network graph.
+METRO_TOPOLOGY_CHECK_SECONDS = float(os.getenv('METRO_TOPOLOGY_CHECK_SECONDS', '2'))
+# Cache alias used for shortest-path results; set to '' to disable.
+METRO_ROUTE_CACHE_ALIAS = os.getenv('METRO_ROUTE_CACHE_ALIAS', 'routes')
+# Directory for mmapped routing snapshots shared by all workers on a host.
+# Unset keeps a private in-memory engine per worker.
+METRO_SNAPSHOT_DIR = os.getenv('METRO_SNAPSHOT_DIR') or None
+# Fare rules, see metro.fares.Tariff. None keeps the flat ₹5.00 per edge.
+# Rebuild the route table (manage.py build_route_table) after changing it.
+METRO_TARIFF = None
+# Maximum number of source/destination pairs accepted by the batch quote API.
+METRO_QUOTE_BATCH_LIMIT = int(os.getenv('METRO_QUOTE_BATCH_LIMIT', '100'))
+# Maximum number of buffered scans accepted in one offline gate upload.
+METRO_GATE_UPLOAD_LIMIT = int(os.getenv('METRO_GATE_UPLOAD_LIMIT', '20000'))
+# Directory of ES256 ticket signing keys (manage.py generate_ticket_key).
+# Unset issues tickets without offline tokens.
+METRO_TICKET_KEY_DIR = os.getenv('METRO_TICKET_KEY_DIR') or None
+# Pin the signing key by kid; by default the newest key in the directory signs.
+METRO_TICKET_SIGNING_KID = os.getenv('METRO_TICKET_SIGNING_KID') or None
+# Gate ticket feed: tickets changed within the lag are held back until any
+# transaction that wrote them has surely committed; page size caps a delta.
+METRO_GATE_FEED_LAG_SECONDS = float(os.getenv('METRO_GATE_FEED_LAG_SECONDS', '10'))
+METRO_GATE_FEED_PAGE_SIZE = int(os.getenv('METRO_GATE_FEED_PAGE_SIZE', '5000'))
+# Months of scans kept in the database (tickets are kept a month longer);
+# manage.py archive_history moves older months to METRO_ARCHIVE_DIR.
+METRO_RETENTION_MONTHS = int(os.getenv('METRO_RETENTION_MONTHS', '6'))
+METRO_ARCHIVE_DIR = os.getenv('METRO_ARCHIVE_DIR') or None
+
 
 
 # ----- added to ensure production ALLOWED_HOSTS -----